@@ -0,0 +1,306 @@
+import argparse
+import os
+import re
+import time
+from collections import defaultdict
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from http_cache import parse_timestamp
+from search import normalize_vn
+
+# Rollup days follow the school's clock, not UTC
+ANALYTICS_TIMEZONE = ZoneInfo(os.environ.get("ANALYTICS_TIMEZONE", "Asia/Ho_Chi_Minh"))
+BACKFILL_FETCH_ROWS = 5000
+REBUILD_LOCK_TIMEOUT = os.environ.get("ANALYTICS_REBUILD_LOCK_TIMEOUT", "2s")
+REBUILD_LOCK_ATTEMPTS = 5
+
+ROLLUP_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily_class (
+        day DATE NOT NULL,
+        class TEXT NOT NULL,
+        questions INTEGER NOT NULL DEFAULT 0,
+        ai_replies INTEGER NOT NULL DEFAULT 0,
+        teacher_replies INTEGER NOT NULL DEFAULT 0,
+        ai_response_count INTEGER NOT NULL DEFAULT 0,
+        ai_response_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+        teacher_response_count INTEGER NOT NULL DEFAULT 0,
+        teacher_response_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, class)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily_topic (
+        day DATE NOT NULL,
+        class TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        questions INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, class, topic)
+    )
+    """,
+    # First unanswered question per session; the next reply turns it into a response time
+    """
+    CREATE TABLE IF NOT EXISTS analytics_pending_question (
+        session_id INTEGER PRIMARY KEY,
+        asked_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+]
+
+ROLLUP_COLUMNS = ["questions", "ai_replies", "teacher_replies", "ai_response_count", "ai_response_seconds",
+                  "teacher_response_count", "teacher_response_seconds"]
+_COLUMN_INDEX = {column: i for i, column in enumerate(ROLLUP_COLUMNS)}
+# rollup table -> (primary key, other columns), for rebuild_rollups()
+REBUILD_TABLES = {
+    "analytics_daily_class": (["day", "class"], ROLLUP_COLUMNS),
+    "analytics_daily_topic": (["day", "class", "topic"], ["questions"]),
+    "analytics_pending_question": (["session_id"], ["asked_at"]),
+}
+
+# topic -> (label shown to teachers, keywords matched on accent-folded lowercase text)
+TOPICS = {
+    "otp": ("Mã OTP, mật khẩu", ["otp", "ma xac thuc", "ma xac nhan", "mat khau", "password", "ma pin"]),
+    "chuyen_khoan": ("Chuyển khoản, ngân hàng", ["chuyen khoan", "chuyen tien", "ngan hang", "so tai khoan", "stk", "banking"]),
+    "link_la": ("Đường link, tin nhắn lạ", ["link", "duong link", "duong dan", "tin nhan la", "ma qr", "qr", "tai app", "cai app"]),
+    "gia_danh": ("Giả danh công an, người quen", ["gia danh", "mao danh", "cong an", "toa an", "vien kiem sat", "nguoi quen"]),
+    "viec_lam": ("Việc làm online, làm nhiệm vụ", ["viec lam", "lam nhiem vu", "cong tac vien", "ctv", "kiem tien", "viec nhe"]),
+    "trung_thuong": ("Trúng thưởng, quà tặng", ["trung thuong", "giai thuong", "qua tang", "tri an", "mien phi"]),
+    "mang_xa_hoi": ("Tài khoản mạng xã hội", ["facebook", "zalo", "tiktok", "messenger", "hack", "nick", "chiem tai khoan"]),
+    "vay_dau_tu": ("Vay tiền, đầu tư", ["vay tien", "vay online", "app vay", "dau tu", "lai suat", "tien ao", "crypto"]),
+    "mua_ban": ("Mua bán online", ["mua hang", "mua online", "dat coc", "shop", "shopee", "giao hang", "shipper"]),
+    "game": ("Game, nạp thẻ", ["game", "nap the", "the cao", "kim cuong", "skin", "acc game"]),
+}
+OTHER_TOPIC = "khac"
+TOPIC_LABELS = {topic: label for topic, (label, _) in TOPICS.items()}
+TOPIC_LABELS[OTHER_TOPIC] = "Khác"
+_TOPIC_PATTERNS = {
+    topic: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True)) + r")\b")
+    for topic, (_, keywords) in TOPICS.items()
+}
+
+
+def classify_topics(content: str) -> List[str]:
+    folded = normalize_vn(content or "").lower()
+    topics = [topic for topic, pattern in _TOPIC_PATTERNS.items() if pattern.search(folded)]
+    return topics or [OTHER_TOPIC]
+
+
+def local_day(timestamp: Optional[datetime]) -> date:
+    return (timestamp or datetime.now(timezone.utc)).astimezone(ANALYTICS_TIMEZONE).date()
+
+
+def record_message(cursor, session_id: int, class_name: Optional[str], role: str, content: str, timestamp: str):
+    # Call in the same transaction as the INSERT into conversations, so a message
+    # and its rollup rows commit (or roll back) together
+    sent_at = parse_timestamp(timestamp) or datetime.now(timezone.utc)
+    day = local_day(sent_at)
+    class_name = class_name or ""
+    if role == "user":
+        cursor.execute("""
+        INSERT INTO analytics_daily_class (day, class, questions) VALUES (%s, %s, 1)
+        ON CONFLICT (day, class) DO UPDATE SET questions = analytics_daily_class.questions + 1
+        """, (day, class_name))
+        execute_values(cursor, """
+        INSERT INTO analytics_daily_topic (day, class, topic, questions) VALUES %s
+        ON CONFLICT (day, class, topic) DO UPDATE SET questions = analytics_daily_topic.questions + 1
+        """, [(day, class_name, topic, 1) for topic in classify_topics(content)])
+        cursor.execute("INSERT INTO analytics_pending_question (session_id, asked_at) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                       (session_id, sent_at))
+    elif role in ("assistant", "teacher"):
+        prefix = "ai" if role == "assistant" else "teacher"
+        cursor.execute("DELETE FROM analytics_pending_question WHERE session_id = %s RETURNING asked_at", (session_id,))
+        pending = cursor.fetchone()
+        answered = 1 if pending else 0
+        seconds = max((sent_at - pending[0]).total_seconds(), 0.0) if pending else 0.0
+        cursor.execute(f"""
+        INSERT INTO analytics_daily_class (day, class, {prefix}_replies, {prefix}_response_count, {prefix}_response_seconds)
+        VALUES (%s, %s, 1, %s, %s)
+        ON CONFLICT (day, class) DO UPDATE SET
+            {prefix}_replies = analytics_daily_class.{prefix}_replies + 1,
+            {prefix}_response_count = analytics_daily_class.{prefix}_response_count + EXCLUDED.{prefix}_response_count,
+            {prefix}_response_seconds = analytics_daily_class.{prefix}_response_seconds + EXCLUDED.{prefix}_response_seconds
+        """, (day, class_name, answered, seconds))
+
+
+def forget_session(cursor, session_id: int):
+    cursor.execute("DELETE FROM analytics_pending_question WHERE session_id = %s", (session_id,))
+
+
+def _lock_tables(conn, tables: str, mode: str):
+    # A LOCK that waits behind a long transaction holds up every writer queued behind it, so
+    # each attempt gives up after REBUILD_LOCK_TIMEOUT and tries again a little later
+    cursor = conn.cursor()
+    for attempt in range(1, REBUILD_LOCK_ATTEMPTS + 1):
+        cursor.execute("SAVEPOINT rebuild_lock")
+        try:
+            cursor.execute(f"SET LOCAL lock_timeout = '{REBUILD_LOCK_TIMEOUT}'")
+            cursor.execute(f"LOCK TABLE {tables} IN {mode} MODE")
+            cursor.execute("SET LOCAL lock_timeout = DEFAULT")
+            cursor.execute("RELEASE SAVEPOINT rebuild_lock")
+            return
+        except psycopg2.errors.LockNotAvailable:
+            cursor.execute("ROLLBACK TO SAVEPOINT rebuild_lock")
+            print(f"Waiting to lock {tables} ({attempt}/{REBUILD_LOCK_ATTEMPTS})")
+            time.sleep(attempt)
+    raise RuntimeError(f"Could not lock {tables}, try again when the server is less busy")
+
+
+def rebuild_rollups(conn, connect) -> Dict[str, int]:
+    # Recomputes every rollup from conversations and archived sessions without holding up
+    # record_message(): the scan runs on a snapshot and fills temporary tables, and the rollup
+    # tables are only locked at the end, to merge those in and replay the messages saved since
+    # the snapshot. connect() opens a second connection, used for a moment to take the snapshot.
+    # Imported here: archive imports bulk_import, which imports this module
+    from archive import iter_archived_rows, lock_archive_files, unlock_archive_files
+    conn.commit()
+    cursor = conn.cursor()
+    class_rows: Dict[Tuple[date, str], List[float]] = defaultdict(lambda: [0] * len(ROLLUP_COLUMNS))
+    topic_rows: Dict[Tuple[date, str, str], int] = defaultdict(int)
+    pending: Dict[int, datetime] = {}
+    scanned = 0
+
+    def add(session_id, role, content, timestamp, class_name):
+        sent_at = parse_timestamp(timestamp) or datetime.now(timezone.utc)
+        key = (local_day(sent_at), class_name or "")
+        values = class_rows[key]
+        if role == "user":
+            values[_COLUMN_INDEX["questions"]] += 1
+            for topic in classify_topics(content):
+                topic_rows[key + (topic,)] += 1
+            pending.setdefault(session_id, sent_at)
+        elif role in ("assistant", "teacher"):
+            prefix = "ai" if role == "assistant" else "teacher"
+            values[_COLUMN_INDEX[f"{prefix}_replies"]] += 1
+            asked_at = pending.pop(session_id, None)
+            if asked_at is not None:
+                values[_COLUMN_INDEX[f"{prefix}_response_count"]] += 1
+                values[_COLUMN_INDEX[f"{prefix}_response_seconds"]] += max((sent_at - asked_at).total_seconds(), 0.0)
+
+    # While no insert into conversations is in flight, every message the snapshot cannot see
+    # gets a higher id than every message it can; a SHARE lock held from another connection
+    # waits out the inserts in flight and keeps new ones back just until the snapshot is taken.
+    # The same connection holds the archive files lock until the files have been read, so no
+    # session is archived (counted twice) or restored (file gone) between snapshot and files.
+    locker = connect()
+    try:
+        locker_cursor = locker.cursor()
+        lock_archive_files(locker_cursor, exclusive=True)
+        _lock_tables(locker, "conversations", "SHARE")
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM conversations")
+        snapshot_id = cursor.fetchone()[0]
+        locker.commit()
+        # Sessions moved to cold storage still count; archiving moves a session's rows whole,
+        # so none of them overlap the conversations scan below
+        for row in iter_archived_rows(conn):
+            scanned += 1
+            add(*row)
+        unlock_archive_files(locker_cursor)
+    finally:
+        locker.close()
+
+    with conn.cursor(name="analytics_backfill") as scan:
+        scan.itersize = BACKFILL_FETCH_ROWS
+        scan.execute("""
+        SELECT c.session_id, c.role, c.content, c.timestamp, st.class
+        FROM conversations c
+        JOIN chat_sessions s ON s.id = c.session_id
+        JOIN students st ON st.id = s.student_id
+        WHERE c.id <= %s
+        ORDER BY c.session_id, c.id
+        """, (snapshot_id,))
+        for row in scan:
+            scanned += 1
+            add(*row)
+    conn.commit()
+
+    for table in REBUILD_TABLES:
+        cursor.execute(f"CREATE TEMP TABLE rebuild_{table} (LIKE {table}) ON COMMIT DROP")
+    execute_values(cursor, f"INSERT INTO rebuild_analytics_daily_class (day, class, {', '.join(ROLLUP_COLUMNS)}) VALUES %s",
+                   [key + tuple(values) for key, values in class_rows.items()], page_size=1000)
+    execute_values(cursor, "INSERT INTO rebuild_analytics_daily_topic (day, class, topic, questions) VALUES %s",
+                   [key + (count,) for key, count in topic_rows.items()], page_size=1000)
+    execute_values(cursor, "INSERT INTO rebuild_analytics_pending_question (session_id, asked_at) VALUES %s",
+                   list(pending.items()), page_size=1000)
+
+    # From here until the commit, record_message() waits. Only rows that differ are written, and
+    # DELETE is used rather than TRUNCATE, which would also wait for readers of the rollups.
+    _lock_tables(conn, ", ".join(REBUILD_TABLES), "EXCLUSIVE")
+    # Sessions deleted since the snapshot took their pending question with them
+    cursor.execute("""
+    DELETE FROM rebuild_analytics_pending_question r
+    WHERE NOT EXISTS (SELECT 1 FROM chat_sessions s WHERE s.id = r.session_id)
+    """)
+    for table, (keys, columns) in REBUILD_TABLES.items():
+        matches = " AND ".join(f"r.{key} = t.{key}" for key in keys)
+        cursor.execute(f"DELETE FROM {table} t WHERE NOT EXISTS (SELECT 1 FROM rebuild_{table} r WHERE {matches})")
+        cursor.execute(f"""
+        INSERT INTO {table} ({', '.join(keys + columns)}) SELECT {', '.join(keys + columns)} FROM rebuild_{table}
+        ON CONFLICT ({', '.join(keys)}) DO UPDATE SET ({', '.join(columns)}) = ROW({', '.join(f'EXCLUDED.{c}' for c in columns)})
+        WHERE ({', '.join(f'{table}.{c}' for c in columns)}) IS DISTINCT FROM ({', '.join(f'EXCLUDED.{c}' for c in columns)})
+        """)
+    # Messages committed since the snapshot go on top, as record_message() would have added them
+    cursor.execute("""
+    SELECT c.session_id, st.class, c.role, c.content, c.timestamp
+    FROM conversations c
+    JOIN chat_sessions s ON s.id = c.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE c.id > %s
+    ORDER BY c.id
+    """, (snapshot_id,))
+    replayed = cursor.fetchall()
+    for row in replayed:
+        record_message(cursor, *row)
+    conn.commit()
+    return {"messages": scanned, "replayed": len(replayed), "class_days": len(class_rows),
+            "topic_days": len(topic_rows), "pending": len(pending)}
+
+
+def summarize(rows: List[tuple]) -> dict:
+    # rows: (day, class, *ROLLUP_COLUMNS)
+    totals = dict.fromkeys(ROLLUP_COLUMNS, 0)
+    for row in rows:
+        for column, value in zip(ROLLUP_COLUMNS, row[2:]):
+            totals[column] += value
+    return with_averages(totals)
+
+
+def with_averages(values: dict) -> dict:
+    result = {
+        "questions": values["questions"],
+        "ai_replies": values["ai_replies"],
+        "teacher_replies": values["teacher_replies"],
+    }
+    for prefix in ("ai", "teacher"):
+        count = values[f"{prefix}_response_count"]
+        result[f"avg_{prefix}_response_seconds"] = round(values[f"{prefix}_response_seconds"] / count, 1) if count else None
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the /analytics rollup tables.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="rebuild all rollups from the conversations table")
+    args = parser.parse_args(argv)
+
+    # Imported here: bulk_import itself refreshes the rollups after an import
+    from bulk_import import connect
+    conn = connect()
+    cursor = conn.cursor()
+    for statement in ROLLUP_SCHEMA:
+        cursor.execute(statement)
+    conn.commit()
+    if args.command == "backfill":
+        started = time.perf_counter()
+        stats = rebuild_rollups(conn, connect)
+        print(", ".join(f"{k}={v}" for k, v in stats.items()) + f" in {time.perf_counter() - started:.2f}s")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
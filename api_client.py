@@ -0,0 +1,330 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlencode
+
+import httpx
+
+from cache import LRUCache
+
+try:
+    from websockets.exceptions import InvalidStatus
+    from websockets.sync.client import connect as ws_connect
+except ImportError:
+    ws_connect = None
+    InvalidStatus = None
+
+DEFAULT_API_URL = "http://localhost:8000"
+HTTP_POOL_SIZE = int(os.environ.get("CHAT_API_POOL_SIZE", "32"))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("CHAT_API_TIMEOUT_SECONDS", "10"))
+# Reads on /chatbot wait for the model, which can pause much longer than a normal request
+STREAM_READ_TIMEOUT_SECONDS = float(os.environ.get("CHAT_API_STREAM_TIMEOUT_SECONDS", "120"))
+ETAG_CACHE_ENTRIES = int(os.environ.get("CHAT_API_ETAG_CACHE_ENTRIES", "2048"))
+PUSH_IDLE_SECONDS = float(os.environ.get("CHAT_PUSH_IDLE_SECONDS", "60"))
+PUSH_RECONNECT_MAX_SECONDS = 30
+FAN_OUT_WORKERS = 8
+
+# chat_server.py reports a failed stream as one last SSE event starting with this text
+STREAM_ERROR_PREFIX = "Error in chatbot streaming:"
+
+
+class ApiError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _raise_for_status(response: httpx.Response):
+    if response.status_code < 400:
+        return
+    try:
+        detail = response.json().get("detail", response.text)
+    except ValueError:
+        detail = response.text
+    raise ApiError(response.status_code, str(detail))
+
+
+def parse_sse(chunks: Iterator[str]) -> Iterator[str]:
+    # chat_server.py writes each delta as "data: <text>\n\n" without escaping, so a
+    # delta that itself contains a blank line arrives split. A piece that does not
+    # start with "data: " is the rest of the previous delta.
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *events, buffer = buffer.split("\n\n")
+        for event in events:
+            yield event[len("data: "):] if event.startswith("data: ") else "\n\n" + event
+    if buffer:
+        yield buffer[len("data: "):] if buffer.startswith("data: ") else "\n\n" + buffer
+
+
+# Listens on one chat_server websocket and counts the change notifications it
+# receives, so the UI re-fetches only after something happened. The thread stops
+# by itself once nobody has asked for the channel in PUSH_IDLE_SECONDS.
+class PushChannel:
+    def __init__(self, url: str):
+        self.url = url
+        self.version = 0
+        self.connected = False
+        self.last_used = time.monotonic()
+        self._session_versions: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-api-push", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self._stop.set()
+
+    def version_for(self, session_id: Optional[int] = None) -> Optional[int]:
+        # None while disconnected: callers must fall back to polling
+        if not self.connected:
+            return None
+        with self._lock:
+            if session_id is None:
+                return self.version
+            return self._session_versions.get(session_id, 0)
+
+    def _idle(self) -> bool:
+        return time.monotonic() - self.last_used > PUSH_IDLE_SECONDS
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set() and not self._idle():
+            try:
+                with ws_connect(self.url, open_timeout=HTTP_TIMEOUT_SECONDS, close_timeout=1) as websocket:
+                    self.connected = True
+                    delay = 1
+                    while not self._stop.is_set() and not self._idle():
+                        try:
+                            raw = websocket.recv(timeout=1)
+                        except TimeoutError:
+                            continue
+                        self._on_frame(raw)
+            except Exception as e:
+                if InvalidStatus is not None and isinstance(e, InvalidStatus):
+                    # Rejected handshake (bad or expired token): the owner opens a new channel after re-login
+                    print(f"Push channel rejected for {self._safe_url()}: {e}")
+                    break
+                print(f"Push channel error for {self._safe_url()}: {e!r}")
+            finally:
+                self.connected = False
+            self._stop.wait(delay)
+            delay = min(delay * 2, PUSH_RECONNECT_MAX_SECONDS)
+        self._stop.set()
+
+    def _on_frame(self, raw):
+        try:
+            frame = json.loads(raw)
+        except ValueError:
+            return
+        # Live "delta" frames are followed by a "done" frame once the reply is saved
+        if frame.get("type") in ("ping", "delta"):
+            return
+        session_id = frame.get("session_id", frame.get("sessionId"))
+        with self._lock:
+            self.version += 1
+            if session_id is not None:
+                self._session_versions[session_id] = self._session_versions.get(session_id, 0) + 1
+
+    def _safe_url(self) -> str:
+        # The last path segment is the token
+        return self.url.rsplit("/", 1)[0] + "/***"
+
+
+# Process-wide client: one keep-alive connection pool, one ETag cache and one set
+# of push channels shared by every UI session. Safe to use from several threads.
+class ApiClient:
+    def __init__(self, base_url: str, pool_size: int = HTTP_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = "ws" + self.base_url[len("http"):] if self.base_url.startswith("http") else self.base_url
+        self.http = httpx.Client(
+            base_url=self.base_url,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self.etags: LRUCache[str, tuple] = LRUCache("api_etag", ETAG_CACHE_ENTRIES)
+        self._channels: Dict[str, PushChannel] = {}
+        self._channels_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="chat-api")
+
+    def request(self, method: str, path: str, params: Optional[dict] = None, json_body=None):
+        response = self.http.request(method, path, params=params, json=json_body)
+        _raise_for_status(response)
+        return response.json()
+
+    def get_json(self, path: str, params: dict):
+        # Revalidate with the stored ETag; a 304 reuses the body we already parsed.
+        # Returned bodies are shared between callers and must not be modified.
+        key = path + "?" + urlencode(sorted(params.items()))
+        cached = self.etags.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else None
+        response = self.http.get(path, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        _raise_for_status(response)
+        body = response.json()
+        etag = response.headers.get("etag")
+        if etag:
+            self.etags.set(key, (etag, body))
+        return body
+
+    def open_stream(self, path: str, params: dict, json_body) -> httpx.Response:
+        request = self.http.build_request(
+            "POST", path, params=params, json=json_body,
+            timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, read=STREAM_READ_TIMEOUT_SECONDS),
+        )
+        response = self.http.send(request, stream=True)
+        if response.status_code >= 400:
+            response.read()
+            response.close()
+            _raise_for_status(response)
+        return response
+
+    def channel(self, path: str) -> Optional[PushChannel]:
+        if ws_connect is None:
+            return None
+        with self._channels_lock:
+            for key in [key for key, ch in self._channels.items() if not ch.alive]:
+                del self._channels[key]
+            channel = self._channels.get(path)
+            if channel is None:
+                channel = self._channels[path] = PushChannel(self.ws_url + path)
+            channel.touch()
+            return channel
+
+    def map(self, fn: Callable, items) -> List:
+        return list(self._executor.map(fn, items))
+
+    def close(self):
+        with self._channels_lock:
+            for channel in self._channels.values():
+                channel.close()
+            self._channels.clear()
+        self._executor.shutdown(wait=False)
+        self.http.close()
+
+
+# One logged-in user. Keeps the credentials in server memory so an expired
+# token is renewed with a fresh login instead of bouncing the user out.
+class ApiSession:
+    def __init__(self, client: ApiClient, user_type: str, username: str, password: str):
+        self.client = client
+        self.user_type = user_type
+        self.username = username
+        self._password = password
+        self.user_id = None
+        self.token = None
+        self.login()
+
+    def login(self):
+        path = "/teacher_login" if self.user_type == "teacher" else "/student_login"
+        data = self.client.request("POST", path, json_body={"username": self.username, "password": self._password})
+        self.user_id = data["id"]
+        self.token = data["token"]
+
+    def _call(self, fn: Callable[[str], object]):
+        try:
+            return fn(self.token)
+        except ApiError as e:
+            if e.status_code != 401:
+                raise
+            self.login()
+            return fn(self.token)
+
+    def get_student(self, student_id: int) -> Optional[dict]:
+        try:
+            return self._call(lambda token: self.client.request("GET", f"/student/{student_id}", {"token": token}))
+        except ApiError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    def get_students(self) -> List[dict]:
+        return self._call(lambda token: self.client.get_json("/students", {"token": token}))
+
+    def get_sessions(self, student_id: int) -> List[dict]:
+        return self._call(lambda token: self.client.get_json(f"/sessions/{student_id}", {"token": token}))
+
+    def create_session(self, student_id: int, title: str) -> int:
+        body = lambda token: {"session": {"student_id": student_id, "title": title}, "token": token}
+        return self._call(lambda token: self.client.request("POST", "/sessions", json_body=body(token)))["id"]
+
+    def get_latest_session(self, student_id: int) -> Optional[int]:
+        return self._call(lambda token: self.client.request(
+            "GET", f"/student/{student_id}/latest_session", {"token": token}))["session_id"]
+
+    def get_conversations(self, session_id: int) -> List[dict]:
+        return self._call(lambda token: self.client.get_json(f"/conversations/{session_id}", {"token": token}))
+
+    def add_message(self, session_id: int, role: str, content: str):
+        message = {"session_id": session_id, "role": role, "content": content,
+                   "timestamp": datetime.now(timezone.utc).isoformat()}
+        self._call(lambda token: self.client.request("POST", "/conversations",
+                                                     json_body={"message": message, "token": token}))
+
+    def mark_read(self, session_id: int):
+        self._call(lambda token: self.client.request("POST", f"/mark_read/{session_id}", {"token": token}))
+
+    def get_unread(self, student_id: int) -> bool:
+        return self._call(lambda token: self.client.request("GET", f"/unread/{student_id}", {"token": token}))["unread"]
+
+    def get_last_message_time(self, student_id: int) -> str:
+        return self._call(lambda token: self.client.request(
+            "GET", f"/last_message/{student_id}", {"token": token}))["last_time"]
+
+    def search(self, query: str, class_name: Optional[str] = None, date_from=None, date_to=None,
+               before_id: Optional[int] = None, limit: int = 20) -> dict:
+        params = {"q": query, "limit": limit}
+        if class_name:
+            params["class_name"] = class_name
+        if date_from:
+            params["date_from"] = date_from.isoformat()
+        if date_to:
+            params["date_to"] = date_to.isoformat()
+        if before_id:
+            params["before_id"] = before_id
+        return self._call(lambda token: self.client.request("GET", "/search", {**params, "token": token}))
+
+    def stream_chat(self, session_id: int, messages: List[dict], ai_enabled: bool = True) -> Iterator[str]:
+        # The server adds the system prompt and saves the finished reply itself
+        timestamp = datetime.now(timezone.utc).isoformat()
+        body = {
+            "session_id": session_id,
+            "ai_enabled": ai_enabled,
+            "messages": [{"role": m["role"], "content": m["content"], "timestamp": timestamp}
+                         for m in messages if m["role"] != "system"],
+        }
+        response = self._call(lambda token: self.client.open_stream("/chatbot", {"token": token}, body))
+        try:
+            for content in parse_sse(response.iter_text()):
+                if content.startswith(STREAM_ERROR_PREFIX):
+                    raise ApiError(500, content)
+                yield content
+        finally:
+            response.close()
+
+    def push_channel(self, session_id: Optional[int] = None) -> Optional[PushChannel]:
+        # Teachers hear about every student message on their own socket; students
+        # get teacher and AI replies on the socket of the session they are viewing
+        if self.user_type == "teacher":
+            return self.client.channel(f"/ws/teacher/{self.user_id}/{self.token}")
+        return self.client.channel(f"/ws/{session_id}/{self.token}")
+
+
+def register_student(client: ApiClient, username: str, name: str, class_name: str, gvcn: str, password: str) -> int:
+    data = client.request("POST", "/student_register", json_body={
+        "username": username, "name": name, "class_name": class_name, "gvcn": gvcn, "password": password})
+    return data["id"]
@@ -0,0 +1,488 @@
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import psycopg2
+
+from bulk_import import copy_rows
+from cache import LRUCache
+from http_cache import parse_timestamp
+
+# Where archived sessions are kept, outside the source tree; archiving stays off until it is set
+ARCHIVE_DIR = os.environ.get("CONVERSATION_ARCHIVE_DIR")
+# Sessions idle this long move to compressed files; 0 disables archiving
+ARCHIVE_AFTER_DAYS = int(os.environ.get("CONVERSATION_ARCHIVE_AFTER_DAYS", "180"))
+# Archived sessions idle this long are deleted for good; 0 keeps them forever
+RETENTION_DAYS = int(os.environ.get("CONVERSATION_RETENTION_DAYS", "0"))
+PARTITIONS_AHEAD = int(os.environ.get("CONVERSATION_PARTITIONS_AHEAD", "3"))
+ARCHIVE_BATCH_SESSIONS = int(os.environ.get("CONVERSATION_ARCHIVE_BATCH_SESSIONS", "200"))
+# Partition DDL needs a strong lock on conversations; give up and retry next run instead of queueing requests
+MAINTENANCE_LOCK_TIMEOUT = os.environ.get("CONVERSATION_MAINTENANCE_LOCK_TIMEOUT", "500ms")
+
+CONVERSATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id SERIAL,
+    session_id INTEGER REFERENCES chat_sessions(id),
+    role TEXT,
+    content TEXT,
+    timestamp TEXT,
+    read_by_teacher INTEGER DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at)
+"""
+
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archived_sessions (
+        session_id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        message_count INTEGER NOT NULL,
+        last_message_at TIMESTAMPTZ NOT NULL,
+        bytes INTEGER NOT NULL,
+        archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archived_sessions_last_message_at_idx ON archived_sessions (last_message_at)",
+]
+
+MESSAGE_FIELDS = ["id", "role", "content", "timestamp", "read_by_teacher", "created_at"]
+
+# Advisory lock taken shared by every transaction that changes which archive files exist, and
+# exclusively by analytics.rebuild_rollups() while it reads them against its snapshot
+ARCHIVE_FILES_LOCK = "conversation_archive_files"
+
+# Parsed archive files: the same old session is usually opened several times in a row
+archive_cache: LRUCache[int, list] = LRUCache("archived_conversations", 256, 300)
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"conversations_p{month:%Y_%m}"
+
+
+def is_partitioned(cursor) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('conversations')")
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def ensure_partitions(cursor, months: Iterable[date]) -> List[str]:
+    created = []
+    for month in sorted(set(months)):
+        name = partition_name(month)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is not None:
+            continue
+        lower = datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+        upper = datetime(*add_months(month, 1).timetuple()[:3], tzinfo=timezone.utc)
+        cursor.execute("SELECT to_regclass('conversations_default')")
+        in_default = False
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM conversations_default WHERE created_at >= %s AND created_at < %s)",
+                           (lower, upper))
+            in_default = cursor.fetchone()[0]
+        if in_default:
+            # Rows of this month were restored while it had no partition. Postgres refuses a new
+            # partition that overlaps rows in the default one, so move them into it before attaching.
+            cursor.execute(f"CREATE TABLE {name} (LIKE conversations INCLUDING DEFAULTS)")
+            cursor.execute(f"""
+            WITH moved AS (DELETE FROM conversations_default WHERE created_at >= %s AND created_at < %s RETURNING *)
+            INSERT INTO {name} SELECT * FROM moved
+            """, (lower, upper))
+            cursor.execute(f"ALTER TABLE conversations ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (lower, upper))
+        else:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)", (lower, upper))
+        created.append(name)
+    return created
+
+
+def upcoming_months(today: Optional[date] = None) -> List[date]:
+    current = month_start(today or datetime.now(timezone.utc))
+    return [add_months(current, i) for i in range(PARTITIONS_AHEAD + 1)]
+
+
+def create_conversations_table(cursor):
+    # Fresh databases start partitioned; older ones are converted by migrate_to_partitioned()
+    cursor.execute("SELECT to_regclass('conversations')")
+    if cursor.fetchone()[0] is None:
+        cursor.execute(CONVERSATIONS_TABLE)
+    else:
+        migrate_to_partitioned(cursor)
+    # Catches rows outside every monthly partition (very old imports, clock errors)
+    cursor.execute("CREATE TABLE IF NOT EXISTS conversations_default PARTITION OF conversations DEFAULT")
+    ensure_partitions(cursor, upcoming_months())
+    for statement in ARCHIVE_SCHEMA:
+        cursor.execute(statement)
+
+
+def migrate_to_partitioned(cursor):
+    if is_partitioned(cursor):
+        return
+    print("Migrating conversations to a monthly partitioned table")
+    cursor.execute("ALTER TABLE conversations RENAME TO conversations_unpartitioned")
+    # Old indexes keep their names on the renamed table; free them for the new table
+    cursor.execute("ALTER TABLE conversations_unpartitioned DROP CONSTRAINT IF EXISTS conversations_pkey")
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'conversations_unpartitioned'")
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f'DROP INDEX "{index_name}"')
+    cursor.execute(CONVERSATIONS_TABLE.replace("id SERIAL", "id INTEGER NOT NULL DEFAULT nextval('conversations_id_seq')"))
+    cursor.execute("ALTER SEQUENCE conversations_id_seq OWNED BY conversations.id")
+    cursor.execute("CREATE TABLE conversations_default PARTITION OF conversations DEFAULT")
+    # Message timestamps are ISO text, read as UTC when they carry no offset (like
+    # http_cache.parse_timestamp); anything unparsable is filed under the migration time
+    cursor.execute("SET LOCAL TimeZone = 'UTC'")
+    created_at = r"""CASE WHEN timestamp ~ '^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}' THEN timestamp::timestamptz ELSE now() END"""
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', {created_at}, 'UTC')::date FROM conversations_unpartitioned")
+    ensure_partitions(cursor, [row[0] for row in cursor.fetchall()])
+    cursor.execute(f"""
+    INSERT INTO conversations (id, session_id, role, content, timestamp, read_by_teacher, created_at)
+    SELECT id, session_id, role, content, timestamp, read_by_teacher, {created_at} FROM conversations_unpartitioned
+    """)
+    cursor.execute("DROP TABLE conversations_unpartitioned")
+
+
+def archive_path(session_id: int, last_message_at: datetime) -> str:
+    return os.path.join(f"{last_message_at:%Y}", f"{last_message_at:%m}", f"session_{session_id}.jsonl.gz")
+
+
+def archive_file(path: str) -> str:
+    if not ARCHIVE_DIR:
+        raise RuntimeError("CONVERSATION_ARCHIVE_DIR is not set")
+    return os.path.join(ARCHIVE_DIR, path)
+
+
+def read_archive(path: str) -> List[dict]:
+    with gzip.open(archive_file(path), "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def write_archive(path: str, messages: List[dict]) -> int:
+    full_path = archive_file(path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    temp_path = full_path + ".tmp"
+    with open(temp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+            for message in messages:
+                f.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    # The file must be complete on disk before the rows it replaces are deleted
+    os.replace(temp_path, full_path)
+    return os.path.getsize(full_path)
+
+
+def remove_archive_file(path: str):
+    try:
+        os.remove(archive_file(path))
+    except FileNotFoundError:
+        pass
+
+
+def get_archived_messages(cursor, session_id: int) -> List[dict]:
+    messages = archive_cache.get(session_id)
+    if messages is None:
+        cursor.execute("SELECT path FROM archived_sessions WHERE session_id = %s", (session_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        messages = read_archive(row[0])
+        archive_cache.set(session_id, messages)
+    return messages
+
+
+def lock_archive_files(cursor, exclusive: bool = False):
+    # Transaction-level when shared; the exclusive one is session-level and released by the caller
+    if exclusive:
+        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (ARCHIVE_FILES_LOCK,))
+    else:
+        cursor.execute("SELECT pg_advisory_xact_lock_shared(hashtext(%s))", (ARCHIVE_FILES_LOCK,))
+
+
+def unlock_archive_files(cursor):
+    cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (ARCHIVE_FILES_LOCK,))
+
+
+def delete_archived(cursor, session_id: int) -> Optional[str]:
+    # Returns the file to remove once the caller has committed
+    cursor.execute("DELETE FROM archived_sessions WHERE session_id = %s RETURNING path", (session_id,))
+    row = cursor.fetchone()
+    archive_cache.invalidate(session_id)
+    return row[0] if row else None
+
+
+def export_archived(cursor, query: str, params: list, timestamp_from: Optional[str],
+                    timestamp_to: Optional[str]) -> Iterator[List[tuple]]:
+    # query selects (session_id, path, title, student_id, student_name, class, gvcn);
+    # yields one batch of export.EXPORT_COLUMNS rows per archived session
+    cursor.execute(query, params)
+    for session_id, path, *session in cursor.fetchall():
+        rows = [
+            (m["id"], session_id, *session, m["role"], m["content"], m["timestamp"], m["read_by_teacher"])
+            for m in read_archive(path)
+            if m["timestamp"] is not None
+            and (timestamp_from is None or m["timestamp"] >= timestamp_from)
+            and (timestamp_to is None or m["timestamp"] < timestamp_to)
+        ]
+        if rows:
+            yield rows
+
+
+def archive_session(conn, session_id: int, cutoff: datetime) -> Optional[dict]:
+    cursor = conn.cursor()
+    lock_archive_files(cursor)
+    # Serializes with restore_session() for the same session
+    cursor.execute("SELECT id FROM chat_sessions WHERE id = %s FOR UPDATE", (session_id,))
+    cursor.execute(f"SELECT {', '.join(MESSAGE_FIELDS)} FROM conversations WHERE session_id = %s ORDER BY id", (session_id,))
+    rows = cursor.fetchall()
+    if not rows or max(row[5] for row in rows) >= cutoff:
+        conn.rollback()
+        return None
+    messages = [dict(zip(MESSAGE_FIELDS, row[:5]), created_at=row[5].isoformat()) for row in rows]
+    cursor.execute("SELECT path FROM archived_sessions WHERE session_id = %s", (session_id,))
+    previous = cursor.fetchone()
+    if previous is not None:
+        # Rows written while the session was archived: fold them into one file
+        messages = read_archive(previous[0]) + messages
+    last_message_at = max(parse_timestamp(m["created_at"]) for m in messages)
+    path = archive_path(session_id, last_message_at)
+    size = write_archive(path, messages)
+    cursor.execute("""
+    INSERT INTO archived_sessions (session_id, path, message_count, last_message_at, bytes) VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (session_id) DO UPDATE SET path = EXCLUDED.path, message_count = EXCLUDED.message_count,
+        last_message_at = EXCLUDED.last_message_at, bytes = EXCLUDED.bytes, archived_at = now()
+    """, (session_id, path, len(messages), last_message_at, size))
+    # Only the rows that made it into the file
+    cursor.execute("DELETE FROM conversations WHERE session_id = %s AND id <= %s", (session_id, rows[-1][0]))
+    conn.commit()
+    if previous is not None and previous[0] != path:
+        remove_archive_file(previous[0])
+    archive_cache.invalidate(session_id)
+    return {"session_id": session_id, "messages": len(messages), "bytes": size}
+
+
+def is_archived(cursor, session_id: int) -> bool:
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM archived_sessions WHERE session_id = %s)", (session_id,))
+    return cursor.fetchone()[0]
+
+
+def create_restore_partitions(conn, messages: List[dict]) -> List[str]:
+    # Archived months usually had their partitions dropped once archiving emptied them. Put them back
+    # in a short transaction of their own; if conversations is busy the rows go to conversations_default
+    # instead, and ensure_partitions() moves them out whenever that month is created later.
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SET LOCAL lock_timeout = '{MAINTENANCE_LOCK_TIMEOUT}'")
+        created = ensure_partitions(cursor, (month_start(parse_timestamp(m["created_at"])) for m in messages))
+        conn.commit()
+        return created
+    except psycopg2.errors.LockNotAvailable:
+        conn.rollback()
+        return []
+
+
+def restore_session(conn, session_id: int) -> int:
+    # Brings an archived session back into the hot table before it gets new messages. Gunzips the file
+    # and COPYs the rows, so callers run it in a worker thread on a connection of its own.
+    cursor = conn.cursor()
+    cursor.execute("SELECT path FROM archived_sessions WHERE session_id = %s", (session_id,))
+    row = cursor.fetchone()
+    conn.rollback()
+    if row is None:
+        return 0
+    path, messages = row[0], read_archive(row[0])
+    create_restore_partitions(conn, messages)
+    lock_archive_files(cursor)
+    cursor.execute("SELECT id FROM chat_sessions WHERE id = %s FOR UPDATE", (session_id,))
+    cursor.execute("SELECT path FROM archived_sessions WHERE session_id = %s", (session_id,))
+    row = cursor.fetchone()
+    if row is None:
+        conn.commit()
+        return 0
+    if row[0] != path:
+        # Archived again in the meantime, with newer rows folded in: start over from the new file
+        conn.commit()
+        return restore_session(conn, session_id)
+    # Rows keep their original created_at, so ordering, analytics days and retention age are unchanged
+    copy_rows(cursor, "conversations", ["session_id"] + MESSAGE_FIELDS,
+              ([session_id] + [m[field] for field in MESSAGE_FIELDS] for m in messages))
+    cursor.execute("DELETE FROM archived_sessions WHERE session_id = %s", (session_id,))
+    conn.commit()
+    remove_archive_file(path)
+    archive_cache.invalidate(session_id)
+    return len(messages)
+
+
+def archive_idle_sessions(conn, cutoff: datetime, limit: int = ARCHIVE_BATCH_SESSIONS) -> List[dict]:
+    # Both halves are pruned to partitions on their side of the cutoff
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT DISTINCT c.session_id FROM conversations c
+    WHERE c.created_at < %(cutoff)s AND c.session_id IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM conversations n WHERE n.session_id = c.session_id AND n.created_at >= %(cutoff)s)
+    LIMIT %(limit)s
+    """, {"cutoff": cutoff, "limit": limit})
+    session_ids = [row[0] for row in cursor.fetchall()]
+    conn.rollback()
+    archived = []
+    for session_id in session_ids:
+        result = archive_session(conn, session_id, cutoff)
+        if result is not None:
+            archived.append(result)
+    return archived
+
+
+def apply_retention(conn, cutoff: datetime, limit: int = ARCHIVE_BATCH_SESSIONS) -> List[Tuple[int, int]]:
+    # Deletes archived sessions whose last message is older than the cutoff.
+    # Returns (session_id, student_id) pairs so callers can drop cached rows.
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT a.session_id, a.path, s.student_id FROM archived_sessions a
+    LEFT JOIN chat_sessions s ON s.id = a.session_id
+    WHERE a.last_message_at < %s ORDER BY a.last_message_at LIMIT %s
+    """, (cutoff, limit))
+    expired = cursor.fetchall()
+    if not expired:
+        conn.rollback()
+        return []
+    session_ids = [row[0] for row in expired]
+    lock_archive_files(cursor)
+    cursor.execute("DELETE FROM conversations WHERE session_id = ANY(%s)", (session_ids,))
+    cursor.execute("DELETE FROM analytics_pending_question WHERE session_id = ANY(%s)", (session_ids,))
+    cursor.execute("DELETE FROM archived_sessions WHERE session_id = ANY(%s)", (session_ids,))
+    cursor.execute("DELETE FROM chat_sessions WHERE id = ANY(%s)", (session_ids,))
+    conn.commit()
+    for session_id, path, _ in expired:
+        remove_archive_file(path)
+        archive_cache.invalidate(session_id)
+    return [(session_id, student_id) for session_id, _, student_id in expired]
+
+
+def list_partitions(cursor) -> List[Tuple[str, Optional[date]]]:
+    # (name, month) for every monthly partition; the default partition has no month
+    cursor.execute("""
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'conversations'::regclass ORDER BY c.relname
+    """)
+    partitions = []
+    for (name,) in cursor.fetchall():
+        month = None
+        if name.startswith("conversations_p"):
+            year, month_number = name[len("conversations_p"):].split("_")
+            month = date(int(year), int(month_number), 1)
+        partitions.append((name, month))
+    return partitions
+
+
+def drop_empty_partitions(conn, before: datetime) -> List[str]:
+    # Once archiving has emptied a month, its partition and indexes go away entirely
+    cursor = conn.cursor()
+    dropped = []
+    for name, month in list_partitions(cursor):
+        if month is None or add_months(month, 1) > before.date():
+            continue
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+        if cursor.fetchone()[0]:
+            continue
+        try:
+            cursor.execute(f"SET LOCAL lock_timeout = '{MAINTENANCE_LOCK_TIMEOUT}'")
+            cursor.execute(f"ALTER TABLE conversations DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+            conn.commit()
+            dropped.append(name)
+        except psycopg2.errors.LockNotAvailable:
+            # Someone is reading conversations; the rest can wait for the next run
+            conn.rollback()
+            print(f"Skipped dropping partition {name}: conversations is busy")
+            break
+    conn.rollback()
+    return dropped
+
+
+def archive_cutoff(now: Optional[datetime] = None) -> Optional[datetime]:
+    if ARCHIVE_AFTER_DAYS <= 0 or not ARCHIVE_DIR:
+        return None
+    return (now or datetime.now(timezone.utc)) - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+
+def manage_partitions(conn, now: Optional[datetime] = None) -> Dict[str, List[str]]:
+    # DDL takes an ACCESS EXCLUSIVE lock on conversations: run this on a connection of its
+    # own, once the server's shared connection has ended its open transaction
+    cursor = conn.cursor()
+    stats = {"created_partitions": [], "dropped_partitions": []}
+    try:
+        cursor.execute(f"SET LOCAL lock_timeout = '{MAINTENANCE_LOCK_TIMEOUT}'")
+        stats["created_partitions"] = ensure_partitions(cursor, upcoming_months(now))
+        conn.commit()
+    except psycopg2.errors.LockNotAvailable:
+        conn.rollback()
+        print("Skipped creating partitions: conversations is busy")
+        return stats
+    cutoff = archive_cutoff(now)
+    if cutoff is not None:
+        stats["dropped_partitions"] = drop_empty_partitions(conn, cutoff)
+    return stats
+
+
+def run_maintenance(conn, now: Optional[datetime] = None) -> Dict[str, object]:
+    # Row moves only (no DDL), safe to run on a separate connection in the background
+    now = now or datetime.now(timezone.utc)
+    stats = {"archived_sessions": 0, "archived_messages": 0, "expired_sessions": []}
+    cutoff = archive_cutoff(now)
+    if cutoff is not None:
+        # Batches keep each candidate scan short; keep going until the backlog is cleared
+        while True:
+            archived = archive_idle_sessions(conn, cutoff)
+            stats["archived_sessions"] += len(archived)
+            stats["archived_messages"] += sum(a["messages"] for a in archived)
+            if not archived:
+                break
+    if RETENTION_DAYS > 0:
+        while True:
+            expired = apply_retention(conn, now - timedelta(days=RETENTION_DAYS))
+            stats["expired_sessions"] += expired
+            if not expired:
+                break
+    return stats
+
+
+def iter_archived_rows(conn) -> Iterator[tuple]:
+    # (session_id, role, content, timestamp, class) for every archived message, session by session
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT a.session_id, a.path, st.class FROM archived_sessions a
+    JOIN chat_sessions s ON s.id = a.session_id
+    JOIN students st ON st.id = s.student_id
+    ORDER BY a.session_id
+    """)
+    for session_id, path, class_name in cursor.fetchall():
+        try:
+            messages = read_archive(path)
+        except FileNotFoundError:
+            # Session deleted since the caller's snapshot
+            continue
+        for message in messages:
+            yield session_id, message["role"], message["content"], message["timestamp"], class_name
+
+
+def archive_stats(cursor) -> dict:
+    partitions = []
+    for name, month in list_partitions(cursor):
+        cursor.execute("SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE relname = %s", (name,))
+        rows, size = cursor.fetchone()
+        partitions.append({"name": name, "month": month.isoformat() if month else None,
+                           "estimated_rows": max(rows, 0), "total_bytes": size})
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(bytes), 0) FROM archived_sessions")
+    sessions, messages, size = cursor.fetchone()
+    return {"partitions": partitions, "archived_sessions": sessions, "archived_messages": messages, "archive_bytes": size,
+            "archive_after_days": ARCHIVE_AFTER_DAYS, "retention_days": RETENTION_DAYS, "cache": archive_cache.stats()}
@@ -0,0 +1,346 @@
+import argparse
+import csv
+import io
+import os
+import secrets
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+import storage
+from analytics import ROLLUP_SCHEMA, rebuild_rollups
+from http_cache import parse_timestamp
+
+DEFAULT_BATCH_SIZE = 5000
+
+# Bookkeeping for resumable imports. Each batch commits its rows, its id mappings
+# and its progress mark together, so an interrupted run continues where it stopped.
+IMPORT_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS import_id_map (
+        source TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        old_id INTEGER NOT NULL,
+        new_id INTEGER NOT NULL,
+        PRIMARY KEY (source, table_name, old_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS import_progress (
+        source TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        last_old_id INTEGER NOT NULL,
+        PRIMARY KEY (source, table_name)
+    )
+    """,
+]
+
+
+def insert_students(cursor, students: Sequence[Tuple[str, str, str, str, str]]) -> Dict[str, int]:
+    # One multi-row INSERT per call. Usernames that are already registered are
+    # left untouched and simply missing from the returned {username: id} map.
+    if not students:
+        return {}
+    rows = execute_values(
+        cursor,
+        "INSERT INTO students (username, name, class, gvcn, password) VALUES %s "
+        "ON CONFLICT (username) DO NOTHING RETURNING username, id",
+        students,
+        page_size=len(students),
+        fetch=True,
+    )
+    return dict(rows)
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_rows(cursor, table: str, columns: Sequence[str], rows: Iterable[Sequence]):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(v) for v in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def allocate_ids(cursor, table: str, count: int) -> List[int]:
+    # Taking ids from the table's own sequence lets COPY write explicit ids
+    # and gives an exact old -> new mapping without a RETURNING round trip
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", (table, count))
+    return [row[0] for row in cursor.fetchall()]
+
+
+class Importer:
+    def __init__(self, conn, source: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                 default_password: Optional[str] = None, resumable: bool = True):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.source = source
+        self.batch_size = batch_size
+        self.default_password = default_password
+        self.resumable = resumable
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.elapsed: Dict[str, float] = {}
+        for statement in IMPORT_TABLES:
+            self.cursor.execute(statement)
+        self.conn.commit()
+
+    def _stat(self, table: str, key: str, amount: int = 1):
+        self.stats.setdefault(table, {"read": 0, "inserted": 0, "existing": 0, "skipped": 0, "generated_passwords": 0})
+        self.stats[table][key] += amount
+
+    def _password(self, password: Optional[str]) -> str:
+        if password:
+            return password
+        if self.default_password:
+            return self.default_password
+        # chat.py never stored passwords; these accounts need a reset before they can log in
+        return secrets.token_urlsafe(12)
+
+    def load_id_map(self, table: str) -> Dict[int, int]:
+        self.cursor.execute("SELECT old_id, new_id FROM import_id_map WHERE source = %s AND table_name = %s",
+                            (self.source, table))
+        return dict(self.cursor.fetchall())
+
+    def last_old_id(self, table: str) -> int:
+        self.cursor.execute("SELECT last_old_id FROM import_progress WHERE source = %s AND table_name = %s",
+                            (self.source, table))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def _finish_batch(self, table: str, last_old_id: int, id_map: Sequence[Tuple[int, int]] = ()):
+        if not self.resumable:
+            self.conn.commit()
+            return
+        if id_map:
+            copy_rows(self.cursor, "import_id_map", ("source", "table_name", "old_id", "new_id"),
+                      ((self.source, table, old_id, new_id) for old_id, new_id in id_map))
+        self.cursor.execute("""
+        INSERT INTO import_progress (source, table_name, last_old_id) VALUES (%s, %s, %s)
+        ON CONFLICT (source, table_name) DO UPDATE SET last_old_id = EXCLUDED.last_old_id
+        """, (self.source, table, last_old_id))
+        self.conn.commit()
+
+    def import_students(self, batches: Iterator[List[tuple]]) -> Dict[int, int]:
+        # Rows: (old_id, username, name, class, gvcn, password). Students are matched
+        # by username, so someone who already registered keeps their account.
+        student_map = self.load_id_map("students")
+        started = time.perf_counter()
+        for batch in batches:
+            self._stat("students", "read", len(batch))
+            rows = []
+            for old_id, username, name, class_name, gvcn, password in batch:
+                if not username:
+                    # Legacy rows without a phone number cannot log in; keep them reachable by id
+                    username = f"{self.source}:{old_id}"
+                if not password and not self.default_password:
+                    self._stat("students", "generated_passwords")
+                rows.append((old_id, username, name, class_name, gvcn, self._password(password)))
+            # Later rows win when a username repeats inside one batch
+            by_username = {row[1]: row for row in rows}
+            inserted = insert_students(self.cursor, [row[1:] for row in by_username.values()])
+            missing = [username for username in {row[1] for row in rows} if username not in inserted]
+            existing = {}
+            if missing:
+                self.cursor.execute("SELECT username, id FROM students WHERE username = ANY(%s)", (missing,))
+                existing = dict(self.cursor.fetchall())
+            mapping = [(row[0], inserted.get(row[1], existing.get(row[1]))) for row in rows]
+            self._finish_batch("students", batch[-1][0], mapping)
+            student_map.update(mapping)
+            self._stat("students", "inserted", len(inserted))
+            self._stat("students", "existing", len(rows) - len(inserted))
+        self.elapsed["students"] = time.perf_counter() - started
+        return student_map
+
+    def import_sessions(self, batches: Iterator[List[tuple]], student_map: Dict[int, int]) -> Dict[int, int]:
+        # Rows: (old_id, student_id, title, created_at)
+        session_map = self.load_id_map("chat_sessions")
+        started = time.perf_counter()
+        for batch in batches:
+            self._stat("chat_sessions", "read", len(batch))
+            rows = [row for row in batch if student_map.get(row[1]) is not None]
+            self._stat("chat_sessions", "skipped", len(batch) - len(rows))
+            new_ids = allocate_ids(self.cursor, "chat_sessions", len(rows)) if rows else []
+            copy_rows(self.cursor, "chat_sessions", ("id", "student_id", "title", "created_at"),
+                      ((new_id, student_map[student_id], title, created_at)
+                       for new_id, (_, student_id, title, created_at) in zip(new_ids, rows)))
+            mapping = [(row[0], new_id) for row, new_id in zip(rows, new_ids)]
+            self._finish_batch("chat_sessions", batch[-1][0], mapping)
+            session_map.update(mapping)
+            self._stat("chat_sessions", "inserted", len(rows))
+        self.elapsed["chat_sessions"] = time.perf_counter() - started
+        return session_map
+
+    def import_conversations(self, batches: Iterator[List[tuple]], session_map: Dict[int, int]):
+        # Rows: (old_id, session_id, role, content, timestamp, read_by_teacher).
+        # Messages are only tracked by the progress mark; nothing references their ids.
+        # Imported here: archive builds on copy_rows() from this module
+        from archive import ensure_partitions, month_start
+        started = time.perf_counter()
+        imported_at = datetime.now(timezone.utc)
+        for batch in batches:
+            self._stat("conversations", "read", len(batch))
+            rows = [row for row in batch if session_map.get(row[1]) is not None]
+            self._stat("conversations", "skipped", len(batch) - len(rows))
+            # Old messages go to the partition of the month they were sent, not the import date
+            created = [parse_timestamp(row[4]) or imported_at for row in rows]
+            ensure_partitions(self.cursor, (month_start(c) for c in created))
+            copy_rows(self.cursor, "conversations",
+                      ("session_id", "role", "content", "timestamp", "read_by_teacher", "created_at"),
+                      ((session_map[session_id], role, content, timestamp, read_by_teacher or 0, created_at.isoformat())
+                       for (_, session_id, role, content, timestamp, read_by_teacher), created_at in zip(rows, created)))
+            self._finish_batch("conversations", batch[-1][0])
+            self._stat("conversations", "inserted", len(rows))
+        self.elapsed["conversations"] = time.perf_counter() - started
+
+
+def sqlite_batches(source: sqlite3.Connection, query: str, after_id: int, batch_size: int) -> Iterator[List[tuple]]:
+    # Keyset pagination: the query must select the id first and filter "id > ?"
+    while True:
+        batch = source.execute(query + " ORDER BY id LIMIT ?", (after_id, batch_size)).fetchall()
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1][0]
+
+
+def csv_batches(path: str, batch_size: int, class_name: Optional[str], gvcn: Optional[str]) -> Iterator[List[tuple]]:
+    # Roster columns: username (phone), name, class, gvcn, password. class/gvcn may be
+    # left out when given on the command line; the line number stands in for an id.
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        batch = []
+        for line_no, row in enumerate(csv.DictReader(f), start=2):
+            username = (row.get("username") or row.get("phone") or "").strip()
+            if not username:
+                print(f"{path}:{line_no}: skipped, no username")
+                continue
+            batch.append((line_no, username, (row.get("name") or "").strip(),
+                          (row.get("class") or class_name or "").strip(),
+                          (row.get("gvcn") or gvcn or "").strip(), (row.get("password") or "").strip() or None))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def table_columns(source: sqlite3.Connection, table: str) -> List[str]:
+    return [info[1] for info in source.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def open_source(path: str, workdir: str) -> sqlite3.Connection:
+    # The source is only ever read: a database chat.py still uses must not be changed by an import
+    source = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+    columns = table_columns(source, "conversations")
+    if "session_id" in columns and "read_by_teacher" in columns:
+        return source
+    # Pre-session databases: run the same migration chat.py runs at startup, on a copy. The
+    # migration adds the sessions in the same order each time, so a resumed import still lines up.
+    print(f"Migrating legacy schema of {path} in a temporary copy")
+    copy_path = os.path.join(workdir, "source.db")
+    copy = sqlite3.connect(copy_path)
+    source.backup(copy)
+    source.close()
+    copy.close()
+    storage.init_db(storage.ConnectionPool(copy_path, 1))
+    return sqlite3.connect(copy_path)
+
+
+def import_sqlite(importer: Importer, path: str):
+    with tempfile.TemporaryDirectory() as workdir:
+        source = open_source(path, workdir)
+        try:
+            import_source(importer, source)
+        finally:
+            source.close()
+
+
+def import_source(importer: Importer, source: sqlite3.Connection):
+    # chat.py's own schema has no password column
+    password_column = "password" if "password" in table_columns(source, "students") else "NULL"
+    batch_size = importer.batch_size
+
+    student_map = importer.import_students(sqlite_batches(
+        source, f"SELECT id, username, name, class, gvcn, {password_column} FROM students WHERE id > ?",
+        importer.last_old_id("students"), batch_size))
+    session_map = importer.import_sessions(sqlite_batches(
+        source, "SELECT id, student_id, title, created_at FROM chat_sessions WHERE id > ?",
+        importer.last_old_id("chat_sessions"), batch_size), student_map)
+    importer.import_conversations(sqlite_batches(
+        source, "SELECT id, session_id, role, content, timestamp, read_by_teacher FROM conversations WHERE id > ?",
+        importer.last_old_id("conversations"), batch_size), session_map)
+
+
+def connect():
+    load_dotenv()
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST"),
+        port=os.environ.get("DB_PORT", "5432"),
+        dbname=os.environ.get("DB_NAME"),
+        user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASSWORD")
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import chat.py SQLite data and CSV rosters into the chat_server.py Postgres database.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--default-password", help="password for imported students that have none (random if omitted)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sqlite_parser = subparsers.add_parser("sqlite", help="import students, chat sessions and messages from a chat.py database")
+    sqlite_parser.add_argument("path", nargs="?", default=storage.DEFAULT_DB_PATH)
+    sqlite_parser.add_argument("--source", help="name used to resume this import (default: file name)")
+
+    roster_parser = subparsers.add_parser("roster", help="import students from CSV rosters")
+    roster_parser.add_argument("paths", nargs="+")
+    roster_parser.add_argument("--class-name", help="class for rows without a class column")
+    roster_parser.add_argument("--gvcn", help="homeroom teacher for rows without a gvcn column")
+
+    args = parser.parse_args(argv)
+    conn = connect()
+    started = time.perf_counter()
+    if args.command == "sqlite":
+        importer = Importer(conn, args.source or os.path.basename(args.path), args.batch_size, args.default_password)
+        import_sqlite(importer, args.path)
+        importers = [importer]
+        if importer.stats.get("conversations", {}).get("inserted"):
+            # COPY bypasses record_message(), so rebuild the /analytics rollups once at the end
+            cursor = conn.cursor()
+            for statement in ROLLUP_SCHEMA:
+                cursor.execute(statement)
+            print("Rebuilding analytics rollups: " + ", ".join(f"{k}={v}" for k, v in rebuild_rollups(conn, connect).items()))
+    else:
+        importers = []
+        for path in args.paths:
+            # Rosters are not resumable by line: re-running only skips usernames that exist
+            importer = Importer(conn, f"roster:{os.path.basename(path)}", args.batch_size, args.default_password,
+                                resumable=False)
+            importer.import_students(csv_batches(path, args.batch_size, args.class_name, args.gvcn))
+            importers.append(importer)
+    elapsed = time.perf_counter() - started
+    conn.close()
+
+    for importer in importers:
+        for table, counts in importer.stats.items():
+            seconds = importer.elapsed.get(table, 0)
+            rate = counts["read"] / seconds if seconds else 0
+            print(f"{importer.source} {table}: " + ", ".join(f"{k}={v}" for k, v in counts.items())
+                  + f" in {seconds:.2f}s ({rate:,.0f} rows/s)")
+    print(f"Finished in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,93 @@
 import streamlit as st
-from groq import Groq
-import sqlite3
 from datetime import datetime
 import pandas as pd
 import time
+from search import InvertedIndex, highlight
+import storage
+from api_client import DEFAULT_API_URL, ApiClient, ApiError, ApiSession, register_student
+from fallback_answers import load_engine, split_chunks
+from llm_providers import NoProviderAvailable, load_pool
+from model_router import load_router
+from usage import BUDGET_BLOCKED_MESSAGE, BudgetExceeded, load_tracker, usage_day
+import atexit
 
-# 🔑 Khởi tạo client Groq
 import os
 from dotenv import load_dotenv
-load_dotenv()
-client = Groq(api_key=os.environ["OPENAI_API_KEY"])
-
-# Kết nối SQLite database
-conn = sqlite3.connect('student_management.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# Tạo bảng nếu chưa tồn tại
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS students (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE,
-    name TEXT,
-    class TEXT,
-    gvcn TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS chat_sessions (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER,
-    title TEXT,
-    created_at TEXT,
-    FOREIGN KEY (student_id) REFERENCES students(id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS conversations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    session_id INTEGER,
-    role TEXT,
-    content TEXT,
-    timestamp TEXT,
-    read_by_teacher INTEGER DEFAULT 0,
-    FOREIGN KEY (session_id) REFERENCES chat_sessions(id)
-)
-''')
-conn.commit()
-
-# Migration for old database schema
-cursor.execute("PRAGMA table_info(conversations)")
-column_info = cursor.fetchall()
-columns = [info[1] for info in column_info]
-
-if 'session_id' not in columns:
-    cursor.execute("ALTER TABLE conversations ADD COLUMN session_id INTEGER")
-    conn.commit()
-
-    if 'student_id' in columns:
-        cursor.execute("SELECT DISTINCT student_id FROM conversations")
-        unique_students = cursor.fetchall()
-        if unique_students:
-            session_map = {}
-            for (sid,) in unique_students:
-                timestamp = datetime.now()
-                title = f"Legacy Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
-                cursor.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)", (sid, title, timestamp.isoformat()))
-                conn.commit()
-                session_map[sid] = cursor.lastrowid
-            for sid, session_id in session_map.items():
-                cursor.execute("UPDATE conversations SET session_id = ? WHERE student_id = ?", (session_id, sid))
-                conn.commit()
-
-if 'read_by_teacher' not in columns:
-    cursor.execute("ALTER TABLE conversations ADD COLUMN read_by_teacher INTEGER DEFAULT 0")
-    conn.commit()
+
+# Đo thời gian mỗi lần Streamlit chạy lại script (bật bằng CHAT_DEBUG_TIMING=1)
+RERUN_STARTED = time.perf_counter()
+
+# Đọc .env một lần cho cả tiến trình.
+# CHAT_BACKEND=api: giao diện chỉ gọi chat_server.py (CHAT_API_URL), không mở DB hay client LLM
+@st.cache_resource(show_spinner=False)
+def load_environment():
+    load_dotenv()
+    return os.environ.get("CHAT_BACKEND", "sqlite")
+
+# 🔑 Khởi tạo các nhà cung cấp LLM (llm_providers.json) một lần cho cả tiến trình:
+# timeout token đầu, tự chuyển nhà cung cấp dự phòng và ngắt mạch khi upstream lỗi
+@st.cache_resource(show_spinner=False)
+def get_client():
+    return load_pool()
+
+# Sổ tay an toàn thông tin (scam_safety_kb.json): trả lời tại chỗ khi không gọi được nhà cung cấp LLM nào
+@st.cache_resource(show_spinner=False)
+def get_fallback():
+    return load_engine()
+
+# Bộ định tuyến mô hình (model_routes.json): câu hỏi ngắn, đơn giản dùng mô hình nhanh hơn.
+# Dùng chung cho cả tiến trình để thống kê độ trễ/chất lượng gộp mọi phiên
+@st.cache_resource(show_spinner=False)
+def get_router():
+    return load_router()
+
+# Một client HTTP keep-alive dùng chung cho mọi phiên Streamlit
+@st.cache_resource(show_spinner=False)
+def get_api_client():
+    return ApiClient(os.environ.get("CHAT_API_URL", DEFAULT_API_URL))
+
+# Tạo bảng, migration và index SQLite chỉ chạy một lần cho cả tiến trình
+@st.cache_resource(show_spinner=False)
+def bootstrap_storage():
+    storage.init_db()
+    return True
+
+# Đếm token mỗi lần gọi AI theo lớp/học sinh/ngày, ghi xuống SQLite theo lô (không ghi mỗi lần gọi).
+# Hạn mức ngày trong usage_budgets.json; nạp lại lượng đã dùng hôm nay để khởi động lại không xoá hạn mức
+@st.cache_resource(show_spinner=False)
+def get_usage_tracker():
+    tracker = load_tracker()
+    tracker.seed(storage.fetch_all("""
+    SELECT day, class, student_id, SUM(prompt_tokens + completion_tokens)
+    FROM token_usage WHERE day = ? GROUP BY day, class, student_id
+    """, (usage_day().isoformat(),)))
+    # Ghi nốt phần còn trong bộ nhớ khi tiến trình dừng
+    atexit.register(flush_usage)
+    return tracker
+
+def flush_usage():
+    rows = usage_tracker.drain()
+    if not rows:
+        return
+    try:
+        storage.record_token_usage(rows)
+    except Exception as e:
+        usage_tracker.restore(rows)
+        print(f"Lỗi ghi token_usage, giữ {len(rows)} dòng cho lần sau: {str(e)}")
+        return
+    usage_tracker.flushed(len(rows))
+
+USE_API = load_environment() == "api"
+if USE_API:
+    client = None
+    api_client = get_api_client()
+else:
+    client = get_client()
+    fallback = get_fallback()
+    router = get_router()
+    bootstrap_storage()
+    usage_tracker = get_usage_tracker()
+SHOW_RERUN_TIMING = os.environ.get("CHAT_DEBUG_TIMING") == "1"
 
 # Cấu hình giao diện
 st.set_page_config(page_title="Chatbot Cô Hương", page_icon="👩‍🏫", layout="wide")
@@ -87,14 +99,172 @@ mode = st.sidebar.selectbox("Chọn chế độ", ["Học sinh", "Giáo viên"])
 if "ai_enabled" not in st.session_state:
     st.session_state["ai_enabled"] = True
 
+# Phiên đăng nhập với chat_server.py của người dùng hiện tại (chế độ api), tách riêng học sinh và giáo viên
+def api_session_key():
+    return "teacher_api_session" if mode == "Giáo viên" else "student_api_session"
+
+def api_session() -> ApiSession:
+    return st.session_state[api_session_key()]
+
+# Cache dữ liệu đọc nhiều; xóa cache tương ứng ngay sau mỗi lần ghi.
+# Chế độ api không dùng cache này: server trả 304 khi dữ liệu không đổi
+CACHE_TTL_SECONDS = 300
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_student_info(student_id):
+    return storage.fetch_one("SELECT name, class, gvcn FROM students WHERE id = ?", (student_id,))
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_student_sessions(student_id):
+    return storage.fetch_all("SELECT id, title FROM chat_sessions WHERE student_id = ? ORDER BY created_at DESC",
+                             (student_id,))
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_session_title(session_id):
+    result = storage.fetch_one("SELECT title FROM chat_sessions WHERE id = ?", (session_id,))
+    return result[0] if result else None
+
+def get_student_info(student_id):
+    if USE_API:
+        student = api_session().get_student(student_id)
+        return (student["name"], student["class"], student["gvcn"]) if student else None
+    return load_student_info(student_id)
+
+def get_student_sessions(student_id):
+    if USE_API:
+        return [(s["id"], s["title"]) for s in api_session().get_sessions(student_id)]
+    return load_student_sessions(student_id)
+
+def get_session_title(student_id, session_id):
+    if USE_API:
+        return next((title for id, title in get_student_sessions(student_id) if id == session_id), None)
+    return load_session_title(session_id)
+
+def create_chat_session(student_id):
+    timestamp = datetime.now()
+    title = f"Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
+    if USE_API:
+        return api_session().create_session(student_id, title)
+    session_id = storage.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
+                                 (student_id, title, timestamp.isoformat()))
+    load_student_sessions.clear()
+    return session_id
+
+def save_message(session_id, role, content, read_by_teacher):
+    if USE_API:
+        # Server tự đặt read_by_teacher theo role và báo cho giáo viên qua websocket
+        api_session().add_message(session_id, role, content)
+        mark_feed_stale(session_id)
+        return
+    storage.execute("INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, role, content, datetime.now().isoformat(), read_by_teacher))
+    router.note_message(session_id, role)
+
+# Stream câu trả lời AI: trực tiếp từ nhà cung cấp LLM, hoặc qua SSE /chatbot ở chế độ api
+def stream_reply(session_id, messages, student_id=None, class_name=None):
+    if USE_API:
+        try:
+            yield from api_session().stream_chat(session_id, messages, st.session_state["ai_enabled"])
+        except ApiError as e:
+            if e.status_code in (413, 429):
+                raise BudgetExceeded(e.detail)
+            raise
+        return
+    # Vượt hạn mức mềm: trả lời ngắn hơn; vượt hạn mức cứng: dùng thêm tuyến rẻ hơn (hoặc chặn)
+    budget = usage_tracker.check(class_name, student_id)
+    if budget.level == "blocked":
+        raise BudgetExceeded(BUDGET_BLOCKED_MESSAGE)
+    route, args = usage_tracker.apply(budget, router.choose(messages), router)
+    # Ước lượng prompt trước khi gọi: quá dài thì bỏ bớt lượt cũ hoặc từ chối, số token được giữ chỗ đến khi ghi usage
+    messages, args, reservation = usage_tracker.admit(class_name, student_id, messages, args)
+    route_call = router.start(route, session_id)
+    # Không có nhà cung cấp hoặc đang quá nhiều lượt chờ upstream: trả lời từ sổ tay luôn
+    fallback_reason = fallback.reason(client)
+    finish_reason = None
+    usage = None
+    reply = ""
+    try:
+        if fallback_reason is None:
+            try:
+                for chunk in client.stream_chat_sync(messages, args):
+                    finish_reason = chunk.finish_reason or finish_reason
+                    usage = chunk.usage or usage
+                    if chunk.content:
+                        reply += chunk.content
+                        route_call.add_output(chunk.content)
+                        yield chunk.content
+                route_call.finish(finish_reason)
+            except NoProviderAvailable:
+                # Lỗi trước token đầu tiên nên học sinh chưa thấy gì: chuyển sang sổ tay
+                route_call.fail()
+                if not fallback.enabled:
+                    raise
+                fallback_reason = "upstream_unavailable"
+        if fallback_reason is not None:
+            yield from split_chunks(fallback.answer(messages, fallback_reason).text)
+    except Exception:
+        if fallback_reason is None:
+            route_call.fail()
+        raise
+    finally:
+        if fallback_reason is None and (reply or usage):
+            usage_tracker.record(class_name, student_id, session_id, args["model"], messages, reply, usage)
+            if usage_tracker.due():
+                flush_usage()
+        reservation.release()
+
+# Tự động làm mới phần chat và danh sách học sinh mà không chạy lại cả trang
+CHAT_REFRESH_SECONDS = int(os.environ.get("CHAT_REFRESH_SECONDS", "3"))
+STUDENT_LIST_REFRESH_SECONDS = int(os.environ.get("STUDENT_LIST_REFRESH_SECONDS", "5"))
+# Chế độ api: khi websocket đang nối chỉ tải lại lúc có thông báo, thêm một lần kiểm tra định kỳ cho chắc
+PUSH_FALLBACK_SECONDS = int(os.environ.get("CHAT_PUSH_FALLBACK_SECONDS", "30"))
+
+def api_change_key(channel, session_id=None):
+    version = channel.version_for(session_id) if channel is not None else None
+    if version is None:
+        # Mất kết nối websocket: hỏi server ở mỗi lần làm mới (rẻ nhờ ETag)
+        return ("poll", time.monotonic())
+    return (version, int(time.monotonic() // PUSH_FALLBACK_SECONDS))
+
+def mark_feed_stale(session_id):
+    feed = st.session_state.get("chat_feeds", {}).get(session_id)
+    if feed is not None:
+        feed["key"] = None
+
 # Hàm để hiển thị chat messages từ DB
-def display_chat_messages(session_id, title):
+def display_chat_messages(session_id, title, mark_read=False):
     st.title(title)
-    cursor.execute("SELECT role, content, timestamp FROM conversations WHERE session_id = ? ORDER BY timestamp",
-                   (session_id,))
-    messages = cursor.fetchall()
-    for msg in messages:
-        role, content, _ = msg
+    chat_feed(session_id, mark_read)
+
+def load_feed_api(feed, session_id, mark_read):
+    api = api_session()
+    key = api_change_key(api.push_channel(session_id), session_id)
+    if feed.get("key") == key:
+        return
+    messages = api.get_conversations(session_id)
+    new_messages = messages[len(feed["messages"]):]
+    feed["messages"] = [(m["role"], m["content"]) for m in messages]
+    feed["key"] = key
+    if mark_read and any(m["role"] == "user" for m in new_messages):
+        api.mark_read(session_id)
+        st.session_state.pop("student_list_key", None)
+
+# Mỗi lần làm mới chỉ lấy các tin nhắn có id lớn hơn tin cuối đã hiển thị
+@st.fragment(run_every=CHAT_REFRESH_SECONDS)
+def chat_feed(session_id, mark_read):
+    feeds = st.session_state.setdefault("chat_feeds", {})
+    feed = feeds.setdefault(session_id, {"last_id": 0, "messages": []})
+    if USE_API:
+        load_feed_api(feed, session_id, mark_read)
+    else:
+        new_rows = storage.fetch_all("SELECT id, role, content FROM conversations WHERE session_id = ? AND id > ? ORDER BY id",
+                                     (session_id, feed["last_id"]))
+        if new_rows:
+            feed["messages"].extend((role, content) for _, role, content in new_rows)
+            feed["last_id"] = new_rows[-1][0]
+            if mark_read and any(role == "user" for _, role, _ in new_rows):
+                storage.execute("UPDATE conversations SET read_by_teacher = 1 WHERE session_id = ? AND role = 'user' AND read_by_teacher = 0", (session_id,))
+    for role, content in feed["messages"]:
         if role == "user":
             st.chat_message("user").write(f"👦 **Học sinh**: {content}")
         elif role == "assistant":
@@ -104,33 +274,202 @@ def display_chat_messages(session_id, title):
 
 # Hàm lấy thời gian tin nhắn cuối cùng
 def get_last_message_time(student_id):
-    cursor.execute("""
+    if USE_API:
+        return api_session().get_last_message_time(student_id)
+    result = storage.fetch_one("""
     SELECT MAX(timestamp) FROM conversations 
     WHERE session_id IN (SELECT id FROM chat_sessions WHERE student_id = ?) 
     AND role = 'user'
-    """, (student_id,))
-    result = cursor.fetchone()[0]
+    """, (student_id,))[0]
     return result if result else "N/A"
 
 # Hàm lấy trạng thái chưa đọc
 def get_unread_status(student_id):
-    cursor.execute("""
+    if USE_API:
+        return "Chưa đọc" if api_session().get_unread(student_id) else "Đã đọc"
+    count = storage.fetch_one("""
     SELECT COUNT(*) FROM conversations 
     WHERE session_id IN (SELECT id FROM chat_sessions WHERE student_id = ?) 
     AND role = 'user' AND read_by_teacher = 0
-    """, (student_id,))
-    count = cursor.fetchone()[0]
+    """, (student_id,))[0]
     return "Chưa đọc" if count > 0 else "Đã đọc"
 
 # Hàm lấy session mới nhất
 def get_latest_session(student_id):
-    cursor.execute("""
+    if USE_API:
+        return api_session().get_latest_session(student_id)
+    result = storage.fetch_one("""
     SELECT id FROM chat_sessions WHERE student_id = ? 
     ORDER BY created_at DESC LIMIT 1
     """, (student_id,))
-    result = cursor.fetchone()
     return result[0] if result else None
 
+# Danh sách học sinh chỉ truy vấn lại khi bộ đếm thay đổi (có tin nhắn mới, đã đọc, học sinh mới)
+@st.fragment(run_every=STUDENT_LIST_REFRESH_SECONDS)
+def student_list(filter_name, filter_class, filter_gvcn):
+    if USE_API:
+        change_key = api_change_key(api_session().push_channel())
+    else:
+        change_key = storage.get_change_counter("student_list")
+    list_key = (change_key, filter_name, filter_class, filter_gvcn)
+    if st.session_state.get("student_list_key") != list_key:
+        st.session_state["student_list_rows"] = load_student_rows(filter_name, filter_class, filter_gvcn)
+        st.session_state["student_list_key"] = list_key
+
+    filtered_students = st.session_state["student_list_rows"]
+    if filtered_students:
+        # Hiển thị header
+        col1, col2, col3, col4, col5, col6, col7 = st.columns([1, 2, 1, 2, 2, 1, 1])
+        col1.write("ID")
+        col2.write("Tên")
+        col3.write("Lớp")
+        col4.write("GVCN")
+        col5.write("Tin nhắn cuối")
+        col6.write("Trạng thái")
+        col7.write("Hành động")
+
+        for student_id, name, class_name, gvcn, last_time, status in filtered_students:
+            col1, col2, col3, col4, col5, col6, col7 = st.columns([1, 2, 1, 2, 2, 1, 1])
+            col1.write(student_id)
+            col2.write(name)
+            col3.write(class_name)
+            col4.write(gvcn)
+            col5.write(last_time)
+            col6.write(status)
+            if col7.button("Trả lời", key=f"reply_{student_id}"):
+                st.session_state["selected_student_id"] = student_id
+                latest_session = get_latest_session(student_id)
+                if latest_session:
+                    st.session_state["current_session_id"] = latest_session
+                    st.session_state["teacher_view"] = "chat"
+                else:
+                    st.session_state["current_session_id"] = create_chat_session(student_id)
+                    st.session_state["teacher_view"] = "chat"
+                st.rerun()
+    else:
+        st.info("Chưa có học sinh nào.")
+
+def load_student_rows(filter_name, filter_class, filter_gvcn):
+    if USE_API:
+        api = api_session()
+        students = [
+            s for s in api.get_students()
+            if (not filter_name or filter_name.lower() in (s["name"] or "").lower())
+            and (not filter_class or filter_class.lower() in (s["class"] or "").lower())
+            and (not filter_gvcn or filter_gvcn.lower() in (s["gvcn"] or "").lower())
+        ]
+        # Gọi song song trên các kết nối keep-alive thay vì lần lượt từng học sinh
+        details = api.client.map(lambda s: (api.get_last_message_time(s["id"]), api.get_unread(s["id"])), students)
+        return [
+            (s["id"], s["name"], s["class"], s["gvcn"], last_time, "Chưa đọc" if unread else "Đã đọc")
+            for s, (last_time, unread) in zip(students, details)
+        ]
+
+    query = "SELECT id, name, class, gvcn FROM students WHERE 1=1"
+    params = []
+    if filter_name:
+        query += " AND name LIKE ?"
+        params.append(f"%{filter_name}%")
+    if filter_class:
+        query += " AND class LIKE ?"
+        params.append(f"%{filter_class}%")
+    if filter_gvcn:
+        query += " AND gvcn LIKE ?"
+        params.append(f"%{filter_gvcn}%")
+    return [
+        (student_id, name, class_name, gvcn, get_last_message_time(student_id), get_unread_status(student_id))
+        for student_id, name, class_name, gvcn in storage.fetch_all(query, params)
+    ]
+
+# Chỉ mục tìm kiếm tin nhắn, dùng chung cho mọi phiên Streamlit
+SEARCH_PAGE_SIZE = 20
+SEARCH_LOAD_BATCH = 5000
+
+@st.cache_resource
+def get_search_index():
+    return InvertedIndex()
+
+def refresh_search_index(index):
+    # Chỉ nạp các tin nhắn mới hơn tin nhắn cuối cùng đã có trong chỉ mục
+    while True:
+        rows = storage.fetch_all("""
+        SELECT c.id, c.content, c.session_id, c.role, c.timestamp, s.student_id, st.class
+        FROM conversations c
+        JOIN chat_sessions s ON s.id = c.session_id
+        JOIN students st ON st.id = s.student_id
+        WHERE c.id > ? ORDER BY c.id LIMIT ?
+        """, (index.last_id, SEARCH_LOAD_BATCH))
+        for msg_id, content, session_id, role, timestamp, student_id, class_name in rows:
+            index.add(msg_id, content or "", (session_id, role, timestamp or "", student_id, class_name or ""))
+        if len(rows) < SEARCH_LOAD_BATCH:
+            break
+
+def search_messages(query, class_filter, date_from, date_to, before_id):
+    if USE_API:
+        found = api_session().search(query, class_filter, date_from, date_to, before_id, SEARCH_PAGE_SIZE)
+        rows = [
+            (r["id"], r["snippet"].replace("<mark>", "**").replace("</mark>", "**"), r["session_id"],
+             r["timestamp"] or "", r["student_id"], r["student_name"], r["class"])
+            for r in found["results"]
+        ]
+        return rows, found["next_before_id"]
+
+    index = get_search_index()
+    refresh_search_index(index)
+
+    def match(meta):
+        _, _, timestamp, _, class_name = meta
+        if class_filter and class_filter.lower() not in class_name.lower():
+            return False
+        if date_from and timestamp[:10] < date_from.isoformat():
+            return False
+        if date_to and timestamp[:10] > date_to.isoformat():
+            return False
+        return True
+
+    ids, next_before_id = index.search(query, match, before_id, SEARCH_PAGE_SIZE)
+    if not ids:
+        return [], None
+    rows = storage.fetch_all(f"""
+    SELECT c.id, c.content, c.session_id, c.timestamp, st.id, st.name, st.class
+    FROM conversations c
+    JOIN chat_sessions s ON s.id = c.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE c.id IN ({",".join("?" * len(ids))})
+    ORDER BY c.id DESC
+    """, ids)
+    return [(msg_id, highlight(content, query, '**', '**'), session_id, timestamp, student_id, name, class_name)
+            for msg_id, content, session_id, timestamp, student_id, name, class_name in rows], next_before_id
+
+def display_search(query, class_filter, date_from, date_to):
+    # Phân trang theo id: mỗi trang lưu id bắt đầu để quay lại trang trước
+    search_key = (query, class_filter, date_from, date_to)
+    if st.session_state.get("search_key") != search_key:
+        st.session_state["search_key"] = search_key
+        st.session_state["search_pages"] = [None]
+    pages = st.session_state["search_pages"]
+    rows, next_before_id = search_messages(query, class_filter, date_from, date_to, pages[-1])
+    if not rows:
+        st.info("Không tìm thấy tin nhắn phù hợp.")
+        return
+
+    for msg_id, snippet, session_id, timestamp, student_id, name, class_name in rows:
+        col_text, col_action = st.columns([6, 1])
+        col_text.markdown(f"**{name}** ({class_name}) · {timestamp[:16]}  \n{snippet}")
+        if col_action.button("Mở", key=f"search_open_{msg_id}"):
+            st.session_state["selected_student_id"] = student_id
+            st.session_state["current_session_id"] = session_id
+            st.session_state["teacher_view"] = "chat"
+            st.rerun()
+
+    col_prev, col_next = st.columns(2)
+    if len(pages) > 1 and col_prev.button("Trang trước"):
+        pages.pop()
+        st.rerun()
+    if next_before_id is not None and col_next.button("Trang sau"):
+        pages.append(next_before_id)
+        st.rerun()
+
 # Chế độ Học sinh
 if mode == "Học sinh":
     st.title("👩‍🏫 Chatbot Cô Hương - Chế độ Học sinh")
@@ -144,27 +483,44 @@ if mode == "Học sinh":
         class_name = st.text_input("Lớp")
         gvcn = st.text_input("GVCN")
         username = st.text_input("Số điện thoại")
+        # Server yêu cầu mật khẩu; lần đăng nhập đầu tiên sẽ đăng ký tài khoản với mật khẩu này
+        password = st.text_input("Mật khẩu", type="password") if USE_API else None
 
         if st.button("Đăng nhập"):
-            if name and class_name and gvcn and username:
+            if USE_API and name and class_name and gvcn and username and password:
+                try:
+                    try:
+                        session = ApiSession(api_client, "student", username, password)
+                    except ApiError as e:
+                        if e.status_code != 401:
+                            raise
+                        # Chưa có tài khoản thì đăng ký; số điện thoại đã có nghĩa là sai mật khẩu
+                        register_student(api_client, username, name, class_name, gvcn, password)
+                        session = ApiSession(api_client, "student", username, password)
+                except ApiError as e:
+                    st.error("Sai số điện thoại hoặc mật khẩu." if e.status_code in (400, 401) else f"Lỗi máy chủ: {e.detail}")
+                else:
+                    st.session_state["student_api_session"] = session
+                    st.session_state["student_id"] = session.user_id
+                    st.success("Đăng nhập thành công!")
+                    st.rerun()
+            elif not USE_API and name and class_name and gvcn and username:
                 # Kiểm tra nếu username tồn tại, nếu không tạo mới
-                cursor.execute("SELECT id FROM students WHERE username = ?", (username,))
-                result = cursor.fetchone()
+                result = storage.fetch_one("SELECT id FROM students WHERE username = ?", (username,))
                 if result:
                     st.session_state["student_id"] = result[0]
                 else:
-                    cursor.execute("INSERT INTO students (username, name, class, gvcn) VALUES (?, ?, ?, ?)",
-                                   (username, name, class_name, gvcn))
-                    conn.commit()
-                    st.session_state["student_id"] = cursor.lastrowid
+                    st.session_state["student_id"] = storage.execute(
+                        "INSERT INTO students (username, name, class, gvcn) VALUES (?, ?, ?, ?)",
+                        (username, name, class_name, gvcn))
+                    load_student_info.clear()
                 st.success("Đăng nhập thành công!")
                 st.rerun()
             else:
                 st.error("Vui lòng nhập đầy đủ thông tin.")
     else:
         # Lấy thông tin học sinh
-        cursor.execute("SELECT name, class, gvcn FROM students WHERE id = ?", (st.session_state["student_id"],))
-        student_info = cursor.fetchone()
+        student_info = get_student_info(st.session_state["student_id"])
         if student_info is None:
             st.error("Thông tin học sinh không tìm thấy. Vui lòng đăng nhập lại.")
             del st.session_state["student_id"]
@@ -174,6 +530,7 @@ if mode == "Học sinh":
 
         if st.button("Sign out"):
             del st.session_state["student_id"]
+            st.session_state.pop("student_api_session", None)
             if "current_session_id" in st.session_state:
                 del st.session_state["current_session_id"]
             if "messages" in st.session_state:
@@ -182,18 +539,11 @@ if mode == "Học sinh":
 
         # Sidebar cho lịch sử chat sessions
         st.sidebar.title("Lịch sử cuộc trò chuyện")
-        cursor.execute("SELECT id, title FROM chat_sessions WHERE student_id = ? ORDER BY created_at DESC",
-                       (st.session_state["student_id"],))
-        sessions = cursor.fetchall()
+        sessions = get_student_sessions(st.session_state["student_id"])
 
         session_options = {title: id for id, title in sessions}
         if st.sidebar.button("Tạo chat mới"):
-            timestamp = datetime.now()
-            title = f"Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
-            cursor.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
-                           (st.session_state["student_id"], title, timestamp.isoformat()))
-            conn.commit()
-            st.session_state["current_session_id"] = cursor.lastrowid
+            st.session_state["current_session_id"] = create_chat_session(st.session_state["student_id"])
             st.session_state["messages"] = [{"role": "system", "content": st.session_state["messages"][0]["content"]}] if "messages" in st.session_state else []
             st.rerun()
 
@@ -203,26 +553,15 @@ if mode == "Học sinh":
 
         # Nếu chưa có session hiện tại, tạo mới
         if "current_session_id" not in st.session_state:
-            timestamp = datetime.now()
-            title = f"Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
-            cursor.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
-                           (st.session_state["student_id"], title, timestamp.isoformat()))
-            conn.commit()
-            st.session_state["current_session_id"] = cursor.lastrowid
-
-        # Nút refresh để tải lại messages từ DB
-        if st.button("Refresh chat"):
-            st.rerun()
+            st.session_state["current_session_id"] = create_chat_session(st.session_state["student_id"])
 
         # Hiển thị chat
-        cursor.execute("SELECT title FROM chat_sessions WHERE id = ?", (st.session_state["current_session_id"],))
-        result = cursor.fetchone()
-        if result is None:
+        chat_title = get_session_title(st.session_state["student_id"], st.session_state["current_session_id"])
+        if chat_title is None:
             st.error("Phiên chat không tìm thấy.")
             del st.session_state["current_session_id"]
             st.rerun()
         else:
-            chat_title = result[0]
             display_chat_messages(st.session_state["current_session_id"], chat_title)
 
         # Lưu system prompt nếu chưa có
@@ -244,10 +583,7 @@ if mode == "Học sinh":
         # Ô nhập câu hỏi
         if prompt := st.chat_input("Nhập câu hỏi của em..."):
             # Lưu vào DB
-            timestamp = datetime.now()
-            cursor.execute("INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (?, ?, ?, ?, ?)",
-                           (st.session_state["current_session_id"], "user", prompt, timestamp.isoformat(), 0))
-            conn.commit()
+            save_message(st.session_state["current_session_id"], "user", prompt, 0)
 
             st.chat_message("user").write(f"👦 **Học sinh**: {prompt}")
 
@@ -260,33 +596,36 @@ if mode == "Học sinh":
                     placeholder = st.empty()
                     full_reply = ""
 
-                    # 🟢 Streaming từ Groq
-                    stream = client.chat.completions.create(
-                        model="openai/gpt-oss-120b",
-                        messages=st.session_state.messages,
-                        temperature=0.7,
-                        max_completion_tokens=1024,
-                        top_p=1,
-                        reasoning_effort="medium",
-                        stream=True  # bật chế độ stream
-                    )
-
-                    for chunk in stream:
-                        if chunk.choices[0].delta.content:
-                            full_reply += chunk.choices[0].delta.content
+                    # 🟢 Streaming từ LLM (hoặc từ chat_server.py ở chế độ api)
+                    try:
+                        for content in stream_reply(st.session_state["current_session_id"], st.session_state.messages,
+                                                    st.session_state["student_id"], student_info[1]):
+                            full_reply += content
                             placeholder.write(f"👩‍🏫 **Cô Hương**: {full_reply}▌")  # hiệu ứng đang gõ
+                    except BudgetExceeded as e:
+                        # Hết hạn mức token hôm nay: không có câu trả lời AI để lưu
+                        st.session_state["budget_notice"] = str(e)
 
                     # Xóa ký hiệu gõ ▌ sau khi xong
                     placeholder.write(f"👩‍🏫 **Cô Hương**: {full_reply}")
 
-                # Lưu câu trả lời AI vào DB
-                cursor.execute("INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (?, ?, ?, ?, ?)",
-                               (st.session_state["current_session_id"], "assistant", full_reply, datetime.now().isoformat(), 1))
-                conn.commit()
+                if "budget_notice" in st.session_state:
+                    st.session_state.messages.pop()
+                else:
+                    # Lưu câu trả lời AI vào DB (chat_server.py tự lưu ở chế độ api)
+                    if not USE_API:
+                        save_message(st.session_state["current_session_id"], "assistant", full_reply, 1)
 
-                st.session_state.messages.append({"role": "assistant", "content": full_reply})
+                    st.session_state.messages.append({"role": "assistant", "content": full_reply})
             else:
-                st.info("AI đang tắt. Cô giáo sẽ trả lời trực tiếp sau.")
+                st.session_state["ai_off_notice"] = True
+            # Chạy lại để khung chat tự làm mới hiển thị tin nhắn mới, tránh hiện hai lần
+            st.rerun()
+
+        if st.session_state.pop("ai_off_notice", False):
+            st.info("AI đang tắt. Cô giáo sẽ trả lời trực tiếp sau.")
+        if budget_notice := st.session_state.pop("budget_notice", None):
+            st.info(budget_notice)
 
 # Chế độ Giáo viên
 elif mode == "Giáo viên":
@@ -299,7 +638,17 @@ elif mode == "Giáo viên":
         password = st.text_input("Password", type="password")
 
         if st.button("Đăng nhập"):
-            if username == "teacher" and password == "123456":
+            if USE_API:
+                try:
+                    st.session_state["teacher_api_session"] = ApiSession(api_client, "teacher", username, password)
+                    logged_in = True
+                except ApiError as e:
+                    if e.status_code != 401:
+                        raise
+                    logged_in = False
+            else:
+                logged_in = username == "teacher" and password == "123456"
+            if logged_in:
                 st.session_state["teacher_logged_in"] = True
                 st.session_state["teacher_view"] = "home"
                 st.success("Đăng nhập thành công!")
@@ -311,6 +660,7 @@ elif mode == "Giáo viên":
 
         if st.button("Sign out"):
             del st.session_state["teacher_logged_in"]
+            st.session_state.pop("teacher_api_session", None)
             if "teacher_view" in st.session_state:
                 del st.session_state["teacher_view"]
             if "selected_student_id" in st.session_state:
@@ -322,6 +672,31 @@ elif mode == "Giáo viên":
         # Công tắc Bật/Tắt AI
         st.session_state["ai_enabled"] = st.checkbox("Bật AI (nếu tắt, học sinh chỉ nhận trả lời từ cô)", value=st.session_state["ai_enabled"])
 
+        # Thống kê theo tuyến mô hình (chế độ api: xem /admin/model_routes/stats của server)
+        if not USE_API:
+            with st.expander("Định tuyến mô hình AI"):
+                route_rows = [
+                    {"Tuyến": name, "Mô hình": r["model"], "Lượt": r["requests"], "Lỗi": r["errors"],
+                     "Token đầu p50 (ms)": r["first_token_ms"]["p50"], "Tổng p95 (ms)": r["total_ms"]["p95"],
+                     "Hỏi lại ngay": r["followups"], "Cô trả lời thêm": r["teacher_takeovers"]}
+                    for name, r in router.stats()["routes"].items()
+                ]
+                st.dataframe(pd.DataFrame(route_rows), hide_index=True)
+            with st.expander("Token AI hôm nay"):
+                flush_usage()
+                usage_by_class = storage.fetch_all("""
+                SELECT class, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens)
+                FROM token_usage WHERE day = ? GROUP BY class ORDER BY SUM(prompt_tokens + completion_tokens) DESC
+                """, (usage_day().isoformat(),))
+                budget_status = usage_tracker.budget_status([row[0] for row in usage_by_class])
+                usage_rows = [
+                    {"Lớp": class_name or "(không rõ)", "Lượt": calls, "Token hỏi": prompt_tokens,
+                     "Token trả lời": completion_tokens, "Hạn mức mềm": budget_status[class_name]["soft"],
+                     "Hạn mức cứng": budget_status[class_name]["hard"], "Mức": budget_status[class_name]["level"]}
+                    for class_name, calls, prompt_tokens, completion_tokens in usage_by_class
+                ]
+                st.dataframe(pd.DataFrame(usage_rows), hide_index=True)
+
         if "teacher_view" not in st.session_state:
             st.session_state["teacher_view"] = "home"
 
@@ -334,62 +709,17 @@ elif mode == "Giáo viên":
             filter_class = st.text_input("Lọc theo lớp")
             filter_gvcn = st.text_input("Lọc theo GVCN")
 
-            query = "SELECT id, name, class, gvcn FROM students WHERE 1=1"
-            params = []
-            if filter_name:
-                query += " AND name LIKE ?"
-                params.append(f"%{filter_name}%")
-            if filter_class:
-                query += " AND class LIKE ?"
-                params.append(f"%{filter_class}%")
-            if filter_gvcn:
-                query += " AND gvcn LIKE ?"
-                params.append(f"%{filter_gvcn}%")
-
-            cursor.execute(query, params)
-            filtered_students = cursor.fetchall()
-            if filtered_students:
-                # Hiển thị header
-                col1, col2, col3, col4, col5, col6, col7 = st.columns([1, 2, 1, 2, 2, 1, 1])
-                col1.write("ID")
-                col2.write("Tên")
-                col3.write("Lớp")
-                col4.write("GVCN")
-                col5.write("Tin nhắn cuối")
-                col6.write("Trạng thái")
-                col7.write("Hành động")
-
-                for student in filtered_students:
-                    student_id, name, class_name, gvcn = student
-                    last_time = get_last_message_time(student_id)
-                    status = get_unread_status(student_id)
-                    col1, col2, col3, col4, col5, col6, col7 = st.columns([1, 2, 1, 2, 2, 1, 1])
-                    col1.write(student_id)
-                    col2.write(name)
-                    col3.write(class_name)
-                    col4.write(gvcn)
-                    col5.write(last_time)
-                    col6.write(status)
-                    if col7.button("Trả lời", key=f"reply_{student_id}"):
-                        st.session_state["selected_student_id"] = student_id
-                        latest_session = get_latest_session(student_id)
-                        if latest_session:
-                            st.session_state["current_session_id"] = latest_session
-                            st.session_state["teacher_view"] = "chat"
-                        else:
-                            timestamp = datetime.now()
-                            title = f"Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
-                            cursor.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
-                                           (student_id, title, timestamp.isoformat()))
-                            conn.commit()
-                            st.session_state["current_session_id"] = cursor.lastrowid
-                            st.session_state["teacher_view"] = "chat"
-                        st.rerun()
-            else:
-                st.info("Chưa có học sinh nào.")
+            student_list(filter_name, filter_class, filter_gvcn)
 
-            if st.button("Refresh list"):
-                st.rerun()
+            # Tìm kiếm trong toàn bộ tin nhắn
+            st.subheader("Tìm kiếm tin nhắn")
+            search_query = st.text_input("Từ khóa (ví dụ: OTP, chuyển khoản)")
+            search_class = st.text_input("Lớp", key="search_class")
+            col_from, col_to = st.columns(2)
+            search_from = col_from.date_input("Từ ngày", value=None)
+            search_to = col_to.date_input("Đến ngày", value=None)
+            if search_query:
+                display_search(search_query, search_class, search_from, search_to)
 
         elif st.session_state["teacher_view"] == "chat_list":
             student_id = st.session_state.get("selected_student_id")
@@ -397,19 +727,16 @@ elif mode == "Giáo viên":
                 st.error("Không có học sinh được chọn.")
                 st.session_state["teacher_view"] = "home"
                 st.rerun()
-            cursor.execute("SELECT name FROM students WHERE id = ?", (student_id,))
-            result = cursor.fetchone()
-            if result is None:
+            student_info = get_student_info(student_id)
+            if student_info is None:
                 st.error("Học sinh không tìm thấy.")
                 st.session_state["teacher_view"] = "home"
                 st.rerun()
             else:
-                student_name = result[0]
+                student_name = student_info[0]
                 st.subheader(f"Danh sách chat của học sinh {student_name}")
 
-            cursor.execute("SELECT id, title FROM chat_sessions WHERE student_id = ? ORDER BY created_at DESC",
-                           (student_id,))
-            sessions = cursor.fetchall()
+            sessions = get_student_sessions(student_id)
             session_options = {title: id for id, title in sessions}
 
             selected_title = st.selectbox("Chọn tab chat", list(session_options.keys()))
@@ -428,35 +755,25 @@ elif mode == "Giáo viên":
                 st.error("Không có phiên chat được chọn.")
                 st.session_state["teacher_view"] = "chat_list"
                 st.rerun()
-            cursor.execute("SELECT title FROM chat_sessions WHERE id = ?", (session_id,))
-            result = cursor.fetchone()
-            if result is None:
+            chat_title = get_session_title(st.session_state.get("selected_student_id"), session_id)
+            if chat_title is None:
                 st.error("Phiên chat không tìm thấy.")
                 st.session_state["teacher_view"] = "chat_list"
                 st.rerun()
-            else:
-                chat_title = result[0]
-
-            # Cập nhật trạng thái đã đọc
-            cursor.execute("UPDATE conversations SET read_by_teacher = 1 WHERE session_id = ? AND role = 'user' AND read_by_teacher = 0", (session_id,))
-            conn.commit()
-
-            # Nút refresh
-            if st.button("Refresh chat"):
-                st.rerun()
 
-            display_chat_messages(session_id, chat_title)
+            # Khung chat tự làm mới và đánh dấu đã đọc khi có tin nhắn mới của học sinh
+            display_chat_messages(session_id, chat_title, mark_read=True)
 
             # Trả lời trực tiếp
             direct_reply = st.chat_input("Nhập câu trả lời của cô...")
             if direct_reply:
-                timestamp = datetime.now()
-                cursor.execute("INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (?, ?, ?, ?, ?)",
-                               (session_id, "teacher", direct_reply, timestamp.isoformat(), 1))
-                conn.commit()
+                save_message(session_id, "teacher", direct_reply, 1)
                 st.chat_message("assistant").write(f"👩‍🏫 **Cô Hương**: {direct_reply}")
                 st.rerun()
 
             if st.button("Quay lại danh sách chat"):
                 st.session_state["teacher_view"] = "chat_list"
-                st.rerun()
\ No newline at end of file
+                st.rerun()
+
+if SHOW_RERUN_TIMING:
+    st.sidebar.caption(f"⏱️ Lượt chạy: {(time.perf_counter() - RERUN_STARTED) * 1000:.1f} ms")
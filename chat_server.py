@@ -1,20 +1,35 @@
 import asyncio
 import uuid
 import psycopg2
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body, Query
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Body, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 import json
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.websockets import WebSocketState
 import uvicorn
-from datetime import datetime, timedelta, timezone
-from groq import Groq
+from datetime import date, datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from jose import JWTError, jwt
 import secrets
+import threading
+import weakref
+import archive
+import db_routing
+import profiling
+import traffic_capture
+from analytics import ROLLUP_COLUMNS, ROLLUP_SCHEMA, TOPIC_LABELS, forget_session, local_day, record_message, summarize, with_averages
+from bulk_import import insert_students
+from cache import LRUCache
+from export import EXPORT_FORMATS, export_chunks, parquet_available
+from http_cache import conditional_json, make_etag, parse_timestamp
+from fallback_answers import load_engine, stream_chunks
+from llm_providers import NoProviderAvailable, load_pool
+from model_router import load_router
+from search import VN_ACCENTED, VN_UNACCENTED, highlight, to_prefix_tsquery
+from usage import BUDGET_BLOCKED_MESSAGE, USAGE_COLUMNS, USAGE_SCHEMA, BudgetExceeded, PromptTooLong, load_tracker, write_rows
 
 load_dotenv()
 
@@ -22,6 +37,14 @@ load_dotenv()
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", secrets.token_hex(32))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+TOKEN_MAX_ACTIVE_PER_USER = int(os.environ.get("TOKEN_MAX_ACTIVE_PER_USER", "5"))
+TOKEN_SWEEP_INTERVAL_SECONDS = int(os.environ.get("TOKEN_SWEEP_INTERVAL_SECONDS", "300"))
+TOKEN_SWEEP_BATCH_SIZE = int(os.environ.get("TOKEN_SWEEP_BATCH_SIZE", "500"))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("CONVERSATION_ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+# Cache Configuration
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "300"))
 
 # Database Configuration
 DB_HOST = os.environ.get("DB_HOST")
@@ -30,32 +53,42 @@ DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 
-try:
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
+def connect_db(host=DB_HOST, port=DB_PORT, connect_timeout=None):
+    return psycopg2.connect(
+        host=host,
+        port=port,
         dbname=DB_NAME,
         user=DB_USER,
-        password=DB_PASSWORD
+        password=DB_PASSWORD,
+        connect_timeout=connect_timeout
     )
+
+try:
+    conn = connect_db()
     cursor = conn.cursor()
     print("Connected to PostgreSQL database")
 except Exception as e:
     print(f"Failed to connect to database: {str(e)}")
     raise
 
-# Initialize Groq client
-try:
-    client = Groq(api_key=os.environ.get("OPENAI_API_KEY"))
-    test_response = client.chat.completions.create(
-        model="openai/gpt-oss-120b",
-        messages=[{"role": "user", "content": "test"}],
-        max_tokens=10
-    )
-    print("Groq client initialized successfully")
-except Exception as e:
-    print(f"Failed to initialize Groq client: {str(e)}")
-    client = None
+# Read-only endpoints go to the replicas in DB_REPLICA_HOSTS (if any); writes stay on the primary
+read_router = db_routing.load_router(cursor, connect_db)
+if read_router.enabled:
+    print(f"Read replicas: {', '.join(r.name for r in read_router.replicas)}")
+
+# Model routes (model_routes.json): short, simple questions go to a faster model
+model_router = load_router()
+
+# Token usage per class/student/day, flushed to token_usage in batches, with daily budgets (usage_budgets.json)
+usage_tracker = load_tracker()
+
+# LLM providers (llm_providers.json): OpenAI-compatible endpoints tried in order, each
+# with a first-token timeout and a circuit breaker instead of a one-off startup check
+llm = load_pool()
+print(f"LLM providers: {', '.join(p.name for p in llm.providers) or 'none'}")
+
+# Local answers from scam_safety_kb.json for when no provider can take a /chatbot request
+fallback = load_engine()
 
 app = FastAPI()
 
@@ -67,6 +100,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Logs requests slower than SLOW_REQUEST_MS with the stacks that held up the event loop meanwhile
+app.add_middleware(profiling.SlowRequestTracer, monitor=profiling.monitor)
+
+# Opt-in capture of sanitized traffic (TRAFFIC_CAPTURE_PATH) for replay.py
+if traffic_capture.TRAFFIC_CAPTURE_PATH:
+    app.add_middleware(traffic_capture.TrafficCapture)
+
 # Create tables
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS teachers (
@@ -93,31 +133,76 @@ CREATE TABLE IF NOT EXISTS chat_sessions (
     created_at TEXT
 )
 """)
+# Monthly range partitions on created_at; converts an existing unpartitioned table once
+archive.create_conversations_table(cursor)
+if archive.ARCHIVE_AFTER_DAYS > 0 and not archive.ARCHIVE_DIR:
+    print("Conversation archiving is off: set CONVERSATION_ARCHIVE_DIR to a directory outside the source tree")
+# Migration for old tokens schema (whole JWT stored as TEXT). Tokens only live
+# ACCESS_TOKEN_EXPIRE_MINUTES, so dropping them just means logging in again.
+cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'tokens'")
+token_columns = [row[0] for row in cursor.fetchall()]
+if "token" in token_columns:
+    cursor.execute("DROP TABLE tokens")
 cursor.execute("""
-CREATE TABLE IF NOT EXISTS conversations (
-    id SERIAL PRIMARY KEY,
-    session_id INTEGER REFERENCES chat_sessions(id),
-    role TEXT,
-    content TEXT,
-    timestamp TEXT,
-    read_by_teacher INTEGER DEFAULT 0
+CREATE TABLE IF NOT EXISTS tokens (
+    jti UUID PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    user_type TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
 )
 """)
+cursor.execute("CREATE INDEX IF NOT EXISTS tokens_expires_at_idx ON tokens (expires_at)")
+cursor.execute("CREATE INDEX IF NOT EXISTS tokens_user_idx ON tokens (user_id, user_type, expires_at)")
+cursor.execute("CREATE INDEX IF NOT EXISTS conversations_session_id_idx ON conversations (session_id, id)")
+cursor.execute("CREATE INDEX IF NOT EXISTS chat_sessions_student_id_idx ON chat_sessions (student_id, created_at)")
+# Full-text search: fold Vietnamese diacritics so "chuyen khoan" matches "chuyển khoản"
+cursor.execute(f"""
+CREATE OR REPLACE FUNCTION vn_normalize(text) RETURNS text
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+AS $$ SELECT translate(lower($1), '{VN_ACCENTED}', '{VN_UNACCENTED}') $$
+""")
 cursor.execute("""
-CREATE TABLE IF NOT EXISTS tokens (
-    id SERIAL PRIMARY KEY,
-    user_id INTEGER,
-    user_type TEXT,
-    token TEXT UNIQUE,
-    expires_at TEXT
-)
+CREATE INDEX IF NOT EXISTS conversations_content_fts_idx
+ON conversations USING GIN (to_tsvector('simple', vn_normalize(content)))
 """)
+for statement in ROLLUP_SCHEMA:
+    cursor.execute(statement)
+for statement in USAGE_SCHEMA:
+    cursor.execute(statement)
 cursor.execute("INSERT INTO teachers (username, password) VALUES (%s, %s) ON CONFLICT DO NOTHING",
                 ("teacher", "123456"))
 conn.commit()
+# Today's usage so far, so a restart does not reset the budgets
+usage_tracker.load_totals(cursor)
 
 connected_clients = {}  # {session_id: {user_id: [websocket]}}
 teacher_connections = {}
+maintenance_tasks = []
+token_sweep_stats = {"last_sweep_at": None, "last_sweep_deleted": 0, "total_deleted": 0}
+archive_run_stats = {"last_run_at": None, "last_run": None, "total_archived_sessions": 0, "total_expired_sessions": 0}
+
+# Read-through caches for rarely-changing rows. A session's owner never changes,
+# the others are invalidated on writes and expire after CACHE_TTL_SECONDS.
+session_owner_cache: LRUCache[int, int] = LRUCache("session_owner", CACHE_MAX_ENTRIES)
+student_cache: LRUCache[int, dict] = LRUCache("student", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+teacher_cache: LRUCache[int, dict] = LRUCache("teacher", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+session_list_cache: LRUCache[int, list] = LRUCache("session_list", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+caches = [session_owner_cache, student_cache, teacher_cache, session_list_cache, archive.archive_cache]
+
+# Bulk roster import
+STUDENT_IMPORT_MAX_ROWS = int(os.environ.get("STUDENT_IMPORT_MAX_ROWS", "5000"))
+
+# Conversation export
+EXPORT_FETCH_ROWS = int(os.environ.get("EXPORT_FETCH_ROWS", "2000"))
+EXPORT_MAX_CONCURRENT = int(os.environ.get("EXPORT_MAX_CONCURRENT", "2"))
+export_stats = {"active": 0, "started": 0, "rows": 0}
+export_lock = threading.Lock()
+
+# Analytics
+ANALYTICS_DEFAULT_DAYS = int(os.environ.get("ANALYTICS_DEFAULT_DAYS", "30"))
+
+# Live AI streaming to session observers
+STREAM_SEND_TIMEOUT_SECONDS = float(os.environ.get("STREAM_SEND_TIMEOUT_SECONDS", "2"))
 
 class Message(BaseModel):
     session_id: int
@@ -156,28 +241,47 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    jti = str(uuid.uuid4())
     to_encode.update({"exp": expire})
-    to_encode.update({"jti": str(uuid.uuid4())})  # Add this line
+    to_encode.update({"jti": jti})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt, expire.isoformat()
+    return encoded_jwt, jti, expire
+
+def store_token(user_id: int, user_type: str, jti: str, expires_at: datetime, max_active: int):
+    cursor.execute("INSERT INTO tokens (jti, user_id, user_type, expires_at) VALUES (%s, %s, %s, %s)",
+                    (jti, user_id, user_type, expires_at))
+    # Keep only the newest max_active tokens for this user
+    cursor.execute("""
+    DELETE FROM tokens WHERE user_id = %s AND user_type = %s AND jti NOT IN (
+        SELECT jti FROM tokens WHERE user_id = %s AND user_type = %s
+        ORDER BY expires_at DESC LIMIT %s
+    )
+    """, (user_id, user_type, user_id, user_type, max_active))
+    conn.commit()
 
 def verify_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
         user_type = payload.get("type")
-        if user_id is None or user_type is None:
-            print("Token validation failed: Missing user_id or user_type")
+        jti = payload.get("jti")
+        if user_id is None or user_type is None or jti is None:
+            print("Token validation failed: Missing user_id, user_type or jti")
             return None
         user_id = int(user_id)
-        cursor.execute("SELECT token, expires_at FROM tokens WHERE token = %s AND user_id = %s AND user_type = %s",
-                        (token, user_id, user_type))
+        try:
+            jti = str(uuid.UUID(jti))
+        except ValueError:
+            print(f"Token validation failed: Malformed jti {jti}")
+            return None
+        cursor.execute("SELECT expires_at FROM tokens WHERE jti = %s AND user_id = %s AND user_type = %s",
+                        (jti, user_id, user_type))
         result = cursor.fetchone()
         if not result:
-            print(f"Token not found in database: token={token}, user_id={user_id}, user_type={user_type}")
+            print(f"Token not found in database: jti={jti}, user_id={user_id}, user_type={user_type}")
             return None
-        if datetime.fromisoformat(result[1]) < datetime.now(timezone.utc):
-            print(f"Token expired: expires_at={result[1]}")
+        if result[0] < datetime.now(timezone.utc):
+            print(f"Token expired: expires_at={result[0].isoformat()}")
             return None
         print(f"Token validated: user_id={user_id}, user_type={user_type}")
         return {"user_id": user_id, "user_type": user_type}
@@ -185,18 +289,325 @@ def verify_token(token: str):
         print(f"JWTError: {str(e)}")
         return None
 
+def load_session_owner(session_id: int):
+    cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (session_id,))
+    session = cursor.fetchone()
+    return session[0] if session else None
+
+def get_session_owner(session_id: int):
+    return session_owner_cache.get_or_load(session_id, load_session_owner)
+
+def load_student(student_id: int):
+    cursor.execute("SELECT id, name, class, gvcn FROM students WHERE id = %s", (student_id,))
+    student = cursor.fetchone()
+    if student:
+        return {"id": student[0], "name": student[1], "class": student[2], "gvcn": student[3]}
+    return None
+
+def get_student_profile(student_id: int):
+    return student_cache.get_or_load(student_id, load_student)
+
+def load_teacher(teacher_id: int):
+    cursor.execute("SELECT id, username FROM teachers WHERE id = %s", (teacher_id,))
+    teacher = cursor.fetchone()
+    if teacher:
+        return {"id": teacher[0], "username": teacher[1]}
+    return None
+
+def load_session_list(student_id: int):
+    reader = read_router.cursor(("student", student_id))
+    reader.execute("SELECT id, title, created_at FROM chat_sessions WHERE student_id = %s ORDER BY created_at DESC",
+                    (student_id,))
+    sessions = reader.fetchall()
+    return [{"id": s[0], "title": s[1], "created_at": s[2]} for s in sessions]
+
+def get_session_list(student_id: int):
+    return session_list_cache.get_or_load(student_id, load_session_list)
+
+def get_session_class(session_id: int):
+    student_id = get_session_owner(session_id)
+    student = get_student_profile(student_id) if student_id is not None else None
+    return student["class"] if student else None
+
+def sweep_expired_tokens(batch_size: int):
+    cursor.execute("""
+    DELETE FROM tokens WHERE jti IN (
+        SELECT jti FROM tokens WHERE expires_at < now() LIMIT %s
+    )
+    """, (batch_size,))
+    deleted = cursor.rowcount
+    conn.commit()
+    return deleted
+
+async def token_maintenance_loop():
+    while True:
+        try:
+            deleted_total = 0
+            while True:
+                deleted = sweep_expired_tokens(TOKEN_SWEEP_BATCH_SIZE)
+                deleted_total += deleted
+                if deleted < TOKEN_SWEEP_BATCH_SIZE:
+                    break
+                # Small batches keep each DELETE short; yield to requests in between
+                await asyncio.sleep(0)
+            token_sweep_stats["last_sweep_at"] = datetime.now(timezone.utc).isoformat()
+            token_sweep_stats["last_sweep_deleted"] = deleted_total
+            token_sweep_stats["total_deleted"] += deleted_total
+            if deleted_total:
+                print(f"Token sweep removed {deleted_total} expired tokens")
+        except Exception as e:
+            conn.rollback()
+            print(f"Token sweep failed: {str(e)}")
+        await asyncio.sleep(TOKEN_SWEEP_INTERVAL_SECONDS)
+
+def run_archive_maintenance():
+    # Runs in a worker thread on its own connection: archiving a batch of sessions
+    # writes files and moves rows, which must not hold up the shared connection
+    archive_conn = connect_db()
+    try:
+        return archive.run_maintenance(archive_conn)
+    finally:
+        archive_conn.close()
+
+def run_partition_maintenance():
+    # Also in a worker thread on its own connection: the DDL may wait for its lock and
+    # scan the default partition, and the event loop must not wait with it
+    partition_conn = connect_db()
+    try:
+        return archive.manage_partitions(partition_conn)
+    finally:
+        partition_conn.close()
+
+def run_restore_session(session_id: int) -> int:
+    # Worker thread, own connection: the restore gunzips the archive file, may create partitions
+    # and COPYs the rows back, none of which should hold up other requests
+    restore_conn = connect_db()
+    try:
+        return archive.restore_session(restore_conn, session_id)
+    finally:
+        restore_conn.close()
+
+async def restore_archived_session(session_id: int):
+    # A new message brings an archived session back into the hot table first
+    if not archive.is_archived(cursor, session_id):
+        return
+    # Like the partition maintenance: end the shared connection's read snapshot so the
+    # restore's partition DDL does not wait on it
+    conn.commit()
+    restored = await asyncio.to_thread(run_restore_session, session_id)
+    print(f"Restored {restored} archived messages for session_id {session_id}")
+
+def count_archived_sessions(reader, student_id: Optional[int] = None, class_name: Optional[str] = None,
+                            since: Optional[str] = None) -> int:
+    # Archived sessions live in files, outside what /search, /unread and /last_message query;
+    # those endpoints report how many they left out instead
+    query = """
+    SELECT COUNT(*) FROM archived_sessions a
+    JOIN chat_sessions s ON s.id = a.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE TRUE
+    """
+    params = []
+    if student_id is not None:
+        query += " AND st.id = %s"
+        params.append(student_id)
+    if class_name:
+        query += " AND st.class = %s"
+        params.append(class_name)
+    if since:
+        query += " AND a.last_message_at >= %s"
+        params.append(since)
+    reader.execute(query, params)
+    return reader.fetchone()[0]
+
+async def archive_maintenance_loop():
+    while True:
+        try:
+            stats = await asyncio.to_thread(run_archive_maintenance)
+            # Between requests the shared connection still holds a read snapshot, which would
+            # block DETACH until its next write; end it right before the partition DDL starts
+            conn.commit()
+            stats.update(await asyncio.to_thread(run_partition_maintenance))
+            for session_id, student_id in stats["expired_sessions"]:
+                session_owner_cache.invalidate(session_id)
+                if student_id is not None:
+                    session_list_cache.invalidate(student_id)
+            stats["expired_sessions"] = len(stats["expired_sessions"])
+            archive_run_stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+            archive_run_stats["last_run"] = stats
+            archive_run_stats["total_archived_sessions"] += stats["archived_sessions"]
+            archive_run_stats["total_expired_sessions"] += stats["expired_sessions"]
+            if stats["archived_sessions"] or stats["expired_sessions"] or stats["dropped_partitions"]:
+                print(f"Conversation archive: {stats}")
+        except Exception as e:
+            conn.rollback()
+            print(f"Conversation archive maintenance failed: {str(e)}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+def flush_usage():
+    rows = usage_tracker.drain()
+    if not rows:
+        return
+    try:
+        write_rows(cursor, rows)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        usage_tracker.restore(rows)
+        print(f"Token usage flush failed, keeping {len(rows)} rows for the next try: {str(e)}")
+        return
+    usage_tracker.flushed(len(rows))
+
+async def replica_check_loop():
+    # Replica connections and lag checks run in a thread so a replica that is down cannot stall requests
+    while True:
+        await asyncio.to_thread(read_router.check)
+        await asyncio.sleep(db_routing.DB_REPLICA_CHECK_SECONDS)
+
+async def usage_flush_loop():
+    # One upsert per batch instead of a write per /chatbot call
+    while True:
+        await asyncio.sleep(1)
+        if usage_tracker.due():
+            flush_usage()
+
+@app.on_event("startup")
+async def start_maintenance_tasks():
+    maintenance_tasks.append(asyncio.create_task(token_maintenance_loop()))
+    maintenance_tasks.append(asyncio.create_task(archive_maintenance_loop()))
+    maintenance_tasks.append(asyncio.create_task(usage_flush_loop()))
+    if read_router.enabled:
+        maintenance_tasks.append(asyncio.create_task(replica_check_loop()))
+    # Event loop heartbeat plus the sampling thread behind /admin/profile
+    maintenance_tasks.append(profiling.monitor.start(asyncio.get_running_loop()))
+
+@app.on_event("shutdown")
+async def flush_usage_on_shutdown():
+    flush_usage()
+
 @app.get("/")
 async def root():
     return {"message": "Chat Server"}
 
+@app.get("/admin/tokens/stats")
+async def get_token_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    cursor.execute("""
+    SELECT COUNT(*), COUNT(*) FILTER (WHERE expires_at < now()), pg_total_relation_size('tokens')
+    FROM tokens
+    """)
+    rows, expired_rows, table_bytes = cursor.fetchone()
+    return {"rows": rows, "expired_rows": expired_rows, "table_bytes": table_bytes, **token_sweep_stats}
+
+@app.get("/admin/archive/stats")
+async def get_archive_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return {**archive.archive_stats(cursor), **archive_run_stats}
+
+@app.get("/admin/llm/providers")
+async def get_llm_provider_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return llm.stats()
+
+@app.get("/admin/db/replicas")
+async def get_replica_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return read_router.stats()
+
+@app.get("/admin/fallback/stats")
+async def get_fallback_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return fallback.stats()
+
+@app.get("/admin/model_routes/stats")
+async def get_model_route_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return model_router.stats()
+
+@app.post("/admin/profile")
+async def start_profile(token: str, seconds: float = 30, interval_ms: float = profiling.PROFILE_INTERVAL_MS,
+                        all_threads: bool = False):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        return profiling.monitor.start_profile(seconds, interval_ms, all_threads)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.delete("/admin/profile")
+async def stop_profile(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    summary = profiling.monitor.stop_profile()
+    if summary is None:
+        raise HTTPException(status_code=404, detail="No profile has been started")
+    return summary
+
+@app.get("/admin/profile")
+async def get_profile_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return profiling.monitor.stats()
+
+@app.get("/admin/profile/collapsed")
+async def download_profile(token: str):
+    # Collapsed stacks ("frame;frame;frame count") for flamegraph.pl, speedscope or inferno
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    collapsed = profiling.monitor.collapsed()
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="No profile has been started")
+    filename = f"chat_server-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/admin/profile/events")
+async def get_profile_events(token: str):
+    # Recent event loop stalls and slow request traces, with the stacks behind them
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return profiling.monitor.recent()
+
+@app.get("/admin/cache/stats")
+async def get_cache_stats(token: str):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return [c.stats() for c in caches]
+
 @app.get("/students")
-async def get_students(token: str):
+async def get_students(request: Request, token: str):
     user = verify_token(token)
     if not user or user["user_type"] != "teacher":
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT id, username, name, class, gvcn FROM students")
-    students = cursor.fetchall()
-    return [{"id": s[0], "username": s[1], "name": s[2], "class": s[3], "gvcn": s[4]} for s in students]
+    reader = read_router.cursor(("students",))
+    reader.execute("SELECT COUNT(*), MAX(id) FROM students")
+    count, max_id = reader.fetchone()
+
+    def build():
+        reader.execute("SELECT id, username, name, class, gvcn FROM students")
+        students = reader.fetchall()
+        return [{"id": s[0], "username": s[1], "name": s[2], "class": s[3], "gvcn": s[4]} for s in students]
+
+    return conditional_json(request, make_etag("students", count, max_id), None, build)
 
 @app.post("/student_register")
 async def student_register(student: StudentRegister):
@@ -209,8 +620,34 @@ async def student_register(student: StudentRegister):
     )
     student_id = cursor.fetchone()[0]
     conn.commit()
+    # The student list changes: its ETag follows COUNT/MAX(id), and ("students",) keeps the next
+    # /students read off a replica that lacks the row. student_cache never holds an unknown id
+    # (None is not cached), but session_list_cache does: a lookup before the id existed cached [].
+    read_router.note_write(("students",), ("student", student_id))
+    session_list_cache.invalidate(student_id)
     return {"id": student_id}
 
+@app.post("/students/import")
+async def import_students(students: List[StudentRegister] = Body(...), token: str = Body(...)):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if len(students) > STUDENT_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {STUDENT_IMPORT_MAX_ROWS} students per request")
+    # One multi-row INSERT in one transaction instead of a SELECT and INSERT per student
+    try:
+        inserted = insert_students(cursor, [(s.username, s.name, s.class_name, s.gvcn, s.password) for s in students])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # Same keys as student_register
+    read_router.note_write(("students",), *(("student", student_id) for student_id in inserted.values()))
+    for student_id in inserted.values():
+        session_list_cache.invalidate(student_id)
+    skipped = sorted({s.username for s in students} - inserted.keys())
+    return {"inserted": len(inserted), "ids": inserted, "skipped": skipped}
+
 @app.post("/student_login")
 async def student_login(student: StudentLogin):
     cursor.execute("SELECT id FROM students WHERE username = %s AND password = %s",
@@ -218,13 +655,9 @@ async def student_login(student: StudentLogin):
     result = cursor.fetchone()
     if result:
         user_id = result[0]
-        token, expires_at = create_access_token({"sub": str(user_id), "type": "student"})
-        # Add this: Delete old tokens for this user
-        cursor.execute("DELETE FROM tokens WHERE user_id = %s AND user_type = %s",
-                        (user_id, "student"))
-        cursor.execute("INSERT INTO tokens (user_id, user_type, token, expires_at) VALUES (%s, %s, %s, %s)",
-                        (user_id, "student", token, expires_at))
-        conn.commit()
+        token, jti, expires_at = create_access_token({"sub": str(user_id), "type": "student"})
+        # A new student login replaces any previous token
+        store_token(user_id, "student", jti, expires_at, max_active=1)
         return {"id": user_id, "token": token}
     raise HTTPException(status_code=401, detail="Sai tài khoản hoặc mật khẩu")
 
@@ -235,10 +668,8 @@ async def teacher_login(teacher: TeacherLogin):
     result = cursor.fetchone()
     if result:
         user_id = result[0]
-        token, expires_at = create_access_token({"sub": str(user_id), "type": "teacher"})
-        cursor.execute("INSERT INTO tokens (user_id, user_type, token, expires_at) VALUES (%s, %s, %s, %s)",
-                        (user_id, "teacher", token, expires_at))
-        conn.commit()
+        token, jti, expires_at = create_access_token({"sub": str(user_id), "type": "teacher"})
+        store_token(user_id, "teacher", jti, expires_at, max_active=TOKEN_MAX_ACTIVE_PER_USER)
         return {"id": user_id, "token": token}
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -247,10 +678,9 @@ async def get_teacher(teacher_id: int, token: str):
     user = verify_token(token)
     if not user or (user["user_type"] == "teacher" and user["user_id"] != teacher_id):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT id, username FROM teachers WHERE id = %s", (teacher_id,))
-    teacher = cursor.fetchone()
+    teacher = teacher_cache.get_or_load(teacher_id, load_teacher)
     if teacher:
-        return {"id": teacher[0], "username": teacher[1]}
+        return dict(teacher)
     raise HTTPException(status_code=404, detail="Teacher not found")
 
 @app.websocket("/ws/teacher/{teacher_id}/{token}")
@@ -300,14 +730,24 @@ async def teacher_websocket_endpoint(websocket: WebSocket, teacher_id: int, toke
                 del teacher_connections[teacher_id]
 
 @app.get("/sessions/{student_id}")
-async def get_sessions(student_id: int, token: str):
+async def get_sessions(request: Request, student_id: int, token: str):
     user = verify_token(token)
     if not user or (user["user_type"] == "student" and user["user_id"] != student_id):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT id, title, created_at FROM chat_sessions WHERE student_id = %s ORDER BY created_at DESC",
-                    (student_id,))
-    sessions = cursor.fetchall()
-    return [{"id": s[0], "title": s[1], "created_at": s[2]} for s in sessions]
+    reader = read_router.cursor(("student", student_id))
+    reader.execute("SELECT COUNT(*), MAX(id), MAX(created_at) FROM chat_sessions WHERE student_id = %s", (student_id,))
+    count, max_id, last_created = reader.fetchone()
+
+    def build():
+        sessions = get_session_list(student_id)
+        cached_max_id = max((s["id"] for s in sessions), default=None)
+        if len(sessions) != count or cached_max_id != max_id:
+            # Another worker changed the list since it was cached
+            session_list_cache.invalidate(student_id)
+            sessions = get_session_list(student_id)
+        return [dict(s) for s in sessions]
+
+    return conditional_json(request, make_etag("sessions", student_id, count, max_id), parse_timestamp(last_created), build)
 
 @app.post("/sessions")
 async def create_session(session: dict = Body(...), token: str = Body(...)):
@@ -319,6 +759,8 @@ async def create_session(session: dict = Body(...), token: str = Body(...)):
                     (session["student_id"], session["title"], timestamp))
     session_id = cursor.fetchone()[0]
     conn.commit()
+    read_router.note_write(("student", session["student_id"]))
+    session_list_cache.invalidate(session["student_id"])
     return {"id": session_id}
 
 @app.delete("/sessions/{session_id}")
@@ -327,14 +769,20 @@ async def delete_session(session_id: int, token: str = Query(...)):
     if not user or user["user_type"] != "student":
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (session_id,))
-    session = cursor.fetchone()
-    if not session or session[0] != user["user_id"]:
+    owner_id = get_session_owner(session_id)
+    if owner_id is None or owner_id != user["user_id"]:
         raise HTTPException(status_code=403, detail="Forbidden: You can only delete your own sessions")
 
     cursor.execute("DELETE FROM conversations WHERE session_id = %s", (session_id,))
+    archive_path = archive.delete_archived(cursor, session_id)
     cursor.execute("DELETE FROM chat_sessions WHERE id = %s", (session_id,))
+    forget_session(cursor, session_id)
     conn.commit()
+    read_router.note_write(("session", session_id), ("student", owner_id))
+    if archive_path:
+        archive.remove_archive_file(archive_path)
+    session_owner_cache.invalidate(session_id)
+    session_list_cache.invalidate(owner_id)
 
     if session_id in connected_clients:
         for user_id, clients in list(connected_clients[session_id].items()):
@@ -352,14 +800,330 @@ async def delete_session(session_id: int, token: str = Query(...)):
     return {"status": "ok"}
 
 @app.get("/conversations/{session_id}")
-async def get_conversations(session_id: int, token: str):
+async def get_conversations(request: Request, session_id: int, token: str):
     user = verify_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT role, content, timestamp FROM conversations WHERE session_id = %s ORDER BY timestamp",
-                    (session_id,))
-    messages = cursor.fetchall()
-    return [{"role": m[0], "content": m[1], "timestamp": m[2]} for m in messages]
+    reader = read_router.cursor(("session", session_id))
+    # Last-Modified comes from created_at, which the server sets: timestamp is whatever the client
+    # sent, and a back-dated one would turn If-Modified-Since into a false 304
+    reader.execute("""
+    SELECT COUNT(*), MAX(id), MAX(created_at),
+        (SELECT message_count FROM archived_sessions WHERE session_id = %(session_id)s),
+        (SELECT last_message_at FROM archived_sessions WHERE session_id = %(session_id)s)
+    FROM conversations WHERE session_id = %(session_id)s
+    """, {"session_id": session_id})
+    count, max_id, last_created, archived_count, archived_last_at = reader.fetchone()
+
+    def build():
+        reader.execute("SELECT role, content, timestamp FROM conversations WHERE session_id = %s ORDER BY timestamp",
+                        (session_id,))
+        messages = [{"role": m[0], "content": m[1], "timestamp": m[2]} for m in reader.fetchall()]
+        if archived_count:
+            # Served straight from the archive file; the session stays cold until someone writes to it
+            archived = [{"role": m["role"], "content": m["content"], "timestamp": m["timestamp"]}
+                        for m in archive.get_archived_messages(reader, session_id)]
+            messages = sorted(archived + messages, key=lambda m: m["timestamp"] or "")
+        return messages
+
+    return conditional_json(request, make_etag("conversations", session_id, count, max_id, archived_count),
+                            max(filter(None, [last_created, archived_last_at]), default=None), build)
+
+@app.get("/search")
+async def search_conversations(
+    token: str,
+    q: str,
+    class_name: Optional[str] = None,
+    student_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    role: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100)
+):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    tsquery = to_prefix_tsquery(q)
+    if not tsquery:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+
+    query = """
+    SELECT c.id, c.session_id, c.role, c.content, c.timestamp, st.id, st.name, st.class
+    FROM conversations c
+    JOIN chat_sessions s ON s.id = c.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE to_tsvector('simple', vn_normalize(c.content)) @@ to_tsquery('simple', %s)
+    """
+    params = [tsquery]
+    if class_name:
+        query += " AND st.class = %s"
+        params.append(class_name)
+    if student_id is not None:
+        query += " AND st.id = %s"
+        params.append(student_id)
+    if date_from:
+        query += " AND c.timestamp >= %s"
+        params.append(date_from.isoformat())
+    if date_to:
+        query += " AND c.timestamp < %s"
+        params.append((date_to + timedelta(days=1)).isoformat())
+    if role:
+        query += " AND c.role = %s"
+        params.append(role)
+    if before_id:
+        query += " AND c.id < %s"
+        params.append(before_id)
+    # Keyset pagination on id keeps deep pages as cheap as the first one
+    query += " ORDER BY c.id DESC LIMIT %s"
+    params.append(limit + 1)
+    # The heaviest read here (GIN match, vn_normalize, highlighting): a replica takes it. Searching one
+    # student waits for that student's own writes; a class-wide search may trail the primary by the replica lag.
+    reader = read_router.cursor(("student", student_id)) if student_id is not None else read_router.cursor()
+    reader.execute(query, params)
+    rows = reader.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = [{
+        "id": r[0],
+        "session_id": r[1],
+        "role": r[2],
+        "timestamp": r[4],
+        "student_id": r[5],
+        "student_name": r[6],
+        "class": r[7],
+        "snippet": highlight(r[3], q)
+    } for r in rows]
+    # Archived sessions are not searched; archived_sessions counts the ones that match the filters
+    archived = count_archived_sessions(reader, student_id=student_id, class_name=class_name,
+                                       since=date_from.isoformat() if date_from else None)
+    return {"results": results, "next_before_id": rows[-1][0] if has_more else None, "archived_sessions": archived}
+
+def reserve_export_slot():
+    # Takes one of the EXPORT_MAX_CONCURRENT slots, checked and counted under the lock so two
+    # requests cannot both take the last one. Returns a release() that is safe to call more than
+    # once, or None when every slot is taken.
+    with export_lock:
+        if export_stats["active"] >= EXPORT_MAX_CONCURRENT:
+            return None
+        export_stats["active"] += 1
+        export_stats["started"] += 1
+    held = [True]
+
+    def release():
+        with export_lock:
+            if held[0]:
+                held[0] = False
+                export_stats["active"] -= 1
+    return release
+
+def fetch_export_batches(release_slot, query: str, params: list, archive_query: str, archive_params: list,
+                         timestamp_from: Optional[str], timestamp_to: Optional[str]):
+    # Runs in Starlette's threadpool. A dedicated read-only connection with a named
+    # (server-side) cursor keeps only EXPORT_FETCH_ROWS rows in the worker at a time
+    # and leaves the shared connection free for other requests.
+    export_conn = None
+    try:
+        export_conn = connect_db()
+        export_conn.set_session(readonly=True)
+        with export_conn.cursor(name=f"export_{uuid.uuid4().hex}") as export_cursor:
+            export_cursor.itersize = EXPORT_FETCH_ROWS
+            export_cursor.execute(query, params)
+            while True:
+                rows = export_cursor.fetchmany(EXPORT_FETCH_ROWS)
+                if not rows:
+                    break
+                with export_lock:
+                    export_stats["rows"] += len(rows)
+                yield rows
+        # Then whatever matches in cold storage, one archived session at a time
+        for rows in archive.export_archived(export_conn.cursor(), archive_query, archive_params, timestamp_from, timestamp_to):
+            with export_lock:
+                export_stats["rows"] += len(rows)
+            yield rows
+    finally:
+        if export_conn is not None:
+            export_conn.close()
+        release_slot()
+
+@app.get("/export")
+async def export_conversations(
+    token: str,
+    format: str = "csv",
+    class_name: Optional[str] = None,
+    student_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export needs pyarrow installed on the server")
+
+    query = """
+    SELECT c.id, c.session_id, s.title, st.id, st.name, st.class, st.gvcn,
+           c.role, c.content, c.timestamp, c.read_by_teacher
+    FROM conversations c
+    JOIN chat_sessions s ON s.id = c.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE TRUE
+    """
+    archive_query = """
+    SELECT a.session_id, a.path, s.title, st.id, st.name, st.class, st.gvcn
+    FROM archived_sessions a
+    JOIN chat_sessions s ON s.id = a.session_id
+    JOIN students st ON st.id = s.student_id
+    WHERE TRUE
+    """
+    params = []
+    if class_name:
+        query += " AND st.class = %s"
+        archive_query += " AND st.class = %s"
+        params.append(class_name)
+    if student_id:
+        query += " AND st.id = %s"
+        archive_query += " AND st.id = %s"
+        params.append(student_id)
+    archive_params = list(params)
+    timestamp_from = date_from.isoformat() if date_from else None
+    timestamp_to = (date_to + timedelta(days=1)).isoformat() if date_to else None
+    if timestamp_from:
+        query += " AND c.timestamp >= %s"
+        params.append(timestamp_from)
+        archive_query += " AND a.last_message_at >= %s"
+        archive_params.append(timestamp_from)
+    if timestamp_to:
+        query += " AND c.timestamp < %s"
+        params.append(timestamp_to)
+    query += " ORDER BY c.id"
+    archive_query += " ORDER BY a.session_id"
+
+    release_slot = reserve_export_slot()
+    if release_slot is None:
+        raise HTTPException(status_code=429, detail="Too many exports running, try again shortly")
+    try:
+        media_type, extension = EXPORT_FORMATS[format]
+        filename = "conversations" + "".join(f"-{part}" for part in (class_name, date_from, date_to) if part)
+        batches = fetch_export_batches(release_slot, query, params, archive_query, archive_params, timestamp_from, timestamp_to)
+        # The generator's finally gives the slot back, but only once the body has started. If the
+        # client is gone before that, the generator is collected without running and this does it.
+        weakref.finalize(batches, release_slot)
+        return StreamingResponse(
+            export_chunks(format, batches),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}.{extension}"'}
+        )
+    except BaseException:
+        release_slot()
+        raise
+
+@app.get("/analytics")
+async def get_analytics(
+    token: str,
+    class_name: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    date_to = date_to or local_day(None)
+    date_from = date_from or date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+
+    # Reads only the rollup tables, so the cost depends on the date range, not on history size
+    where = "day BETWEEN %s AND %s"
+    params = [date_from, date_to]
+    if class_name:
+        where += " AND class = %s"
+        params.append(class_name)
+    cursor.execute(f"""
+    SELECT day, class, questions, ai_replies, teacher_replies, ai_response_count, ai_response_seconds,
+           teacher_response_count, teacher_response_seconds
+    FROM analytics_daily_class WHERE {where} ORDER BY day, class
+    """, params)
+    rows = cursor.fetchall()
+    cursor.execute(f"""
+    SELECT topic, SUM(questions) FROM analytics_daily_topic WHERE {where}
+    GROUP BY topic ORDER BY SUM(questions) DESC, topic
+    """, params)
+    topics = cursor.fetchall()
+    return {
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "totals": summarize(rows),
+        "days": [{"day": r[0].isoformat(), "class": r[1], **with_averages(dict(zip(ROLLUP_COLUMNS, r[2:])))} for r in rows],
+        "topics": [{"topic": topic, "label": TOPIC_LABELS.get(topic, topic), "questions": count} for topic, count in topics]
+    }
+
+# group_by -> {response field: column}
+USAGE_GROUPS = {
+    "class": {"class": "u.class"},
+    "student": {"class": "u.class", "student_id": "u.student_id", "student_name": "st.name"},
+    "session": {"class": "u.class", "student_id": "u.student_id", "student_name": "st.name", "session_id": "u.session_id"},
+    "model": {"model": "u.model"},
+    "day": {"day": "u.day"},
+}
+
+@app.get("/usage")
+async def get_usage(
+    token: str,
+    class_name: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    group_by: str = "class"
+):
+    user = verify_token(token)
+    if not user or user["user_type"] != "teacher":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if group_by not in USAGE_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(USAGE_GROUPS)}")
+    date_to = date_to or local_day(None)
+    date_from = date_from or date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    # Counts still in memory go to the table first, so the answer includes the last few seconds
+    flush_usage()
+
+    where = "u.day BETWEEN %s AND %s"
+    params = [date_from, date_to]
+    if class_name:
+        where += " AND u.class = %s"
+        params.append(class_name)
+    group = ", ".join(USAGE_GROUPS[group_by].values())
+    cursor.execute(f"""
+    SELECT {group}, {', '.join(f'SUM(u.{column})' for column in USAGE_COLUMNS)}
+    FROM token_usage u LEFT JOIN students st ON st.id = u.student_id
+    WHERE {where} GROUP BY {group} ORDER BY SUM(u.prompt_tokens + u.completion_tokens) DESC
+    """, params)
+    keys = list(USAGE_GROUPS[group_by])
+    rows = []
+    totals = dict.fromkeys(USAGE_COLUMNS, 0)
+    for row in cursor.fetchall():
+        entry = dict(zip(keys, row))
+        for column, value in zip(USAGE_COLUMNS, row[len(keys):]):
+            entry[column] = int(value)
+            totals[column] += int(value)
+        entry["total_tokens"] = entry["prompt_tokens"] + entry["completion_tokens"]
+        if "day" in entry:
+            entry["day"] = entry["day"].isoformat()
+        rows.append(entry)
+    totals["total_tokens"] = totals["prompt_tokens"] + totals["completion_tokens"]
+    classes = {r["class"] for r in rows if "class" in r} | ({class_name} if class_name else set())
+    return {
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "group_by": group_by,
+        "totals": totals,
+        "rows": rows,
+        "budgets": usage_tracker.budget_status(sorted(classes)),
+        "tracker": usage_tracker.stats()
+    }
 
 async def broadcast_message_to_teachers(student_id: int, session_id: int, last_message_time: str):
     print(f"Broadcasting new message to teachers: student_id={student_id}, session_id={session_id}, last_message_time={last_message_time}")
@@ -400,12 +1164,10 @@ async def broadcast_message_to_clients(session_id: int, broadcast_message: dict)
     print(f"Preparing to broadcast message: {broadcast_message}")
     await asyncio.sleep(0.1)
 
-    cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (session_id,))
-    session = cursor.fetchone()
-    if not session:
+    student_id = get_session_owner(session_id)
+    if student_id is None:
         print(f"Session {session_id} not found")
         return
-    student_id = session[0]
 
     for user_id, clients in list(connected_clients[session_id].items()):
         if user_id != student_id and broadcast_message["role"] != "teacher":
@@ -430,24 +1192,60 @@ async def broadcast_message_to_clients(session_id: int, broadcast_message: dict)
         if not connected_clients[session_id]:
             del connected_clients[session_id]
 
+def get_stream_observers(session_id: int, owner_id: int):
+    observers = []
+    for user_id, clients in connected_clients.get(session_id, {}).items():
+        for client_ws in clients:
+            # The owning student already receives the reply through the /chatbot SSE response
+            if user_id == owner_id and getattr(client_ws.state, "user_type", None) == "student":
+                continue
+            if client_ws.client_state == WebSocketState.CONNECTED:
+                observers.append((user_id, client_ws))
+    return observers
+
+async def fan_out_stream_frames(session_id: int, owner_id: int, frames: asyncio.Queue):
+    # Runs beside the /chatbot generator so a slow observer never delays the student's SSE stream
+    while True:
+        frame = await frames.get()
+        if frame is None:
+            break
+        observers = get_stream_observers(session_id, owner_id)
+        if not observers:
+            continue
+        payload = json.dumps(frame, ensure_ascii=False)
+        results = await asyncio.gather(
+            *(asyncio.wait_for(client_ws.send_text(payload), timeout=STREAM_SEND_TIMEOUT_SECONDS)
+              for _, client_ws in observers),
+            return_exceptions=True
+        )
+        for (user_id, client_ws), result in zip(observers, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to send {frame['type']} frame to user_id {user_id} for session_id {session_id}: {result!r}")
+                clients = connected_clients.get(session_id, {}).get(user_id)
+                if clients and client_ws in clients:
+                    clients.remove(client_ws)
+
 @app.post("/conversations")
 async def add_message(message: Message, token: str = Body(...)):
     user = verify_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    await restore_archived_session(message.session_id)
     cursor.execute(
         "INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (%s, %s, %s, %s, %s)",
         (message.session_id, message.role, message.content, message.timestamp,
         1 if message.role in ["assistant", "teacher"] else 0)
     )
+    record_message(cursor, message.session_id, get_session_class(message.session_id),
+                   message.role, message.content, message.timestamp)
     conn.commit()
+    read_router.note_write(("session", message.session_id), ("student", get_session_owner(message.session_id)))
 
     print(f"Saved message to database: session_id={message.session_id}, role={message.role}, content={message.content}")
+    model_router.note_message(message.session_id, message.role)
     if message.role == "user":
-        cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (message.session_id,))
-        session = cursor.fetchone()
-        if session:
-            student_id = session[0]
+        student_id = get_session_owner(message.session_id)
+        if student_id is not None:
             print(f"Broadcasting new message for student_id={student_id}, session_id={message.session_id}")
             await broadcast_message_to_teachers(student_id, message.session_id, message.timestamp)
 
@@ -472,8 +1270,8 @@ async def chatbot(request: ChatRequest = Body(...), token: str = Query(...)):
         if not request.ai_enabled:
             raise HTTPException(status_code=400, detail="AI is disabled")
 
-        if not client:
-            print("Chatbot error: Groq client not initialized")
+        if not llm.available() and not fallback.enabled:
+            print("Chatbot error: no LLM provider configured")
             raise HTTPException(status_code=500, detail="AI service unavailable")
 
         system_prompt = {
@@ -488,41 +1286,113 @@ async def chatbot(request: ChatRequest = Body(...), token: str = Query(...)):
 """
         }
 
+        # Daily token budgets (usage_budgets.json): over budget means shorter answers or the cheaper route
+        student_id = get_session_owner(request.session_id)
+        class_name = get_session_class(request.session_id)
+        budget = usage_tracker.check(class_name, student_id)
+        if budget.level == "blocked":
+            print(f"Chatbot blocked: {budget.scope} token budget used up ({budget.used}/{budget.limit}) for session_id {request.session_id}")
+            raise HTTPException(status_code=429, detail=BUDGET_BLOCKED_MESSAGE)
+
         valid_roles = {"system", "user", "assistant"}
         messages = [system_prompt]
         for m in request.messages:
             role = m.role if m.role in valid_roles else "user"
             messages.append({"role": role, "content": m.content})
 
+        route, args = usage_tracker.apply(budget, model_router.choose(messages), model_router)
+        # The prompt is estimated before anything goes upstream: too long for the prompt limit or for
+        # what is left of a blocking budget, it loses older turns or the request is refused. Its tokens
+        # stay reserved against the budgets until the real usage is recorded.
+        try:
+            messages, args, reservation = usage_tracker.admit(class_name, student_id, messages, args)
+        except PromptTooLong as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except BudgetExceeded as e:
+            print(f"Chatbot blocked: prompt does not fit the remaining token budget for session_id {request.session_id}")
+            raise HTTPException(status_code=429, detail=str(e))
+
         async def generate():
             full_reply = ""
+            frames = asyncio.Queue()
+            fan_out = asyncio.create_task(fan_out_stream_frames(request.session_id, student_id, frames))
+            seq = 0
+            route_call = model_router.start(route, request.session_id)
+            upstream = traffic_capture.UpstreamTiming(route)
+            finish_reason = None
+            usage = None
+            # No provider, or too many streams already waiting upstream: answer locally right away
+            fallback_reason = fallback.reason(llm)
+
+            def delta(content):
+                nonlocal seq
+                if request.session_id in connected_clients:
+                    frames.put_nowait({
+                        "type": "delta",
+                        "session_id": request.session_id,
+                        "role": "assistant",
+                        "seq": seq,
+                        "content": content
+                    })
+                seq += 1
+                return f"data: {content}\n\n".encode('utf-8')
+
             try:
-                print(f"Starting Groq stream for session_id: {request.session_id}")
-                print(f"Messages sent to Groq: {json.dumps(messages, ensure_ascii=False)}")
-                stream = client.chat.completions.create(
-                    model="openai/gpt-oss-120b",
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=1024,
-                    top_p=1,
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
+                if fallback_reason is None:
+                    print(f"Starting LLM stream for session_id: {request.session_id} on route {route}")
+                    print(f"Messages sent to LLM: {json.dumps(messages, ensure_ascii=False)}")
+                    try:
+                        async for chunk in llm.stream_chat(messages, args):
+                            finish_reason = chunk.finish_reason or finish_reason
+                            usage = chunk.usage or usage
+                            if chunk.content:
+                                content = chunk.content
+                                full_reply += content
+                                route_call.add_output(content)
+                                upstream.chunk(content, chunk.provider)
+                                print(f"Streaming chunk: {content}")
+                                yield delta(content)
+                        route_call.finish(finish_reason)
+                        upstream.finish(finish_reason)
+                    except NoProviderAvailable as e:
+                        # Raised before the first token (all circuits open, every provider failed
+                        # or timed out), so the student has seen nothing yet
+                        route_call.fail()
+                        upstream.finish(None, error=type(e).__name__)
+                        if not fallback.enabled:
+                            raise
+                        print(f"LLM unavailable for session_id {request.session_id}: {str(e)}")
+                        fallback_reason = "upstream_unavailable"
+                if fallback_reason is not None:
+                    answer = fallback.answer(messages, fallback_reason)
+                    print(f"Fallback answer ({fallback_reason}) for session_id {request.session_id}: "
+                          f"entry={answer.entry_id} score={answer.score:.2f} retrieval={answer.retrieval_ms:.2f}ms")
+                    async for content in stream_chunks(answer.text):
                         full_reply += content
-                        print(f"Streaming chunk: {content}")
-                        yield f"data: {content}\n\n".encode('utf-8')
-                        await asyncio.sleep(0)
+                        yield delta(content)
                 print(f"Full AI reply: {full_reply}")
                 timestamp = datetime.now(timezone.utc).isoformat()
                 try:
+                    await restore_archived_session(request.session_id)
                     cursor.execute(
-                        "INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (%s, %s, %s, %s, %s)",
+                        "INSERT INTO conversations (session_id, role, content, timestamp, read_by_teacher) VALUES (%s, %s, %s, %s, %s) RETURNING id",
                         (request.session_id, "assistant", full_reply, timestamp, 1)
                     )
+                    message_id = cursor.fetchone()[0]
+                    record_message(cursor, request.session_id, get_session_class(request.session_id),
+                                   "assistant", full_reply, timestamp)
                     conn.commit()
+                    read_router.note_write(("session", request.session_id), ("student", student_id))
                     print(f"Saved AI response to database for session_id: {request.session_id}")
+                    frames.put_nowait({
+                        "type": "done",
+                        "session_id": request.session_id,
+                        "role": "assistant",
+                        "message_id": message_id,
+                        "seq": seq,
+                        "content": full_reply,
+                        "timestamp": timestamp
+                    })
                     broadcast_message = {
                         "session_id": request.session_id,
                         "role": "assistant",
@@ -530,24 +1400,39 @@ async def chatbot(request: ChatRequest = Body(...), token: str = Query(...)):
                         "timestamp": timestamp
                     }
                     await broadcast_message_to_clients(request.session_id, broadcast_message)
-                    cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (request.session_id,))
-                    session = cursor.fetchone()
-                    if session:
-                        student_id = session[0]
+                    if student_id is not None:
                         print(f"Broadcasting AI response to teachers for student_id={student_id}, session_id={request.session_id}")
                         await broadcast_message_to_teachers(student_id, request.session_id, timestamp)
                 except Exception as db_e:
                     print(f"Database error: {str(db_e)}")
                     raise HTTPException(status_code=500, detail=f"Database error: {str(db_e)}")
             except Exception as e:
+                if fallback_reason is None:
+                    route_call.fail()
+                upstream.finish(finish_reason, error=type(e).__name__)
                 error_msg = f"Error in chatbot streaming: {str(e)}"
                 print(error_msg)
+                frames.put_nowait({"type": "error", "session_id": request.session_id, "seq": seq, "detail": error_msg})
                 yield f"data: {error_msg}\n\n".encode('utf-8')
                 if "400" in str(e):
                     raise HTTPException(status_code=400, detail=f"Invalid request to AI: {str(e)}")
                 raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
-
-        return StreamingResponse(generate(), media_type="text/event-stream")
+            finally:
+                # Tokens count even when the stream broke or the student left mid-answer
+                if fallback_reason is None and (full_reply or usage):
+                    usage_tracker.record(class_name, student_id, request.session_id, args["model"],
+                                         messages, full_reply, usage)
+                reservation.release()
+                frames.put_nowait(None)
+                try:
+                    await asyncio.wait_for(fan_out, timeout=STREAM_SEND_TIMEOUT_SECONDS)
+                except Exception as fan_out_e:
+                    print(f"Stream fan-out for session_id {request.session_id} did not finish cleanly: {fan_out_e!r}")
+
+        stream = generate()
+        # A body that never starts never reaches the finally above; the reservation goes back here
+        weakref.finalize(stream, reservation.release)
+        return StreamingResponse(stream, media_type="text/event-stream")
     except HTTPException as http_exc:
         print(f"HTTPException in /chatbot: {str(http_exc)}")
         raise
@@ -567,18 +1452,18 @@ async def websocket_endpoint(websocket: WebSocket, session_id: int, token: str):
     user_type = user["user_type"]
     print(f"WebSocket attempt: session_id={session_id}, user_id={user_id}, user_type={user_type}")
 
-    cursor.execute("SELECT student_id FROM chat_sessions WHERE id = %s", (session_id,))
-    session = cursor.fetchone()
-    if not session:
+    session_student_id = get_session_owner(session_id)
+    if session_student_id is None:
         await websocket.close(code=1008)
         print(f"WebSocket connection rejected: Session not found for session_id {session_id}")
         return
-    if user_type == "student" and session[0] != user_id:
+    if user_type == "student" and session_student_id != user_id:
         await websocket.close(code=1008)
-        print(f"WebSocket connection rejected: Unauthorized access for session_id {session_id}, user_id {user_id}, session_student_id={session[0]}")
+        print(f"WebSocket connection rejected: Unauthorized access for session_id {session_id}, user_id {user_id}, session_student_id={session_student_id}")
         return
 
     await websocket.accept()
+    websocket.state.user_type = user_type
     print(f"WebSocket accepted for session_id: {session_id}, user_id: {user_id}")
 
     if session_id not in connected_clients:
@@ -636,6 +1521,7 @@ async def mark_read(session_id: int, token: str):
     cursor.execute("UPDATE conversations SET read_by_teacher = 1 WHERE session_id = %s AND role = 'user' AND read_by_teacher = 0",
                     (session_id,))
     conn.commit()
+    read_router.note_write(("session", session_id), ("student", get_session_owner(session_id)))
     return {"status": "ok"}
 
 @app.get("/unread/{student_id}")
@@ -643,36 +1529,39 @@ async def get_unread(student_id: int, token: str):
     user = verify_token(token)
     if not user or user["user_type"] != "teacher":
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("""
+    reader = read_router.cursor(("student", student_id))
+    reader.execute("""
     SELECT COUNT(*) FROM conversations 
     WHERE session_id IN (SELECT id FROM chat_sessions WHERE student_id = %s) 
     AND role = 'user' AND read_by_teacher = 0
     """, (student_id,))
-    count = cursor.fetchone()[0]
-    return {"unread": count > 0}
+    count = reader.fetchone()[0]
+    # Archived sessions are not counted; they had been idle for CONVERSATION_ARCHIVE_AFTER_DAYS
+    return {"unread": count > 0, "archived_sessions": count_archived_sessions(reader, student_id=student_id)}
 
 @app.get("/last_message/{student_id}")
 async def get_last_message(student_id: int, token: str):
     user = verify_token(token)
     if not user or user["user_type"] != "teacher":
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("""
+    reader = read_router.cursor(("student", student_id))
+    reader.execute("""
     SELECT MAX(timestamp) FROM conversations 
     WHERE session_id IN (SELECT id FROM chat_sessions WHERE student_id = %s) 
     AND role = 'user'
     """, (student_id,))
-    result = cursor.fetchone()[0]
-    return {"last_time": result or "N/A"}
+    result = reader.fetchone()[0]
+    # Only hot sessions: a student whose sessions are all archived shows "N/A" with archived_sessions > 0
+    return {"last_time": result or "N/A", "archived_sessions": count_archived_sessions(reader, student_id=student_id)}
 
 @app.get("/student/{student_id}")
 async def get_student(student_id: int, token: str):
     user = verify_token(token)
     if not user or (user["user_type"] == "student" and user["user_id"] != student_id):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT id, name, class, gvcn FROM students WHERE id = %s", (student_id,))
-    student = cursor.fetchone()
+    student = get_student_profile(student_id)
     if student:
-        return {"id": student[0], "name": student[1], "class": student[2], "gvcn": student[3]}
+        return dict(student)
     raise HTTPException(status_code=404, detail="Student not found")
 
 @app.get("/student/{student_id}/latest_session")
@@ -680,10 +1569,8 @@ async def get_latest_session(student_id: int, token: str):
     user = verify_token(token)
     if not user or (user["user_type"] == "student" and user["user_id"] != student_id):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    cursor.execute("SELECT id FROM chat_sessions WHERE student_id = %s ORDER BY created_at DESC LIMIT 1",
-                    (student_id,))
-    session = cursor.fetchone()
-    return {"session_id": session[0] if session else None}
+    sessions = get_session_list(student_id)
+    return {"session_id": sessions[0]["id"] if sessions else None}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,281 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+
+# Read replicas as "host:port,host:port" (same database, user and password as the primary).
+# Empty means every query runs on the primary, as before.
+DB_REPLICA_HOSTS = os.environ.get("DB_REPLICA_HOSTS", "")
+DB_REPLICA_CHECK_SECONDS = float(os.environ.get("DB_REPLICA_CHECK_SECONDS", "5"))
+DB_REPLICA_CONNECT_TIMEOUT = int(os.environ.get("DB_REPLICA_CONNECT_TIMEOUT", "3"))
+# A replica further behind the primary than this is skipped until it catches up
+DB_REPLICA_MAX_LAG_BYTES = int(os.environ.get("DB_REPLICA_MAX_LAG_BYTES", str(16 * 1024 * 1024)))
+# How long a write is remembered for read-your-writes; replicas are normally well under a second behind
+DB_READ_YOUR_WRITES_SECONDS = float(os.environ.get("DB_READ_YOUR_WRITES_SECONDS", "60"))
+MAX_TRACKED_WRITES = 50000
+# The catch-up query runs on the event loop, so a replica slower than this is skipped for the read
+DB_REPLICA_CATCH_UP_TIMEOUT_MS = int(os.environ.get("DB_REPLICA_CATCH_UP_TIMEOUT_MS", "100"))
+# Required position of a write whose own position could not be read: only the primary has it
+PRIMARY_ONLY = 1 << 64
+
+# Errors after which a replica connection is not trusted any more (the query is re-run on the primary)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+REPLAY_LSN_SQL = "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END"
+
+
+def parse_lsn(lsn: Optional[str]) -> int:
+    # "16/B374D848" -> byte position in the WAL
+    if not lsn:
+        return 0
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def parse_hosts(value: str) -> List[Tuple[str, str]]:
+    hosts = []
+    for item in value.split(","):
+        item = item.strip()
+        if item:
+            host, _, port = item.partition(":")
+            hosts.append((host, port or "5432"))
+    return hosts
+
+
+class Replica:
+    def __init__(self, host: str, port: str):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.conn = None
+        # Set by the request path when a query fails; the next check() reconnects
+        self.broken = False
+        self.healthy = False
+        self.replay_lsn = 0
+        self.lag_bytes: Optional[int] = None
+        self.reads = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[str] = None
+
+    def fail(self, error: Exception):
+        self.healthy = False
+        self.broken = True
+        self.errors += 1
+        self.last_error = str(error).strip()
+        self.last_error_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag_bytes": self.lag_bytes,
+            "reads": self.reads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+        }
+
+
+class ReadCursor:
+    # Cursor for the reads of one request: on a replica that has every write the request depends
+    # on, otherwise on the primary. A replica that fails mid-request is dropped for the rest of it.
+    def __init__(self, router: "ReadRouter", replica: Optional[Replica]):
+        self.router = router
+        self.replica = replica
+        self.cursor = replica.conn.cursor() if replica is not None else router.primary_cursor
+
+    def execute(self, sql: str, params=None):
+        if self.replica is not None:
+            try:
+                self.cursor.execute(sql, params)
+                self.replica.reads += 1
+                return
+            except (psycopg2.extensions.TransactionRollbackError, psycopg2.extensions.QueryCanceledError) as e:
+                # Query cancelled by a recovery conflict on the replica: the connection is still fine
+                self.replica.errors += 1
+                self.replica.last_error = str(e).strip()
+            except CONNECTION_ERRORS as e:
+                print(f"Replica {self.replica.name} failed, reading from the primary: {str(e).strip()}")
+                self.replica.fail(e)
+            self.replica = None
+            self.cursor = self.router.primary_cursor
+            self.router.replica_failovers += 1
+        self.cursor.execute(sql, params)
+        self.router.primary_reads += 1
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class ReadRouter:
+    # Sends read-only queries to replicas. Read-your-writes: after a write the caller records the
+    # primary's WAL position under the keys it touched (("session", id), ("student", id), ...);
+    # a read of one of those keys only uses a replica that has replayed past that position.
+    # Writes are tracked per process, so with several workers a read can still land on a replica
+    # that has not seen another worker's write for up to the replica lag.
+    def __init__(self, primary_cursor, hosts: List[Tuple[str, str]], connect: Callable):
+        self.primary_cursor = primary_cursor
+        self.replicas = [Replica(host, port) for host, port in hosts]
+        self.connect = connect
+        self._written: Dict[tuple, Tuple[int, float]] = {}
+        # Keys written whose WAL position is still being read: reads of them stay on the primary
+        self._unresolved: Dict[tuple, float] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        # Autocommit connection (re)opened by check() and read by the WAL position thread, never on
+        # the event loop; _primary_lock serializes the two
+        self._primary = None
+        self._primary_lock = threading.Lock()
+        self._wake = threading.Event()
+        if self.replicas:
+            threading.Thread(target=self._resolve_writes, name="replica-write-lsn", daemon=True).start()
+        self.primary_reads = 0
+        self.replica_failovers = 0
+        self.read_your_writes = 0
+        self.stale_skips = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def note_write(self, *keys):
+        # Call after conn.commit() of a write that later reads of these keys must see. No query here:
+        # the keys read from the primary until the replica-write-lsn thread has the commit's position.
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._written) >= MAX_TRACKED_WRITES:
+                self._written = {k: v for k, v in self._written.items() if now - v[1] < DB_READ_YOUR_WRITES_SECONDS}
+            for key in keys:
+                self._unresolved[key] = now
+        self._wake.set()
+
+    def _resolve_writes(self):
+        # One WAL position read covers every write noted since the last one; it is taken after
+        # those commits returned, so it is at or past each of them
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                unresolved, self._unresolved = self._unresolved, {}
+            lsn = self._primary_lsn()
+            with self._lock:
+                for key, at in unresolved.items():
+                    self._written[key] = (lsn, at)
+
+    def _primary_lsn(self) -> int:
+        # Asked on the autocommit connection: on the shared cursor the SELECT would open a new
+        # transaction and leave that connection idle in it until the next request commits
+        with self._primary_lock:
+            primary = self._primary
+            if primary is not None and not primary.closed:
+                try:
+                    with primary.cursor() as cur:
+                        cur.execute("SELECT pg_current_wal_lsn()")
+                        return parse_lsn(cur.fetchone()[0])
+                except CONNECTION_ERRORS as e:
+                    print(f"Could not read the primary's WAL position, reading from the primary: {str(e).strip()}")
+        return PRIMARY_ONLY
+
+    def required_lsn(self, keys) -> int:
+        now = time.monotonic()
+        with self._lock:
+            if any(key in self._unresolved for key in keys):
+                return PRIMARY_ONLY
+            written = [self._written.get(key) for key in keys]
+        return max((lsn for lsn, at in filter(None, written) if now - at < DB_READ_YOUR_WRITES_SECONDS), default=0)
+
+    def cursor(self, *keys) -> ReadCursor:
+        if not self.enabled:
+            return ReadCursor(self, None)
+        required = self.required_lsn(keys)
+        if required:
+            self.read_your_writes += 1
+        if required >= PRIMARY_ONLY:
+            return ReadCursor(self, None)
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if not replica.healthy or replica.conn is None:
+                continue
+            if replica.replay_lsn < required and not self._catch_up(replica, required):
+                self.stale_skips += 1
+                continue
+            return ReadCursor(self, replica)
+        return ReadCursor(self, None)
+
+    def _catch_up(self, replica: Replica, required: int) -> bool:
+        # The replay position from the last check is older than the write; ask the replica again.
+        # This runs on the request path, so the query gets DB_REPLICA_CATCH_UP_TIMEOUT_MS in the same
+        # round trip (both statements share one implicit transaction) and a slow replica is skipped.
+        try:
+            with replica.conn.cursor() as cur:
+                cur.execute(f"SET LOCAL statement_timeout = {DB_REPLICA_CATCH_UP_TIMEOUT_MS}; {REPLAY_LSN_SQL}")
+                replica.replay_lsn = parse_lsn(cur.fetchone()[0])
+        except psycopg2.extensions.QueryCanceledError:
+            return False
+        except CONNECTION_ERRORS as e:
+            replica.fail(e)
+            return False
+        return replica.replay_lsn >= required
+
+    def check(self):
+        # Runs in a worker thread every DB_REPLICA_CHECK_SECONDS: (re)connects replicas and
+        # compares their replay position with the primary's
+        try:
+            with self._primary_lock:
+                if self._primary is None or self._primary.closed:
+                    self._primary = self.connect(connect_timeout=DB_REPLICA_CONNECT_TIMEOUT)
+                    self._primary.autocommit = True
+                with self._primary.cursor() as cur:
+                    cur.execute("SELECT pg_current_wal_lsn()")
+                    primary_lsn = parse_lsn(cur.fetchone()[0])
+        except Exception as e:
+            print(f"Replica check could not reach the primary: {str(e).strip()}")
+            with self._primary_lock:
+                self._primary = None
+            return
+        for replica in self.replicas:
+            try:
+                if replica.conn is None or replica.broken or replica.conn.closed:
+                    if replica.conn is not None:
+                        replica.conn.close()
+                    replica.conn = None
+                    conn = self.connect(host=replica.host, port=replica.port, connect_timeout=DB_REPLICA_CONNECT_TIMEOUT)
+                    conn.set_session(readonly=True, autocommit=True)
+                    replica.conn = conn
+                    replica.broken = False
+                with replica.conn.cursor() as cur:
+                    cur.execute(REPLAY_LSN_SQL)
+                    replica.replay_lsn = parse_lsn(cur.fetchone()[0])
+                replica.lag_bytes = max(primary_lsn - replica.replay_lsn, 0)
+                healthy = replica.lag_bytes <= DB_REPLICA_MAX_LAG_BYTES
+                if healthy != replica.healthy:
+                    print(f"Replica {replica.name} {'in use' if healthy else 'skipped'} (lag {replica.lag_bytes} bytes)")
+                replica.healthy = healthy
+            except Exception as e:
+                if replica.healthy or replica.errors == 0:
+                    print(f"Replica {replica.name} unavailable: {str(e).strip()}")
+                replica.fail(e)
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [r.stats() for r in self.replicas],
+            "primary_reads": self.primary_reads,
+            "replica_reads": sum(r.reads for r in self.replicas),
+            "read_your_writes_checks": self.read_your_writes,
+            "stale_replica_skips": self.stale_skips,
+            "replica_failovers": self.replica_failovers,
+            "tracked_writes": len(self._written),
+            "unresolved_writes": len(self._unresolved),
+        }
+
+
+def load_router(primary_cursor, connect: Callable, hosts: str = DB_REPLICA_HOSTS) -> ReadRouter:
+    return ReadRouter(primary_cursor, parse_hosts(hosts), connect)
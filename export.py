@@ -0,0 +1,98 @@
+import csv
+import importlib.util
+import io
+import json
+from typing import Iterable, Iterator, List, Sequence
+
+EXPORT_COLUMNS = [
+    "message_id", "session_id", "session_title", "student_id", "student_name", "class", "gvcn",
+    "role", "content", "timestamp", "read_by_teacher",
+]
+
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def parquet_available() -> bool:
+    # pyarrow is optional and heavy, so it is only imported when a Parquet export runs
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def csv_chunks(batches: Iterable[Sequence[tuple]]) -> Iterator[bytes]:
+    # The BOM lets Excel open Vietnamese text as UTF-8
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Header only: no rows matched
+        yield buffer.getvalue().encode("utf-8")
+
+
+def jsonl_chunks(batches: Iterable[Sequence[tuple]]) -> Iterator[bytes]:
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+                      for row in rows).encode("utf-8")
+
+
+# Write-only file object that hands out whatever Parquet wrote since the last call
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_chunks(batches: Iterable[Sequence[tuple]]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # One row group per fetched batch, so memory stays at one batch
+    schema = pa.schema([
+        ("message_id", pa.int64()), ("session_id", pa.int64()), ("session_title", pa.string()),
+        ("student_id", pa.int64()), ("student_name", pa.string()), ("class", pa.string()), ("gvcn", pa.string()),
+        ("role", pa.string()), ("content", pa.string()), ("timestamp", pa.string()), ("read_by_teacher", pa.int32()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(fmt: str, batches: Iterable[Sequence[tuple]]) -> Iterator[bytes]:
+    if fmt == "parquet":
+        return parquet_chunks(batches)
+    if fmt == "jsonl":
+        return jsonl_chunks(batches)
+    return csv_chunks(batches)
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from search import TOKEN_RE, tokenize
+
+SCAM_SAFETY_KB_PATH = os.environ.get("SCAM_SAFETY_KB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scam_safety_kb.json"))
+# Upstream counts as saturated once this many LLM streams are open in this process; 0 turns the check off
+FALLBACK_MAX_UPSTREAM_STREAMS = int(os.environ.get("FALLBACK_MAX_UPSTREAM_STREAMS", "48"))
+# Below this BM25 score, or with less than FALLBACK_MIN_COVERAGE of the question's words found in
+# the entry, the question gets the general answer instead of a wrong entry
+FALLBACK_MIN_SCORE = float(os.environ.get("FALLBACK_MIN_SCORE", "3.0"))
+FALLBACK_MIN_COVERAGE = float(os.environ.get("FALLBACK_MIN_COVERAGE", "0.5"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+STREAM_WORDS_PER_CHUNK = 3
+
+# Syllables that say nothing about the topic once accents are folded ("cô ơi em là gì", ...)
+STOPWORDS = {"a", "ai", "bao", "ban", "cac", "cai", "cho", "chu", "co", "cua", "da", "de", "di", "do", "duoc", "em",
+             "gi", "hay", "khi", "khong", "la", "lam", "ma", "minh", "mot", "nao", "nay", "nhe", "nhu", "nhung", "oi",
+             "phai", "roi", "sao", "se", "thi", "the", "toi", "tu", "va", "vay", "ve", "voi", "vi", "ya"}
+
+# Templates in Cô Hương's voice: a warm opening, the entry, then the advice she always ends with
+OPENINGS = [
+    "Cô chào em 🙂 Câu em hỏi về **{title}** rất đáng để ý đấy.",
+    "Em hỏi đúng chỗ rồi 😉 Cô nói nhanh về **{title}** nhé.",
+    "Cảm ơn em đã hỏi cô về **{title}** 🙂",
+]
+ADVICE = "👉 **Lời khuyên của cô:** {advice}"
+NO_MATCH = (
+    "Cô chào em 🙂 Câu này cô chưa có câu trả lời soạn sẵn, cô giáo sẽ đọc và trả lời em sau nhé.\n\n"
+    "Trong lúc chờ, em nhớ mấy điều quen thuộc: không đọc mã OTP cho ai, không bấm link lạ, "
+    "không chuyển tiền khi bị giục giã hay doạ dẫm, và luôn hỏi bố mẹ, thầy cô khi thấy điều gì bất thường."
+)
+NO_MATCH_ADVICE = "Thấy nghi ngờ thì dừng lại, kiểm tra và hỏi người lớn trước khi làm theo bất kỳ ai."
+NOTICE = "_(Hệ thống AI đang bận nên cô trả lời nhanh từ sổ tay an toàn thông tin. Em cần hỏi kỹ hơn thì cô giáo sẽ xem tin nhắn của em sau nhé!)_"
+
+
+def terms(text: str) -> List[str]:
+    # Accent-folded syllables so unaccented questions match, adjacent pairs so "tài khoản" also
+    # matches as one phrase, and the accented syllables so "mượn" and "muốn" still differ
+    tokens = tokenize(text.lower())
+    accented = [t for t, folded in zip(TOKEN_RE.findall(text.lower()), tokens) if t != folded and folded not in STOPWORDS]
+    words = [t for t in tokens if t not in STOPWORDS]
+    return words + accented + [f"{a}_{b}" for a, b in zip(tokens, tokens[1:]) if a not in STOPWORDS or b not in STOPWORDS]
+
+
+class FallbackAnswer:
+    def __init__(self, text: str, entry_id: Optional[str], score: float, retrieval_ms: float):
+        self.text = text
+        self.entry_id = entry_id
+        self.score = score
+        self.retrieval_ms = retrieval_ms
+
+
+class FallbackEngine:
+    # BM25 over a small curated knowledge base (scam_safety_kb.json), kept in memory. Used by
+    # /chatbot when no LLM provider can take the request; answers are built from templates.
+    def __init__(self, entries: List[dict]):
+        self.entries = entries
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.lengths: List[int] = []
+        self.vocabularies: List[set] = []
+        for doc_id, entry in enumerate(entries):
+            # Titles, keywords and sample questions describe what an entry is about better than its
+            # answer text, so they count twice
+            about = " ".join([entry["title"], *entry.get("keywords", []), *entry.get("questions", [])])
+            doc_terms = terms(about) * 2 + terms(entry["answer"])
+            counts: Dict[str, int] = defaultdict(int)
+            for term in doc_terms:
+                counts[term] += 1
+            for term, count in counts.items():
+                self.postings[term].append((doc_id, count))
+            self.lengths.append(len(doc_terms))
+            self.vocabularies.append(set(counts))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        self.idf = {term: math.log(1 + (len(entries) - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+        self._lock = threading.Lock()
+        self.answers = 0
+        self.misses = 0
+        self.reasons: Dict[str, int] = defaultdict(int)
+        self.retrieval_ms_total = 0.0
+        self.retrieval_ms_max = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.entries)
+
+    def search(self, text: str) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(terms(text)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / self.avg_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def best(self, text: str) -> Tuple[Optional[int], float]:
+        # The top entry if it is a confident match for the question
+        hits = self.search(text)
+        if not hits or hits[0][1] < FALLBACK_MIN_SCORE:
+            return None, hits[0][1] if hits else 0.0
+        doc_id, score = hits[0]
+        words = {t for t in tokenize(text.lower()) if t not in STOPWORDS}
+        if len(words & self.vocabularies[doc_id]) < FALLBACK_MIN_COVERAGE * len(words):
+            return None, score
+        return doc_id, score
+
+    def reason(self, pool) -> Optional[str]:
+        # Why /chatbot should skip the LLM for this request, or None to call it as usual
+        if not self.enabled:
+            return None
+        if not pool.available():
+            return "no_provider"
+        if FALLBACK_MAX_UPSTREAM_STREAMS and pool.in_flight >= FALLBACK_MAX_UPSTREAM_STREAMS:
+            return "saturated"
+        return None
+
+    def answer(self, messages: List[dict], reason: str) -> FallbackAnswer:
+        started = time.perf_counter()
+        questions = [m["content"] for m in messages if m.get("role") == "user" and m.get("content")]
+        doc_id, score = self.best(questions[-1]) if questions else (None, 0.0)
+        if doc_id is None and len(questions) > 1:
+            # Short follow-ups ("thế phải làm sao ạ?") take their topic from the previous question
+            doc_id, score = self.best(questions[-2])
+        retrieval_ms = (time.perf_counter() - started) * 1000
+        if doc_id is not None:
+            entry = self.entries[doc_id]
+            seed = int(hashlib.md5(questions[-1].encode("utf-8")).hexdigest(), 16)
+            text = "\n\n".join([OPENINGS[seed % len(OPENINGS)].format(title=entry["title"]),
+                                entry["answer"], ADVICE.format(advice=entry["advice"]), NOTICE])
+            result = FallbackAnswer(text, entry["id"], score, retrieval_ms)
+        else:
+            text = "\n\n".join([NO_MATCH, ADVICE.format(advice=NO_MATCH_ADVICE), NOTICE])
+            result = FallbackAnswer(text, None, score, retrieval_ms)
+        with self._lock:
+            self.answers += 1
+            self.misses += 1 if result.entry_id is None else 0
+            self.reasons[reason] += 1
+            self.retrieval_ms_total += retrieval_ms
+            self.retrieval_ms_max = max(self.retrieval_ms_max, retrieval_ms)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "terms": len(self.postings),
+                "answers": self.answers,
+                "misses": self.misses,
+                "reasons": dict(self.reasons),
+                "avg_retrieval_ms": round(self.retrieval_ms_total / self.answers, 3) if self.answers else None,
+                "max_retrieval_ms": round(self.retrieval_ms_max, 3),
+                "max_upstream_streams": FALLBACK_MAX_UPSTREAM_STREAMS,
+            }
+
+
+def split_chunks(text: str) -> Iterator[str]:
+    # A few words per chunk, with their trailing whitespace, like the deltas an LLM streams
+    words = re.findall(r"\S+\s*", text)
+    for i in range(0, len(words), STREAM_WORDS_PER_CHUNK):
+        yield "".join(words[i:i + STREAM_WORDS_PER_CHUNK])
+
+
+async def stream_chunks(text: str):
+    for chunk in split_chunks(text):
+        yield chunk
+        # Let other requests run between chunks; the whole answer is already in memory
+        await asyncio.sleep(0)
+
+
+def load_config(path: str = SCAM_SAFETY_KB_PATH) -> dict:
+    if not os.path.exists(path):
+        print(f"Fallback answers disabled: {path} not found")
+        return {"entries": []}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_engine(path: str = SCAM_SAFETY_KB_PATH) -> FallbackEngine:
+    return FallbackEngine(load_config(path)["entries"])
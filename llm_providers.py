@@ -0,0 +1,370 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+LLM_PROVIDERS_PATH = os.environ.get("LLM_PROVIDERS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_providers.json"))
+
+# Used when llm_providers.json is missing: Groq with the key the app always used
+DEFAULT_CONFIG = {
+    "providers": [
+        {"name": "groq", "base_url": "https://api.groq.com/openai/v1", "api_key_env": "OPENAI_API_KEY"},
+    ],
+    "first_token_timeout_seconds": 10,
+    "read_timeout_seconds": 30,
+    "hedge_after_ms": 0,
+    "circuit": {"failure_threshold": 3, "open_seconds": 30},
+}
+
+
+class ProviderError(Exception):
+    def __init__(self, provider: str, detail: str, status_code: Optional[int] = None):
+        super().__init__(f"{provider} returned {status_code}: {detail}" if status_code else f"{provider}: {detail}")
+        self.provider = provider
+        self.status_code = status_code
+
+
+class NoProviderAvailable(Exception):
+    # Every provider failed before the first token, or all circuits are open
+    def __init__(self, errors: List[str]):
+        super().__init__("No LLM provider available" + (f" ({'; '.join(errors)})" if errors else ""))
+        self.errors = errors
+
+
+class StreamChunk:
+    def __init__(self, content: Optional[str], finish_reason: Optional[str] = None, usage: Optional[dict] = None,
+                 provider: Optional[str] = None, reasoning: Optional[str] = None):
+        self.content = content
+        # Reasoning models (gpt-oss) stream their thinking before any content; not shown to students
+        self.reasoning = reasoning
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.provider = provider
+
+
+class CircuitBreaker:
+    # closed -> (failure_threshold failures in a row) -> open -> (open_seconds) -> half_open:
+    # one trial request, which closes the circuit on success or reopens it on failure
+    def __init__(self, failure_threshold: int, open_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.trial_running:
+                return False
+            self.trial_running = True
+        return self.state != "open"
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # The request ended without telling us anything (lost a hedge race, client went away)
+        self.trial_running = False
+
+
+class Provider:
+    def __init__(self, config: dict, breaker: CircuitBreaker):
+        self.name: str = config["name"]
+        self.base_url: str = config["base_url"].rstrip("/")
+        self.api_key: Optional[str] = os.environ.get(config["api_key_env"]) if config.get("api_key_env") else config.get("api_key")
+        # Route model name -> this provider's name for the same model
+        self.models: Dict[str, str] = config.get("models", {})
+        self.supports_reasoning_effort: bool = config.get("supports_reasoning_effort", True)
+        # Ask for a final usage chunk (OpenAI stream_options); Groq sends x_groq.usage without it
+        self.include_usage: bool = config.get("include_usage", False)
+        self.breaker = breaker
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.hedges = 0
+        self.first_token_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[str] = None
+
+    def request_body(self, messages: List[dict], args: dict) -> dict:
+        body = dict(args, messages=messages, stream=True)
+        body["model"] = self.models.get(args["model"], args["model"])
+        if not self.supports_reasoning_effort:
+            body.pop("reasoning_effort", None)
+        if self.include_usage:
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    async def stream(self, http: httpx.AsyncClient, messages: List[dict], args: dict) -> AsyncIterator[StreamChunk]:
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        async with http.stream("POST", f"{self.base_url}/chat/completions", json=self.request_body(messages, args),
+                               headers=headers) as response:
+            if response.status_code != 200:
+                detail = (await response.aread()).decode("utf-8", "replace")[:300]
+                raise ProviderError(self.name, detail, response.status_code)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                event = json.loads(data)
+                if event.get("error"):
+                    raise ProviderError(self.name, json.dumps(event["error"], ensure_ascii=False)[:300])
+                # Groq reports token usage under x_groq on the last chunk
+                usage = event.get("usage") or (event.get("x_groq") or {}).get("usage")
+                choices = event.get("choices") or []
+                if not choices:
+                    if usage:
+                        yield StreamChunk(None, None, usage, self.name)
+                    continue
+                delta = choices[0].get("delta") or {}
+                yield StreamChunk(delta.get("content"), choices[0].get("finish_reason"), usage, self.name,
+                                  delta.get("reasoning") or delta.get("reasoning_content"))
+
+    def record_first_token(self, seconds: float):
+        ms = seconds * 1000
+        self.first_token_ms = ms if self.first_token_ms is None else self.first_token_ms * 0.8 + ms * 0.2
+
+    def record_error(self, error: str, timeout: bool = False):
+        self.failures += 1
+        if timeout:
+            self.timeouts += 1
+        self.last_error = error
+        self.last_error_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        self.breaker.record_failure()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "hedges": self.hedges,
+            "avg_first_token_ms": round(self.first_token_ms, 1) if self.first_token_ms is not None else None,
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+        }
+
+
+class _Attempt:
+    # One provider's request, racing to produce its first token
+    def __init__(self, provider: Provider, stream: AsyncIterator[StreamChunk], hedge: bool):
+        self.provider = provider
+        self.stream = stream
+        self.hedge = hedge
+        self.started = time.monotonic()
+        self.first = asyncio.ensure_future(self._read_until_first_token())
+
+    async def _read_until_first_token(self) -> List[StreamChunk]:
+        # Role-only and empty chunks come before the first real token; keep them for the caller.
+        # A reasoning token counts: the model is working, even if content is still a while off.
+        buffered = []
+        async for chunk in self.stream:
+            buffered.append(chunk)
+            if chunk.content or chunk.reasoning:
+                break
+        return buffered
+
+    async def cancel(self):
+        self.first.cancel()
+        try:
+            await self.first
+        except BaseException:
+            pass
+        await self.stream.aclose()
+
+
+class ProviderPool:
+    def __init__(self, config: dict):
+        self.first_token_timeout: float = config.get("first_token_timeout_seconds", 10)
+        self.read_timeout: float = config.get("read_timeout_seconds", 30)
+        self.hedge_after: float = config.get("hedge_after_ms", 0) / 1000
+        circuit = config.get("circuit", {})
+        self.providers: List[Provider] = []
+        for provider_config in config["providers"]:
+            if provider_config.get("api_key_env") and not os.environ.get(provider_config["api_key_env"]):
+                print(f"LLM provider {provider_config['name']} skipped: {provider_config['api_key_env']} is not set")
+                continue
+            breaker = CircuitBreaker(circuit.get("failure_threshold", 3), circuit.get("open_seconds", 30))
+            self.providers.append(Provider(provider_config, breaker))
+        # Created inside the event loop that first uses the pool
+        self._http: Optional[httpx.AsyncClient] = None
+        self._bridge: Optional[_SyncBridge] = None
+        # Streamlit runs every session in its own thread; only one of them may start the bridge
+        self._bridge_lock = threading.Lock()
+        # Streams currently open upstream (waiting for or receiving tokens)
+        self.in_flight = 0
+
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=httpx.Timeout(self.read_timeout, connect=5.0),
+                                           limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60))
+        return self._http
+
+    def available(self) -> bool:
+        return bool(self.providers)
+
+    def _start_next(self, providers: Iterator[Provider], messages: List[dict], args: dict,
+                    hedge: bool = False) -> Optional[_Attempt]:
+        for provider in providers:
+            if provider.breaker.allow():
+                provider.requests += 1
+                if hedge:
+                    provider.hedges += 1
+                return _Attempt(provider, provider.stream(self.http(), messages, args), hedge)
+        return None
+
+    async def stream_chat(self, messages: List[dict], args: dict) -> AsyncIterator[StreamChunk]:
+        # Providers are tried in config order. A provider that errors or sends no token within
+        # first_token_timeout is abandoned for the next one; with hedge_after_ms set, the next
+        # one is also started early and whichever answers first wins. Once tokens flow there
+        # is no failover: the student has already seen part of the answer.
+        providers = iter(self.providers)
+        errors: List[str] = []
+        pending: List[_Attempt] = []
+        winner: Optional[_Attempt] = None
+        self.in_flight += 1
+        try:
+            attempt = self._start_next(providers, messages, args)
+            if attempt is None:
+                raise NoProviderAvailable(["all circuits open"])
+            pending.append(attempt)
+            hedged = False
+            while winner is None:
+                if not pending:
+                    attempt = self._start_next(providers, messages, args)
+                    if attempt is None:
+                        raise NoProviderAvailable(errors)
+                    pending.append(attempt)
+                now = time.monotonic()
+                wait = min(a.started + self.first_token_timeout for a in pending) - now
+                if self.hedge_after and not hedged and len(pending) == 1:
+                    wait = min(wait, pending[0].started + self.hedge_after - now)
+                done, _ = await asyncio.wait([a.first for a in pending], timeout=max(wait, 0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for attempt in [a for a in pending if a.first in done]:
+                    pending.remove(attempt)
+                    error = attempt.first.exception()
+                    if error is None:
+                        if winner is None:
+                            winner = attempt
+                        else:
+                            pending.append(attempt)
+                        continue
+                    message = str(error) or type(error).__name__
+                    print(f"LLM provider {attempt.provider.name} failed before the first token: {message}")
+                    attempt.provider.record_error(message)
+                    errors.append(f"{attempt.provider.name}: {message}")
+                    await attempt.stream.aclose()
+                now = time.monotonic()
+                for attempt in [a for a in pending if now - a.started >= self.first_token_timeout]:
+                    pending.remove(attempt)
+                    print(f"LLM provider {attempt.provider.name} sent no token within {self.first_token_timeout}s")
+                    await attempt.cancel()
+                    attempt.provider.record_error("first token timeout", timeout=True)
+                    errors.append(f"{attempt.provider.name}: first token timeout")
+                if (winner is None and self.hedge_after and not hedged and len(pending) == 1
+                        and now - pending[0].started >= self.hedge_after):
+                    hedged = True
+                    hedge = self._start_next(providers, messages, args, hedge=True)
+                    if hedge is not None:
+                        print(f"LLM hedge: {pending[0].provider.name} slow, also asking {hedge.provider.name}")
+                        pending.append(hedge)
+
+            for loser in pending:
+                loser.provider.cancelled += 1
+                loser.provider.breaker.release()
+                await loser.cancel()
+            pending = []
+
+            provider = winner.provider
+            provider.record_first_token(time.monotonic() - winner.started)
+            for chunk in winner.first.result():
+                yield chunk
+            try:
+                async for chunk in winner.stream:
+                    yield chunk
+            except (httpx.HTTPError, ProviderError, ValueError) as e:
+                provider.record_error(f"stream broke after the first token: {e}")
+                raise ProviderError(provider.name, f"stream broke after the first token: {e}")
+            provider.successes += 1
+            provider.breaker.record_success()
+            winner = None
+        finally:
+            self.in_flight -= 1
+            for attempt in pending:
+                attempt.provider.breaker.release()
+                await attempt.cancel()
+            if winner is not None:
+                # The caller stopped reading mid-answer
+                winner.provider.breaker.release()
+                await winner.stream.aclose()
+
+    def stream_chat_sync(self, messages: List[dict], args: dict) -> Iterator[StreamChunk]:
+        # For synchronous callers (chat.py): the pool runs on its own event loop thread
+        with self._bridge_lock:
+            if self._bridge is None:
+                self._bridge = _SyncBridge()
+        return self._bridge.iterate(self.stream_chat(messages, args))
+
+    def stats(self) -> dict:
+        return {
+            "first_token_timeout_seconds": self.first_token_timeout,
+            "hedge_after_ms": self.hedge_after * 1000,
+            "in_flight": self.in_flight,
+            "providers": [p.stats() for p in self.providers],
+        }
+
+
+class _SyncBridge:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="llm-providers", daemon=True).start()
+
+    def iterate(self, stream: AsyncIterator[StreamChunk]) -> Iterator[StreamChunk]:
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), self.loop).result()
+
+
+def load_config(path: str = LLM_PROVIDERS_PATH) -> dict:
+    if not os.path.exists(path):
+        return DEFAULT_CONFIG
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    if not config.get("providers"):
+        raise ValueError(f"{path}: at least one provider is required")
+    return config
+
+
+def load_pool(path: str = LLM_PROVIDERS_PATH) -> ProviderPool:
+    return ProviderPool(load_config(path))
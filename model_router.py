@@ -0,0 +1,216 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from cache import LRUCache
+from search import normalize_vn
+
+MODEL_ROUTES_PATH = os.environ.get("MODEL_ROUTES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_routes.json"))
+LATENCY_SAMPLES = 500
+
+# Used when model_routes.json is missing: everything goes to the model used before routing existed
+DEFAULT_CONFIG = {
+    "default_route": "full",
+    "routes": {
+        "full": {"model": "openai/gpt-oss-120b", "reasoning_effort": "medium", "max_tokens": 1024,
+                 "temperature": 0.7, "top_p": 1},
+    },
+    "simple": {"route": "full"},
+    "followup_seconds": 120,
+}
+
+URL_RE = re.compile(r"https?://|www\.|\b[a-z0-9-]+\.(?:com|vn|net|org|xyz|top|info|link|me)\b")
+# Phone, account and card numbers usually mean a real message was pasted in for checking
+LONG_NUMBER_RE = re.compile(r"\d[\d .-]{7,}\d")
+
+
+def load_config(path: str = MODEL_ROUTES_PATH) -> dict:
+    if not os.path.exists(path):
+        return DEFAULT_CONFIG
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("default_route") not in config.get("routes", {}):
+        raise ValueError(f"{path}: default_route must name one of the routes")
+    if config.get("simple", {}).get("route", config["default_route"]) not in config["routes"]:
+        raise ValueError(f"{path}: simple.route must name one of the routes")
+    return config
+
+
+def last_user_message(messages: List[dict]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.empty_replies = 0
+        self.truncated = 0
+        self.output_chars = 0
+        # Quality signals: the student asks again soon after the answer, or the teacher steps in
+        self.followups = 0
+        self.teacher_takeovers = 0
+        self.first_token_ms = deque(maxlen=LATENCY_SAMPLES)
+        self.total_ms = deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self) -> dict:
+        answered = self.requests - self.errors
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "empty_replies": self.empty_replies,
+            "truncated": self.truncated,
+            "avg_output_chars": round(self.output_chars / answered) if answered else None,
+            "followups": self.followups,
+            "teacher_takeovers": self.teacher_takeovers,
+            "first_token_ms": percentiles(self.first_token_ms),
+            "total_ms": percentiles(self.total_ms),
+        }
+
+
+def percentiles(samples) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None}
+    ordered = sorted(samples)
+    return {"p50": round(ordered[len(ordered) // 2], 1),
+            "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1)}
+
+
+class RouteCall:
+    # One streamed completion: add_output() for every chunk, then finish() or fail() (only the first counts)
+    def __init__(self, router: "ModelRouter", route: str, session_id):
+        self.router = router
+        self.route = route
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.output_chars = 0
+        self.done = False
+
+    def add_output(self, content: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.output_chars += len(content)
+
+    def finish(self, finish_reason: Optional[str] = None):
+        if not self.done:
+            self.done = True
+            self.router._record(self, finish_reason, error=False)
+
+    def fail(self):
+        if not self.done:
+            self.done = True
+            self.router._record(self, None, error=True)
+
+
+class ModelRouter:
+    def __init__(self, config: dict):
+        self.config = config
+        self.routes: Dict[str, dict] = config["routes"]
+        self.default_route: str = config["default_route"]
+        simple = config.get("simple", {})
+        self.simple_route: str = simple.get("route", self.default_route)
+        self.max_chars = simple.get("max_chars", 160)
+        self.max_words = simple.get("max_words", 30)
+        self.max_turns = simple.get("max_turns", 8)
+        keywords = sorted((normalize_vn(k).lower() for k in simple.get("complex_keywords", [])), key=len, reverse=True)
+        self.complex_pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, keywords)) + r")\b") if keywords else None
+        self.followup_seconds = config.get("followup_seconds", 120)
+        self._lock = threading.Lock()
+        self._stats: Dict[str, RouteStats] = {name: RouteStats() for name in self.routes}
+        self._reasons: Dict[str, int] = {}
+        # session_id -> (route of the last AI answer, when it finished)
+        self._last_answer: LRUCache = LRUCache("model_route_last_answer", 10000, self.followup_seconds * 10)
+
+    def classify(self, messages: List[dict]) -> Tuple[str, str]:
+        # Returns (route, reason). Cheap local checks only; anything doubtful goes to the default route.
+        if self.simple_route == self.default_route:
+            return self.default_route, "single_route"
+        question = last_user_message(messages)
+        folded = normalize_vn(question).lower()
+        turns = sum(1 for m in messages if m.get("role") == "user")
+        if len(question) > self.max_chars or len(folded.split()) > self.max_words:
+            return self.default_route, "long"
+        if "\n" in question.strip() or question.count("?") > 1:
+            return self.default_route, "multi_part"
+        if URL_RE.search(folded) or LONG_NUMBER_RE.search(folded):
+            return self.default_route, "pasted_content"
+        if self.complex_pattern is not None and self.complex_pattern.search(folded):
+            return self.default_route, "keyword"
+        if turns > self.max_turns:
+            return self.default_route, "long_conversation"
+        return self.simple_route, "simple"
+
+    def choose(self, messages: List[dict]) -> str:
+        route, reason = self.classify(messages)
+        with self._lock:
+            key = f"{route}:{reason}"
+            self._reasons[key] = self._reasons.get(key, 0) + 1
+        return route
+
+    def completion_args(self, route: str) -> dict:
+        # Request parameters for an OpenAI-compatible chat completion
+        settings = self.routes[route]
+        args = {"model": settings["model"], "temperature": settings.get("temperature", 0.7),
+                "top_p": settings.get("top_p", 1), "max_tokens": settings.get("max_tokens", 1024)}
+        if settings.get("reasoning_effort"):
+            args["reasoning_effort"] = settings["reasoning_effort"]
+        return args
+
+    def start(self, route: str, session_id=None) -> RouteCall:
+        return RouteCall(self, route, session_id)
+
+    def _record(self, call: RouteCall, finish_reason: Optional[str], error: bool):
+        now = time.perf_counter()
+        with self._lock:
+            stats = self._stats[call.route]
+            stats.requests += 1
+            if error:
+                stats.errors += 1
+                return
+            stats.total_ms.append((now - call.started) * 1000)
+            if call.first_token_at is not None:
+                stats.first_token_ms.append((call.first_token_at - call.started) * 1000)
+            stats.output_chars += call.output_chars
+            if call.output_chars == 0:
+                stats.empty_replies += 1
+            if finish_reason == "length":
+                stats.truncated += 1
+        if call.session_id is not None:
+            self._last_answer.set(call.session_id, (call.route, time.monotonic()))
+
+    def note_message(self, session_id, role: str):
+        # Call for every student or teacher message saved after an AI answer
+        last = self._last_answer.get(session_id)
+        if last is None or role not in ("user", "teacher"):
+            return
+        route, answered_at = last
+        if role == "user" and time.monotonic() - answered_at > self.followup_seconds:
+            return
+        self._last_answer.invalidate(session_id)
+        with self._lock:
+            if role == "user":
+                self._stats[route].followups += 1
+            else:
+                self._stats[route].teacher_takeovers += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "routes": {name: dict(model=self.routes[name]["model"],
+                                      reasoning_effort=self.routes[name].get("reasoning_effort"),
+                                      **stats.snapshot())
+                           for name, stats in self._stats.items()},
+                "decisions": dict(sorted(self._reasons.items())),
+            }
+
+
+def load_router(path: str = MODEL_ROUTES_PATH) -> ModelRouter:
+    return ModelRouter(load_config(path))
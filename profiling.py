@@ -0,0 +1,305 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# Sampling profiler and event-loop watchdog for chat_server.py. One background thread looks at the
+# stacks of the running threads (sys._current_frames) a few hundred times a second at most, and only
+# while a profile runs or the loop is late for its heartbeat; nothing is instrumented, so it can be
+# switched on against a live class without restarting the server.
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+# A loop that misses its heartbeat by this much is reported with the stack that was blocking it (0 disables)
+LOOP_LAG_THRESHOLD_MS = float(os.environ.get("LOOP_LAG_THRESHOLD_MS", "200"))
+LOOP_HEARTBEAT_MS = 50
+# Requests slower than this (time to first byte for streams) are logged with what the loop was doing (0 disables)
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+TRACE_INTERVAL_MS = 10
+# Outside a profile, stacks are only sampled once the loop is this much later than its heartbeat
+TRACE_AFTER_LAG_MS = 20
+TRACE_BUFFER_SECONDS = 120
+RECENT_EVENTS = 50
+TRACE_TOP_STACKS = 5
+
+# Innermost frames of an event loop thread that is waiting for I/O rather than running a callback
+IDLE_FRAMES = {("selectors.py", "select"), ("selectors.py", "poll"), ("base_events.py", "_run_once"),
+               ("base_events.py", "run_forever"), ("runners.py", "run")}
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse(frame) -> List[str]:
+    # Root first, the order flamegraph.pl and speedscope expect in "a;b;c count" lines
+    stack = []
+    while frame is not None:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def short_stack(stack: Optional[str], depth: int = 8) -> str:
+    # Innermost frames first, for log lines
+    return " <- ".join(reversed(stack.split(";")[-depth:])) if stack else "no Python frame"
+
+
+def is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def task_label(loop) -> Optional[str]:
+    # The task the loop is running right now; read from another thread, so only a best guess
+    try:
+        task = asyncio.current_task(loop)
+    except RuntimeError:
+        return None
+    if task is None:
+        return None
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', type(coro).__name__)})"
+
+
+def is_stream_header(name: bytes, value: bytes) -> bool:
+    # Server-sent events, or a file download such as /export
+    name = name.lower()
+    return ((name == b"content-type" and value.startswith(b"text/event-stream"))
+            or (name == b"content-disposition" and value.lower().startswith(b"attachment")))
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Profile:
+    def __init__(self, seconds: float, interval_ms: float, all_threads: bool):
+        self.seconds = seconds
+        self.interval = interval_ms / 1000
+        self.all_threads = all_threads
+        self.started_at = now_iso()
+        self.started = time.monotonic()
+        self.ends = self.started + seconds
+        self.finished_at: Optional[str] = None
+        self.samples = 0
+        self.idle_samples = 0
+        self.stacks: Counter = Counter()
+
+    def summary(self) -> dict:
+        return {"running": self.finished_at is None, "started_at": self.started_at, "finished_at": self.finished_at,
+                "seconds": self.seconds, "interval_ms": self.interval * 1000, "all_threads": self.all_threads,
+                "samples": self.samples, "idle_samples": self.idle_samples, "distinct_stacks": len(self.stacks)}
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class LoopMonitor:
+    def __init__(self, lag_threshold_ms: float = LOOP_LAG_THRESHOLD_MS, slow_request_ms: float = SLOW_REQUEST_MS):
+        self.lag_threshold = lag_threshold_ms / 1000
+        self.slow_request_ms = slow_request_ms
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.profile: Optional[Profile] = None
+        self.last_beat = time.monotonic()
+        # Stack seen by the watchdog while the current stall is still going on
+        self.stall: Optional[dict] = None
+        self.stalls = 0
+        self.stalled_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.recent_stalls: deque = deque(maxlen=RECENT_EVENTS)
+        # (monotonic time, sample interval, collapsed stack) of the loop thread while it was busy
+        self.samples: deque = deque(maxlen=int(TRACE_BUFFER_SECONDS * 1000 / TRACE_INTERVAL_MS))
+        self.slow_requests = 0
+        self.recent_slow_requests: deque = deque(maxlen=RECENT_EVENTS)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> asyncio.Task:
+        # Call from the event loop thread at startup; returns the heartbeat task
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="loop-monitor", daemon=True)
+        self.thread.start()
+        return loop.create_task(self.heartbeat())
+
+    async def heartbeat(self):
+        beat = LOOP_HEARTBEAT_MS / 1000
+        while True:
+            expected = time.monotonic() + beat
+            await asyncio.sleep(beat)
+            now = time.monotonic()
+            lag = now - expected
+            with self._lock:
+                self.last_beat = now
+                stall, self.stall = self.stall, None
+                if not self.lag_threshold or lag < self.lag_threshold:
+                    continue
+                lag_ms = round(lag * 1000, 1)
+                self.stalls += 1
+                self.stalled_ms += lag_ms
+                self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+                event = {"at": now_iso(), "lag_ms": lag_ms, **(stall or {})}
+                self.recent_stalls.append(event)
+            print(f"Event loop was blocked for {lag_ms} ms" + (f" by {stall['task']}" if stall and stall.get("task") else ""))
+
+    def _interval(self) -> float:
+        intervals = [TRACE_INTERVAL_MS / 1000]
+        if self.profile is not None and self.profile.finished_at is None:
+            intervals.append(self.profile.interval)
+        return min(intervals)
+
+    def _run(self):
+        while True:
+            interval = self._interval()
+            time.sleep(interval)
+            try:
+                self._sample(interval)
+            except Exception as e:
+                print(f"Loop monitor sample failed: {str(e)}")
+
+    def _sample(self, interval: float):
+        now = time.monotonic()
+        with self._lock:
+            profiling = self.profile is not None and self.profile.finished_at is None
+            late = now - self.last_beat > (LOOP_HEARTBEAT_MS + TRACE_AFTER_LAG_MS) / 1000
+        if not profiling and not late:
+            # The loop keeps up with its heartbeat: nothing worth a walk over every thread's stack
+            return
+        frames = sys._current_frames()
+        loop_frame = frames.get(self.loop_thread_id)
+        busy = loop_frame is not None and not is_idle(loop_frame)
+        stack = ";".join(collapse(loop_frame)) if busy else None
+        with self._lock:
+            if self.lag_threshold and self.stall is None and now - self.last_beat > self.lag_threshold + LOOP_HEARTBEAT_MS / 1000:
+                # Still blocked: the stack right now is the code that is holding the loop
+                self.stall = {"task": task_label(self.loop), "stack": stack}
+                print(f"Event loop blocked for over {round((now - self.last_beat) * 1000)} ms in "
+                      f"{self.stall['task'] or 'a callback'}: {short_stack(stack)}")
+            if self.slow_request_ms and busy:
+                self.samples.append((now, interval, stack))
+            profile = self.profile
+            if profile is not None and profile.finished_at is None:
+                self._profile_sample(profile, frames, loop_frame, busy, stack)
+                if now >= profile.ends:
+                    profile.finished_at = now_iso()
+                    print(f"Profile finished: {profile.samples} samples, {len(profile.stacks)} distinct stacks")
+
+    def _profile_sample(self, profile: Profile, frames: Dict[int, object], loop_frame, busy: bool, stack: Optional[str]):
+        profile.samples += 1
+        if loop_frame is not None:
+            if busy:
+                profile.stacks["event-loop;" + stack] += 1
+            else:
+                profile.idle_samples += 1
+                profile.stacks["event-loop;(idle)"] += 1
+        if profile.all_threads:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id in (self.loop_thread_id, threading.get_ident()):
+                    continue
+                profile.stacks[";".join([names.get(thread_id, str(thread_id))] + collapse(frame))] += 1
+
+    def start_profile(self, seconds: float, interval_ms: float = PROFILE_INTERVAL_MS, all_threads: bool = False) -> dict:
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+        if interval_ms < 1:
+            raise ValueError("interval_ms must be at least 1")
+        with self._lock:
+            if self.profile is not None and self.profile.finished_at is None:
+                raise RuntimeError("A profile is already running")
+            self.profile = Profile(seconds, interval_ms, all_threads)
+            print(f"Profiling for {seconds}s every {interval_ms} ms (all_threads={all_threads})")
+            return self.profile.summary()
+
+    def stop_profile(self) -> Optional[dict]:
+        with self._lock:
+            if self.profile is not None and self.profile.finished_at is None:
+                self.profile.finished_at = now_iso()
+            return self.profile.summary() if self.profile else None
+
+    def collapsed(self) -> Optional[str]:
+        with self._lock:
+            return self.profile.collapsed() if self.profile else None
+
+    def trace(self, method: str, path: str, status, started: float, ended: float, elapsed_ms: float):
+        # What the loop was busy with while the request was waiting; the loop is shared, so the
+        # stacks may belong to other requests that held it up
+        window = []
+        with self._lock:
+            for t, interval, stack in reversed(self.samples):
+                if t < started:
+                    break
+                if t <= ended:
+                    window.append((interval, stack))
+        busy = Counter()
+        busy_ms = 0.0
+        for interval, stack in window:
+            busy[stack] += interval * 1000
+            busy_ms += interval * 1000
+        top = [{"ms": round(ms), "stack": stack} for stack, ms in busy.most_common(TRACE_TOP_STACKS)]
+        event = {"at": now_iso(), "method": method, "path": path, "status": status,
+                 "elapsed_ms": round(elapsed_ms, 1), "loop_busy_ms": round(busy_ms), "top_stacks": top}
+        with self._lock:
+            self.slow_requests += 1
+            self.recent_slow_requests.append(event)
+        print(f"Slow request {method} {path} ({status}) took {event['elapsed_ms']} ms, "
+              f"event loop busy for {event['loop_busy_ms']} ms of it")
+        for entry in top:
+            print(f"    {entry['ms']} ms  {short_stack(entry['stack'])}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "profile": self.profile.summary() if self.profile else None,
+                "loop_lag": {"threshold_ms": self.lag_threshold * 1000, "stalls": self.stalls,
+                             "stalled_ms": round(self.stalled_ms, 1), "max_lag_ms": self.max_lag_ms},
+                "slow_requests": {"threshold_ms": self.slow_request_ms, "count": self.slow_requests},
+            }
+
+    def recent(self) -> dict:
+        with self._lock:
+            return {"stalls": list(self.recent_stalls), "slow_requests": list(self.recent_slow_requests)}
+
+
+class SlowRequestTracer:
+    # ASGI middleware: logs requests above SLOW_REQUEST_MS with the stacks that kept the loop busy meanwhile.
+    # For streamed responses (the LLM stream, /export downloads) the time to the first byte counts; the
+    # rest is expected to be long. loop_busy_ms only covers the time the loop was late for its heartbeat.
+    def __init__(self, app, monitor: LoopMonitor):
+        self.app = app
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.monitor.slow_request_ms:
+            await self.app(scope, receive, send)
+            return
+        started = time.monotonic()
+        response = {"status": None, "first_byte": None, "stream": False}
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["stream"] = any(is_stream_header(name, value) for name, value in message.get("headers", []))
+            elif message["type"] == "http.response.body" and response["first_byte"] is None:
+                response["first_byte"] = time.monotonic()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            ended = response["first_byte"] if response["stream"] and response["first_byte"] else time.monotonic()
+            elapsed_ms = (ended - started) * 1000
+            if elapsed_ms >= self.monitor.slow_request_ms:
+                route = scope.get("route")
+                self.monitor.trace(scope["method"], route.path if route is not None else scope["path"],
+                                   response["status"], started, ended, elapsed_ms)
+
+
+monitor = LoopMonitor()
@@ -0,0 +1,483 @@
+import argparse
+import asyncio
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+import websockets
+from fastapi import Body, FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from model_router import percentiles
+
+# Replays a traffic capture (traffic_capture.py) against a test instance of chat_server.py.
+#
+#   python replay.py --llm-config --llm-port 9300 > replay_llm.json
+#   LLM_PROVIDERS_PATH=replay_llm.json DB_NAME=chat_replay uvicorn chat_server:app --port 8001
+#   python replay.py captures/traffic-20261019.jsonl --target http://127.0.0.1:8001 --speed 4
+#
+# The test instance talks to a fake LLM run by this script, which answers every /chatbot call with
+# the first-token delay and chunk pacing recorded for it (divided by --speed, like the request schedule).
+
+DEFAULT_LLM_PORT = 9300
+REPLAY_PASSWORD = "replay"
+ID_FIELDS = ("student_id", "session_id", "teacher_id")
+TOKEN_FIELDS = {"token", "access_token"}
+LOGIN_ROUTES = ("/student_login", "/teacher_login")
+# Prefixed to the last user message of each replayed /chatbot call so the fake LLM knows which record it is serving
+MARKER_RE = re.compile(r"^#r(\d+) ")
+ROUTE_PARAM_RE = re.compile(r"\{(\w+)(?::\w+)?\}")
+# Upstream timing for /chatbot records captured before timing was recorded
+DEFAULT_PROFILE = {"chunk_offsets_ms": [300 + 30 * i for i in range(20)], "chunk_chars": [8] * 20,
+                   "finish_reason": "stop", "error": None}
+SESSION_WAIT_SECONDS = 30
+
+
+class MissingId(Exception):
+    pass
+
+
+def load_capture(paths: List[str], limit: Optional[int] = None) -> List[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    # Records are written when a request ends; replay them in the order they started
+    records.sort(key=lambda r: r["ts"])
+    records = records[:limit] if limit else records
+    for index, record in enumerate(records):
+        record["index"] = index
+    return records
+
+
+def walk_ids(value, key: Optional[str] = None):
+    # Yields (field, id) for every student/session/teacher id in a JSON value
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from walk_ids(v, k)
+    elif isinstance(value, list):
+        for v in value:
+            yield from walk_ids(v, key)
+    elif key in ID_FIELDS and str(value).isdigit():
+        yield key, int(value)
+
+
+def record_ids(record: dict):
+    yield from walk_ids(record.get("path_params"))
+    yield from walk_ids(record.get("query"))
+    yield from walk_ids(record.get("body"))
+    for frame in record.get("frames") or []:
+        if frame["dir"] == "in":
+            yield from walk_ids(frame.get("data"))
+
+
+def route_key(record: dict) -> str:
+    return f"{record['method']} {record.get('route') or record['path']}"
+
+
+def sse(event: dict) -> str:
+    return f"data: {json.dumps(event)}\n\n"
+
+
+def fake_llm_app(profiles: Dict[int, dict], speed: float) -> FastAPI:
+    # OpenAI-compatible streaming endpoint that replays captured upstream timing with placeholder text
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def completions(body: dict = Body(...)):
+        user_messages = [m.get("content") or "" for m in body.get("messages", []) if m.get("role") == "user"]
+        match = MARKER_RE.match(user_messages[-1]) if user_messages else None
+        profile = (profiles.get(int(match.group(1))) if match else None) or DEFAULT_PROFILE
+        if profile.get("error") and not profile.get("chunk_offsets_ms"):
+            return JSONResponse({"error": {"message": f"replayed upstream error {profile['error']}"}}, status_code=503)
+
+        async def stream():
+            started = time.perf_counter()
+            for offset, chars in zip(profile["chunk_offsets_ms"], profile["chunk_chars"]):
+                delay = started + offset / 1000 / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield sse({"choices": [{"index": 0, "delta": {"content": "x" * chars}, "finish_reason": None}]})
+            if profile.get("error"):
+                # The captured stream broke after the first token: drop the connection the same way
+                raise RuntimeError(f"replayed upstream error {profile['error']}")
+            yield sse({"choices": [{"index": 0, "delta": {}, "finish_reason": profile.get("finish_reason") or "stop"}]})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def start_fake_llm(profiles: Dict[int, dict], speed: float, port: int) -> uvicorn.Server:
+    # Own thread and event loop, so the fake LLM's pacing does not compete with the replay client
+    server = uvicorn.Server(uvicorn.Config(fake_llm_app(profiles, speed), host="127.0.0.1", port=port,
+                                           log_level="warning"))
+    threading.Thread(target=server.run, name="replay-fake-llm", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def llm_config(port: int) -> dict:
+    # llm_providers.json for the test instance, pointing at the fake LLM
+    return {
+        "providers": [{"name": "replay", "base_url": f"http://127.0.0.1:{port}/v1"}],
+        "first_token_timeout_seconds": 60,
+        "read_timeout_seconds": 60,
+        "hedge_after_ms": 0,
+        "circuit": {"failure_threshold": 1000, "open_seconds": 1},
+    }
+
+
+class Replayer:
+    def __init__(self, records: List[dict], target: str, speed: float, teacher_username: str,
+                 teacher_password: str, class_name: str):
+        self.records = records
+        self.target = target.rstrip("/")
+        self.ws_target = re.sub(r"^http", "ws", self.target)
+        self.speed = speed
+        self.teacher_username = teacher_username
+        self.teacher_password = teacher_password
+        self.class_name = class_name
+        self.run_id = uuid.uuid4().hex[:6]
+        # Principal label from the capture ("student:12") -> token on the test instance
+        self.tokens: Dict[str, str] = {}
+        # Captured id -> id on the test instance, per kind of id
+        self.ids: Dict[str, Dict[int, int]] = {field: {} for field in ID_FIELDS}
+        # Sessions the capture creates itself: requests for them wait until the replayed POST /sessions returns
+        self.pending_sessions: Dict[int, asyncio.Event] = {}
+        self.etags: Dict[tuple, str] = {}
+        # Principal -> the latest replayed login of that principal, set once its response is back
+        self.logins: Dict[str, asyncio.Event] = {}
+        self.results: List[dict] = []
+        self.skipped: Dict[str, int] = {}
+        self.max_lag_ms = 0.0
+        self.http: Optional[httpx.AsyncClient] = None
+
+    def student_username(self, student_id) -> str:
+        return f"replay-{self.run_id}-{student_id}"
+
+    async def post(self, path: str, body: dict) -> dict:
+        response = await self.http.post(self.target + path, json=body)
+        response.raise_for_status()
+        return response.json()
+
+    async def provision(self):
+        # Accounts and sessions the capture refers to but did not create while it was recording
+        students, owners, created = set(), {}, set()
+        for record in self.records:
+            principal = record.get("principal") or ""
+            student = int(principal.split(":")[1]) if principal.startswith("student:") else None
+            if student is not None:
+                students.add(student)
+            for field, value in record_ids(record):
+                if field == "student_id":
+                    students.add(value)
+                elif field == "session_id" and student is not None:
+                    owners.setdefault(value, student)
+            response = record.get("response")
+            if record.get("route") == "/sessions" and record["method"] == "POST" and isinstance(response, dict):
+                created.add(response["id"])
+            elif record.get("route") == "/sessions/{student_id}" and isinstance(response, list):
+                for session in response:
+                    owners.setdefault(session["id"], int(record["path_params"]["student_id"]))
+        sessions = {value for record in self.records for field, value in record_ids(record) if field == "session_id"}
+
+        teacher = await self.post("/teacher_login", {"username": self.teacher_username, "password": self.teacher_password})
+        teachers = {value for record in self.records for field, value in record_ids(record) if field == "teacher_id"}
+        teachers |= {int(r["principal"].split(":")[1]) for r in self.records
+                     if (r.get("principal") or "").startswith("teacher:")}
+        for teacher_id in teachers:
+            self.ids["teacher_id"][teacher_id] = teacher["id"]
+            self.tokens[f"teacher:{teacher_id}"] = teacher["token"]
+
+        limit = asyncio.Semaphore(20)
+
+        async def add_student(student_id: int):
+            async with limit:
+                registered = await self.post("/student_register", {
+                    "username": self.student_username(student_id), "name": f"Replay {student_id}",
+                    "class_name": self.class_name, "gvcn": "Replay", "password": REPLAY_PASSWORD})
+                login = await self.post("/student_login", {"username": self.student_username(student_id),
+                                                           "password": REPLAY_PASSWORD})
+                self.ids["student_id"][student_id] = registered["id"]
+                self.tokens[f"student:{student_id}"] = login["token"]
+
+        await asyncio.gather(*(add_student(s) for s in sorted(students)))
+
+        fallback_owner = min(students) if students else None
+
+        async def add_session(session_id: int):
+            owner = owners.get(session_id, fallback_owner)
+            if owner is None:
+                return
+            async with limit:
+                session = await self.post("/sessions", {
+                    "session": {"student_id": self.ids["student_id"][owner], "title": f"replay {session_id}"},
+                    "token": self.tokens[f"student:{owner}"]})
+                self.ids["session_id"][session_id] = session["id"]
+
+        await asyncio.gather(*(add_session(s) for s in sorted(sessions - created)))
+        self.pending_sessions = {session_id: asyncio.Event() for session_id in created}
+        print(f"Provisioned {len(students)} students, {len(sessions - created)} sessions "
+              f"and {len(teachers)} teacher ids (run {self.run_id})")
+
+    def rewrite(self, value, key: Optional[str] = None):
+        if isinstance(value, dict):
+            return {k: self.rewrite(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.rewrite(v, key) for v in value]
+        if key in TOKEN_FIELDS and isinstance(value, str):
+            return self.tokens.get(value, value)
+        if key in ID_FIELDS and str(value).isdigit():
+            mapped = self.ids[key].get(int(value))
+            if mapped is None:
+                raise MissingId(f"{key}={value}")
+            return str(mapped) if isinstance(value, str) else mapped
+        if key == "password" and value == "***":
+            return REPLAY_PASSWORD
+        return value
+
+    def request_body(self, record: dict):
+        body = self.rewrite(record.get("body"))
+        route, principal = record.get("route"), record.get("principal") or ""
+        if route in LOGIN_ROUTES and isinstance(body, dict):
+            # Log in as the replay account of whoever logged in; failed logins stay failed
+            if principal.startswith("teacher:"):
+                body.update(username=self.teacher_username, password=self.teacher_password)
+            elif principal.startswith("student:"):
+                body.update(username=self.student_username(principal.split(":")[1]), password=REPLAY_PASSWORD)
+            else:
+                body.update(username=f"replay-{self.run_id}-unknown", password="wrong")
+        elif route == "/student_register" and isinstance(body, dict):
+            body["username"] = f"replay-{self.run_id}-r{record['index']}"
+        elif route == "/students/import" and isinstance(body, dict):
+            for n, student in enumerate(body.get("students") or []):
+                student["username"] = f"replay-{self.run_id}-i{record['index']}-{n}"
+        elif route == "/chatbot" and isinstance(body, dict) and body.get("messages"):
+            body["messages"][-1]["content"] = f"#r{record['index']} " + body["messages"][-1]["content"]
+        return body
+
+    def request_path(self, record: dict) -> str:
+        if not record.get("route"):
+            return record["path"]
+        params = self.rewrite(record.get("path_params") or {})
+        return ROUTE_PARAM_RE.sub(lambda m: str(params[m.group(1)]), record["route"])
+
+    async def wait_for_sessions(self, record: dict):
+        for field, value in record_ids(record):
+            event = self.pending_sessions.get(value) if field == "session_id" else None
+            if event is not None and not event.is_set():
+                await asyncio.wait_for(event.wait(), SESSION_WAIT_SECONDS)
+
+    async def replay(self, record: dict, login: Optional[asyncio.Event] = None):
+        try:
+            if login is None and record.get("principal") in self.logins:
+                # The captured client had its new token before sending this; wait for the replayed login too
+                await self.logins[record["principal"]].wait()
+            await self.wait_for_sessions(record)
+            path = self.request_path(record)
+            if record["kind"] == "websocket":
+                result = await self.replay_websocket(record, path)
+            else:
+                result = await self.replay_http(record, path, self.rewrite(record.get("query")),
+                                                self.request_body(record))
+        except (MissingId, asyncio.TimeoutError) as e:
+            reason = f"missing {e}" if isinstance(e, MissingId) else "session never created"
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+            return
+        finally:
+            if login is not None:
+                login.set()
+        self.results.append(result)
+
+    async def replay_http(self, record: dict, path: str, query: Optional[dict], body) -> dict:
+        result = {"index": record["index"], "key": route_key(record), "captured_status": record.get("status"),
+                  "captured_ms": record.get("duration_ms"), "captured_ttfb_ms": record.get("ttfb_ms")}
+        headers = {"Accept-Encoding": record.get("accept_encoding") or "identity"}
+        # Revalidate with the ETag this replay got earlier for the same URL, like the captured client did
+        etag_key = (record.get("principal"), path, json.dumps(query, sort_keys=True))
+        if record.get("conditional") and etag_key in self.etags:
+            headers["If-None-Match"] = self.etags[etag_key]
+        started = time.perf_counter()
+        content = bytearray()
+        try:
+            async with self.http.stream(record["method"], self.target + path, params=query, headers=headers,
+                                        json=body if record["method"] != "GET" else None) as response:
+                async for chunk in response.aiter_raw():
+                    result.setdefault("ttfb_ms", round((time.perf_counter() - started) * 1000, 1))
+                    content.extend(chunk)
+                result["status"] = response.status_code
+                if response.headers.get("etag"):
+                    self.etags[etag_key] = response.headers["etag"]
+        except httpx.HTTPError as e:
+            result["status"] = type(e).__name__
+        result["replay_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        captured = record.get("response")
+        if result["status"] == 200 and isinstance(captured, dict) and record.get("route") in (
+                "/sessions",) + LOGIN_ROUTES:
+            replayed = json.loads(content)
+            if record["route"] == "/sessions":
+                self.ids["session_id"][captured["id"]] = replayed["id"]
+                if captured["id"] in self.pending_sessions:
+                    self.pending_sessions[captured["id"]].set()
+            elif record.get("principal"):
+                # A new student login revokes the previous token, as it did in production
+                self.tokens[record["principal"]] = replayed["token"]
+        llm = record.get("llm")
+        if llm and llm.get("first_token_ms") is not None and record.get("ttfb_ms") is not None \
+                and result.get("ttfb_ms") is not None:
+            # Time the server adds before the first byte, net of the upstream's own first-token delay
+            result["captured_overhead_ms"] = round(record["ttfb_ms"] - llm["first_token_ms"], 1)
+            result["overhead_ms"] = round(result["ttfb_ms"] - llm["first_token_ms"] / self.speed, 1)
+        return result
+
+    async def replay_websocket(self, record: dict, path: str) -> dict:
+        result = {"index": record["index"], "key": route_key(record), "captured_status": record.get("close_code"),
+                  "captured_ms": record.get("accept_ms"), "captured_frames_out": 0, "frames_out": 0}
+        result["captured_frames_out"] = sum(1 for f in record.get("frames") or []
+                                            if f["dir"] == "out" and f.get("type") != "ping")
+        started = time.perf_counter()
+
+        async def at(offset_ms: float):
+            delay = started + offset_ms / 1000 / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        try:
+            async with websockets.connect(self.ws_target + path, open_timeout=30, max_size=None) as ws:
+                result["replay_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+                async def read():
+                    async for message in ws:
+                        if '"type": "ping"' not in message:
+                            result["frames_out"] += 1
+
+                reader = asyncio.create_task(read())
+                for frame in record.get("frames") or []:
+                    if frame["dir"] == "in" and frame.get("data") is not None:
+                        await at(frame["t_ms"])
+                        await ws.send(json.dumps(self.rewrite(frame["data"]), ensure_ascii=False))
+                await at(record.get("duration_ms") or 0)
+                reader.cancel()
+            result["status"] = result["captured_status"] if result["captured_status"] is not None else 1000
+        except websockets.exceptions.InvalidStatus as e:
+            result["status"] = e.response.status_code
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            result["status"] = type(e).__name__
+        if result["captured_status"] == 1008 and result["status"] == 403:
+            # A close before accept is an HTTP 403 to the client; both mean the socket was refused
+            result["status"] = 1008
+        return result
+
+    async def run(self):
+        async with httpx.AsyncClient(timeout=httpx.Timeout(120, connect=10),
+                                     limits=httpx.Limits(max_connections=None, max_keepalive_connections=200)) as http:
+            self.http = http
+            await self.provision()
+            loop = asyncio.get_running_loop()
+            first = self.records[0]["ts"]
+            start = loop.time() + 0.5
+            tasks = []
+            for record in self.records:
+                scheduled = start + (record["ts"] - first) / self.speed
+                delay = scheduled - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.max_lag_ms = max(self.max_lag_ms, (loop.time() - scheduled) * 1000)
+                login = None
+                if record.get("route") in LOGIN_ROUTES and record.get("principal"):
+                    login = self.logins[record["principal"]] = asyncio.Event()
+                tasks.append(asyncio.create_task(self.replay(record, login)))
+            await asyncio.gather(*tasks)
+
+    def report(self) -> dict:
+        routes: Dict[str, dict] = {}
+        for result in self.results:
+            route = routes.setdefault(result["key"], {"requests": 0, "mismatched_status": 0, "captured_ms": [],
+                                                      "replay_ms": [], "captured_overhead_ms": [], "overhead_ms": []})
+            route["requests"] += 1
+            if result.get("status") != result.get("captured_status"):
+                route["mismatched_status"] += 1
+            for field in ("captured_ms", "replay_ms", "captured_overhead_ms", "overhead_ms"):
+                if result.get(field) is not None:
+                    route[field].append(result[field])
+        summary = {}
+        for key, route in sorted(routes.items()):
+            summary[key] = {field: percentiles(value) if isinstance(value, list) else value
+                            for field, value in route.items() if not isinstance(value, list) or value}
+        return {"run_id": self.run_id, "speed": self.speed, "records": len(self.records),
+                "replayed": len(self.results), "skipped": self.skipped,
+                "max_dispatch_lag_ms": round(self.max_lag_ms, 1), "routes": summary}
+
+
+def print_report(report: dict):
+    print(f"Replayed {report['replayed']}/{report['records']} records at {report['speed']}x, "
+          f"max dispatch lag {report['max_dispatch_lag_ms']} ms")
+    for reason, count in report["skipped"].items():
+        print(f"  skipped {count}: {reason}")
+    print(f"{'route':<48}{'n':>6}{'status!=':>9}{'captured p50/p95':>20}{'replay p50/p95':>20}{'p50 diff':>10}")
+
+    def pair(p):
+        return f"{p['p50']}/{p['p95']}" if p else "-"
+
+    for key, route in report["routes"].items():
+        captured, replayed = route.get("captured_ms"), route.get("replay_ms")
+        diff = "-"
+        if captured and replayed and captured["p50"]:
+            diff = f"{(replayed['p50'] - captured['p50']) / captured['p50'] * 100:+.0f}%"
+        print(f"{key:<48}{route['requests']:>6}{route['mismatched_status']:>9}{pair(captured):>20}{pair(replayed):>20}{diff:>10}")
+        if route.get("overhead_ms"):
+            print(f"{'  server time before first token':<63}{pair(route.get('captured_overhead_ms')):>20}"
+                  f"{pair(route['overhead_ms']):>20}")
+    if report["speed"] != 1:
+        print("Streaming and websocket timings scale with --speed; compare the first-token overhead rows instead.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured chat_server traffic against a test instance")
+    parser.add_argument("captures", nargs="*", help="JSONL files written with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="base URL of the test instance")
+    parser.add_argument("--speed", type=float, default=1.0, help="2 replays twice as fast as captured")
+    parser.add_argument("--llm-port", type=int, default=DEFAULT_LLM_PORT, help="port of the fake LLM")
+    parser.add_argument("--llm-config", action="store_true", help="print llm_providers.json for the test instance and exit")
+    parser.add_argument("--teacher-username", default="teacher")
+    parser.add_argument("--teacher-password", default="123456")
+    parser.add_argument("--class-name", default="REPLAY", help="class of the students created for the replay")
+    parser.add_argument("--limit", type=int, help="replay only the first N records")
+    parser.add_argument("--report", help="also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.llm_config:
+        print(json.dumps(llm_config(args.llm_port), indent=2))
+        return
+    if not args.captures:
+        parser.error("no capture files given")
+    records = load_capture(args.captures, args.limit)
+    if not records:
+        sys.exit("Capture is empty")
+    profiles = {r["index"]: r["llm"] for r in records if r.get("llm")}
+    server = start_fake_llm(profiles, args.speed, args.llm_port)
+    replayer = Replayer(records, args.target, args.speed, args.teacher_username, args.teacher_password,
+                        args.class_name)
+    try:
+        asyncio.run(replayer.run())
+    finally:
+        server.should_exit = True
+    report = replayer.report()
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import bisect
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Matching rule shared by the Postgres /search query, InvertedIndex and highlight(): query terms of
+# MIN_PREFIX_LENGTH or more characters match as prefixes ("chuyen" finds "chuyenkhoan"), shorter
+# ones only as whole words, since a one- or two-letter prefix matches most Vietnamese syllables
+MIN_PREFIX_LENGTH = 3
+
+# Accented Vietnamese letters and their base letters, used by the vn_normalize()
+# SQL function so Postgres and normalize_vn() fold text the same way
+VN_ACCENTED = (
+    "àáảãạăằắẳẵặâầấẩẫậèéẻẽẹêềếểễệìíỉĩịòóỏõọôồốổỗộơờớởỡợùúủũụưừứửữựỳýỷỹỵđ"
+    "ÀÁẢÃẠĂẰẮẲẴẶÂẦẤẨẪẬÈÉẺẼẸÊỀẾỂỄỆÌÍỈĨỊÒÓỎÕỌÔỒỐỔỖỘƠỜỚỞỠỢÙÚỦŨỤƯỪỨỬỮỰỲÝỶỸỴĐ"
+)
+VN_UNACCENTED = (
+    "aaaaaaaaaaaaaaaaaeeeeeeeeeeeiiiiiooooooooooooooooouuuuuuuuuuuyyyyyd"
+    "aaaaaaaaaaaaaaaaaeeeeeeeeeeeiiiiiooooooooooooooooouuuuuuuuuuuyyyyyd"
+)
+
+
+@lru_cache(maxsize=4096)
+def _fold_char(ch: str) -> str:
+    if ch in "đĐ":
+        return "d"
+    base = unicodedata.normalize("NFD", ch)[0].lower()
+    # Keep a 1:1 character mapping so match offsets line up with the original text
+    return base if len(base) == 1 else ch
+
+
+def normalize_vn(text: str) -> str:
+    return "".join(_fold_char(ch) for ch in text)
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(normalize_vn(text))
+
+
+def is_prefix_term(term: str) -> bool:
+    return len(term) >= MIN_PREFIX_LENGTH
+
+
+def to_prefix_tsquery(query: str) -> Optional[str]:
+    # Tokens only contain \w characters, so they are safe to join into a tsquery
+    terms = tokenize(query)
+    if not terms:
+        return None
+    return " & ".join(f"{term}:*" if is_prefix_term(term) else term for term in terms)
+
+
+def highlight(content: str, query: str, pre: str = "<mark>", post: str = "</mark>", width: int = 160) -> str:
+    folded = normalize_vn(content)
+    spans = []
+    for term in set(tokenize(query)):
+        pattern = r"\b" + re.escape(term) + ("" if is_prefix_term(term) else r"\b")
+        for match in re.finditer(pattern, folded):
+            end = match.end()
+            # Extend prefix matches to the end of the word
+            while end < len(folded) and (folded[end].isalnum() or folded[end] == "_"):
+                end += 1
+            spans.append((match.start(), end))
+    if not spans:
+        return content[:width] + ("…" if len(content) > width else "")
+
+    spans.sort()
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    window_start = max(0, merged[0][0] - width // 3)
+    window_end = min(len(content), window_start + width)
+    parts = ["…"] if window_start > 0 else []
+    cursor = window_start
+    for start, end in merged:
+        if start >= window_end:
+            break
+        end = min(end, window_end)
+        parts.append(content[cursor:start])
+        parts.append(pre + content[start:end] + post)
+        cursor = end
+    parts.append(content[cursor:window_end])
+    if window_end < len(content):
+        parts.append("…")
+    return "".join(parts)
+
+
+# In-process inverted index for deployments without Postgres full-text search.
+# Documents must be added in increasing id order so postings stay sorted.
+class InvertedIndex:
+    def __init__(self):
+        self.last_id = 0
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+        self._meta: Dict[int, Tuple] = {}
+        self._sorted_terms: Optional[List[str]] = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._meta)
+
+    def add(self, doc_id: int, content: str, meta: Tuple):
+        with self._lock:
+            if doc_id <= self.last_id:
+                return
+            for term in set(tokenize(content)):
+                if term not in self._postings:
+                    self._sorted_terms = None
+                self._postings[term].append(doc_id)
+            self._meta[doc_id] = meta
+            self.last_id = doc_id
+
+    def _matching_postings(self, term: str) -> List[int]:
+        if not is_prefix_term(term):
+            return self._postings.get(term) or []
+        # Longer query terms are prefixes, like the ":*" terms of to_prefix_tsquery()
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        start = bisect.bisect_left(self._sorted_terms, term)
+        end = bisect.bisect_left(self._sorted_terms, term + "\uffff")
+        prefixed = [self._postings[key] for key in self._sorted_terms[start:end]]
+        if len(prefixed) <= 1:
+            return prefixed[0] if prefixed else []
+        return sorted(set().union(*prefixed))
+
+    def search(self, query: str, filter_fn: Optional[Callable[[Tuple], bool]] = None,
+               before_id: Optional[int] = None, limit: int = 20) -> Tuple[List[int], Optional[int]]:
+        terms = set(tokenize(query))
+        if not terms:
+            return [], None
+        with self._lock:
+            lists = sorted((self._matching_postings(term) for term in terms), key=len)
+            if not lists[0]:
+                return [], None
+            smallest, others = lists[0], lists[1:]
+            end = len(smallest) if before_id is None else bisect.bisect_left(smallest, before_id)
+            results = []
+            for i in range(end - 1, -1, -1):
+                doc_id = smallest[i]
+                if not all(_contains(postings, doc_id) for postings in others):
+                    continue
+                if filter_fn is not None and not filter_fn(self._meta[doc_id]):
+                    continue
+                if len(results) == limit:
+                    return results, results[-1]
+                results.append(doc_id)
+            return results, None
+
+
+def _contains(postings: List[int], doc_id: int) -> bool:
+    i = bisect.bisect_left(postings, doc_id)
+    return i < len(postings) and postings[i] == doc_id
@@ -0,0 +1,294 @@
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_DB_PATH = "student_management.db"
+POOL_SIZE = int(os.environ.get("CHAT_DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = int(os.environ.get("CHAT_DB_BUSY_TIMEOUT_MS", "5000"))
+WRITE_BATCH_SIZE = int(os.environ.get("CHAT_DB_WRITE_BATCH_SIZE", "200"))
+WRITE_BATCH_WAIT_SECONDS = float(os.environ.get("CHAT_DB_WRITE_BATCH_WAIT_SECONDS", "0.002"))
+
+PRAGMAS = [
+    # WAL lets readers proceed while one writer commits
+    "PRAGMA journal_mode=WAL",
+    # Safe with WAL: a crash can lose the last commits but never corrupts the database
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+]
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE,
+        name TEXT,
+        class TEXT,
+        gvcn TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS chat_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        title TEXT,
+        created_at TEXT,
+        FOREIGN KEY (student_id) REFERENCES students(id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER,
+        role TEXT,
+        content TEXT,
+        timestamp TEXT,
+        read_by_teacher INTEGER DEFAULT 0,
+        FOREIGN KEY (session_id) REFERENCES chat_sessions(id)
+    )
+    ''',
+    # Same layout as token_usage in chat_server.py's PostgreSQL (usage.py); day is an ISO date
+    '''
+    CREATE TABLE IF NOT EXISTS token_usage (
+        day TEXT NOT NULL,
+        class TEXT NOT NULL,
+        student_id INTEGER NOT NULL,
+        session_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        estimated_calls INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, class, student_id, session_id, model)
+    )
+    ''',
+]
+
+# Change counters let views poll one row instead of re-running their queries.
+# "student_list" moves whenever the teacher's student list could look different.
+CHANGE_COUNTERS = [
+    "CREATE TABLE IF NOT EXISTS change_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+    "INSERT OR IGNORE INTO change_counters (name, value) VALUES ('student_list', 0)",
+    """
+    CREATE TRIGGER IF NOT EXISTS conversations_insert_student_list AFTER INSERT ON conversations
+    BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'student_list'; END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversations_read_student_list AFTER UPDATE OF read_by_teacher ON conversations
+    BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'student_list'; END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS students_insert_student_list AFTER INSERT ON students
+    BEGIN UPDATE change_counters SET value = value + 1 WHERE name = 'student_list'; END
+    """,
+]
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS conversations_session_id_timestamp_idx ON conversations (session_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS chat_sessions_student_id_created_at_idx ON chat_sessions (student_id, created_at)",
+]
+
+
+# Small pool of autocommit connections shared by all Streamlit session threads.
+# Each connection is used by one thread at a time.
+class ConnectionPool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, isolation_level=None)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+
+# Group commit: concurrent writes are queued and committed together in one
+# transaction, so 100 sessions posting at once cost a handful of commits.
+# Callers still block until their row is durable, keeping read-after-write.
+class GroupCommitWriter:
+    def __init__(self, pool: ConnectionPool, max_batch: int, max_wait: float):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.statements = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql: str, params=()) -> int:
+        future = Future()
+        self._queue.put((sql, params, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get(timeout=self.max_wait))
+            except queue.Empty:
+                pass
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with transaction(self.pool) as cur:
+                results = []
+                for sql, params, _ in batch:
+                    cur.execute(sql, params)
+                    results.append(cur.lastrowid)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            # Retry one by one so a single bad statement only fails its own caller
+            for item in batch:
+                self._commit([item])
+            return
+        self.batches += 1
+        self.statements += len(batch)
+        for (_, _, future), lastrowid in zip(batch, results):
+            future.set_result(lastrowid)
+
+
+_pool = None
+_writer = None
+_init_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _init_lock:
+            if _pool is None:
+                # Read lazily so a .env loaded by the app can still set the path
+                _pool = ConnectionPool(os.environ.get("CHAT_DB_PATH", DEFAULT_DB_PATH), POOL_SIZE)
+    return _pool
+
+
+def get_writer() -> GroupCommitWriter:
+    global _writer
+    if _writer is None:
+        with _init_lock:
+            if _writer is None:
+                _writer = GroupCommitWriter(get_pool(), WRITE_BATCH_SIZE, WRITE_BATCH_WAIT_SECONDS)
+    return _writer
+
+
+@contextmanager
+def transaction(pool: ConnectionPool = None):
+    with (pool or get_pool()).connection() as conn:
+        # IMMEDIATE takes the write lock up front instead of failing on upgrade
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.cursor()
+        try:
+            yield cur
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def fetch_all(sql: str, params=()):
+    with get_pool().connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def fetch_one(sql: str, params=()):
+    with get_pool().connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+
+def execute(sql: str, params=()) -> int:
+    return get_writer().submit(sql, params)
+
+
+def get_change_counter(name: str) -> int:
+    result = fetch_one("SELECT value FROM change_counters WHERE name = ?", (name,))
+    return result[0] if result else 0
+
+
+def execute_many(sql: str, rows):
+    with transaction() as cur:
+        cur.executemany(sql, rows)
+
+
+def record_token_usage(rows):
+    # rows from usage.UsageTracker.drain()
+    execute_many("""
+    INSERT INTO token_usage (day, class, student_id, session_id, model, calls, estimated_calls, prompt_tokens, completion_tokens)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (day, class, student_id, session_id, model) DO UPDATE SET
+        calls = token_usage.calls + excluded.calls,
+        estimated_calls = token_usage.estimated_calls + excluded.estimated_calls,
+        prompt_tokens = token_usage.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = token_usage.completion_tokens + excluded.completion_tokens
+    """, [(day.isoformat(),) + tuple(rest) for day, *rest in rows])
+
+
+def init_db(pool: ConnectionPool = None):
+    with transaction(pool) as cur:
+        for statement in SCHEMA:
+            cur.execute(statement)
+
+        # Migration for old database schema
+        cur.execute("PRAGMA table_info(conversations)")
+        columns = [info[1] for info in cur.fetchall()]
+
+        if 'session_id' not in columns:
+            cur.execute("ALTER TABLE conversations ADD COLUMN session_id INTEGER")
+
+            if 'student_id' in columns:
+                cur.execute("SELECT DISTINCT student_id FROM conversations")
+                session_map = {}
+                for (sid,) in cur.fetchall():
+                    timestamp = datetime.now()
+                    title = f"Legacy Chat {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
+                    cur.execute("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
+                                (sid, title, timestamp.isoformat()))
+                    session_map[sid] = cur.lastrowid
+                cur.executemany("UPDATE conversations SET session_id = ? WHERE student_id = ?",
+                                [(session_id, sid) for sid, session_id in session_map.items()])
+
+        if 'read_by_teacher' not in columns:
+            cur.execute("ALTER TABLE conversations ADD COLUMN read_by_teacher INTEGER DEFAULT 0")
+
+        for statement in INDEXES + CHANGE_COUNTERS:
+            cur.execute(statement)
@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+import storage
+
+THREADS = 100
+ROUNDS = 20
+# Every few rounds a thread also writes a small batch in its own transaction, like execute_many()
+BATCH_EVERY = 5
+BATCH_ROWS = 3
+
+
+def run(path: str) -> dict:
+    # The same pool and group-commit writer chat.py uses, on a throwaway database
+    pool = storage.ConnectionPool(path, storage.POOL_SIZE)
+    writer = storage.GroupCommitWriter(pool, storage.WRITE_BATCH_SIZE, storage.WRITE_BATCH_WAIT_SECONDS)
+    with storage.transaction(pool) as cur:
+        for statement in storage.SCHEMA + storage.INDEXES + storage.CHANGE_COUNTERS:
+            cur.execute(statement)
+        cur.executemany("INSERT INTO chat_sessions (student_id, title, created_at) VALUES (?, ?, ?)",
+                        [(i, f"Session {i}", "2024-01-01T00:00:00") for i in range(THREADS)])
+
+    errors = []
+    row_ids = []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def worker(n: int):
+        session_id = n + 1
+        ids = []
+        try:
+            start.wait()
+            for i in range(ROUNDS):
+                ids.append(writer.submit(
+                    "INSERT INTO conversations (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                    (session_id, "user", f"message {i}", f"2024-01-01T00:00:{i:02d}")))
+                with pool.connection() as conn:
+                    count = conn.execute("SELECT COUNT(*) FROM conversations WHERE session_id = ?",
+                                         (session_id,)).fetchone()[0]
+                    conn.execute("SELECT value FROM change_counters WHERE name = 'student_list'").fetchone()
+                # Group commit keeps read-after-write: this thread's rows are all visible already
+                if count < i + 1:
+                    raise AssertionError(f"session {session_id}: {count} rows visible after {i + 1} writes")
+                if i % BATCH_EVERY == 0:
+                    with storage.transaction(pool) as cur:
+                        cur.executemany("INSERT INTO conversations (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                                        [(session_id, "assistant", f"reply {i}.{j}", f"2024-01-01T00:01:{i:02d}")
+                                         for j in range(BATCH_ROWS)])
+        except Exception as e:
+            with lock:
+                errors.append(e)
+        with lock:
+            row_ids.extend(ids)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with pool.connection() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        per_session = dict(conn.execute("SELECT session_id, COUNT(*) FROM conversations GROUP BY session_id").fetchall())
+        counter = conn.execute("SELECT value FROM change_counters WHERE name = 'student_list'").fetchone()[0]
+    return {"errors": errors, "row_ids": row_ids, "total": total, "per_session": per_session,
+            "counter": counter, "batches": writer.batches, "statements": writer.statements}
+
+
+def check(result: dict):
+    batches = (ROUNDS + BATCH_EVERY - 1) // BATCH_EVERY
+    per_thread = ROUNDS + batches * BATCH_ROWS
+    locked = [e for e in result["errors"] if isinstance(e, sqlite3.OperationalError) and "locked" in str(e)]
+    assert not locked, f"{len(locked)} 'database is locked' errors, first: {locked[0]}"
+    assert not result["errors"], f"{len(result['errors'])} errors, first: {result['errors'][0]!r}"
+    assert result["total"] == THREADS * per_thread
+    assert result["per_session"] == {n + 1: per_thread for n in range(THREADS)}
+    # Every group-committed insert got its own row id back
+    assert len(set(result["row_ids"])) == THREADS * ROUNDS
+    assert result["statements"] == THREADS * ROUNDS
+    # The change-counter trigger fired once per inserted row
+    assert result["counter"] == THREADS * per_thread
+
+
+def test_concurrent_reads_and_writes():
+    with tempfile.TemporaryDirectory() as tmp:
+        check(run(os.path.join(tmp, "concurrency.db")))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run(os.path.join(tmp, "concurrency.db"))
+    check(result)
+    print(f"OK: {result['total']} rows from {THREADS} threads, "
+          f"{result['statements']} group-committed writes in {result['batches']} commits")
+    sys.exit(0)
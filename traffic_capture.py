@@ -0,0 +1,304 @@
+import contextvars
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+from urllib.parse import parse_qsl
+
+from jose import jwt
+
+# Opt-in: set TRAFFIC_CAPTURE_PATH to record sanitized traffic for replay.py, e.g.
+# captures/traffic-%Y%m%d.jsonl (strftime placeholders give one file per day). Empty means no capture.
+TRAFFIC_CAPTURE_PATH = os.environ.get("TRAFFIC_CAPTURE_PATH", "")
+TRAFFIC_CAPTURE_SAMPLE = float(os.environ.get("TRAFFIC_CAPTURE_SAMPLE", "1"))
+# "mask" keeps only the shape of free text (length, spaces, punctuation); "keep" stores it verbatim.
+# Tokens, passwords and usernames are replaced either way.
+TRAFFIC_CAPTURE_CONTENT = os.environ.get("TRAFFIC_CAPTURE_CONTENT", "mask")
+MAX_BODY_BYTES = 64 * 1024
+MAX_RESPONSE_BYTES = 8 * 1024
+MAX_STREAM_CHUNKS = 2000
+MAX_WS_FRAMES = 2000
+WRITE_QUEUE_SIZE = 10000
+
+# Values kept as they are: ids, roles, dates and other fields replay needs to rebuild requests
+KEEP_FIELDS = {"role", "type", "user_type", "status", "timestamp", "last_message_at", "created_at", "archived_at",
+               "date_from", "date_to", "format", "class", "class_name", "ai_enabled", "sort", "order", "seq"}
+TOKEN_FIELDS = {"token", "access_token"}
+SECRET_FIELDS = {"password"}
+PSEUDONYM_FIELDS = {"username"}
+JWT_RE = re.compile(r"eyJ[\w-]*\.[\w-]+\.[\w-]*")
+
+# The record of the request being handled, so endpoints can add details with annotate()
+_current: contextvars.ContextVar = contextvars.ContextVar("traffic_capture_record", default=None)
+
+# Usernames are phone numbers: hash them with a per-process salt so they cannot be looked up
+_pseudonym_salt = secrets.token_bytes(16)
+
+
+def principal_label(token: str) -> str:
+    # "student:12" / "teacher:1" from the (unverified) claims; replay maps these to its own accounts
+    try:
+        claims = jwt.get_unverified_claims(token)
+        return f"{claims['type']}:{claims['sub']}"
+    except Exception:
+        return "invalid"
+
+
+def pseudonym(value: str) -> str:
+    return "u_" + hashlib.sha256(_pseudonym_salt + value.encode("utf-8")).hexdigest()[:10]
+
+
+def mask_text(text: str) -> str:
+    # Same length and layout, no words: letters -> x, digits -> 0, spaces and punctuation kept
+    return re.sub(r"\w", lambda m: "0" if m.group().isdigit() else "x", text)
+
+
+def sanitize(value, key: Optional[str] = None, keep_content: bool = False):
+    if isinstance(value, dict):
+        return {k: sanitize(v, k, keep_content) for k, v in value.items()}
+    if isinstance(value, list):
+        return [sanitize(v, key, keep_content) for v in value]
+    if not isinstance(value, str):
+        return value
+    if key in TOKEN_FIELDS:
+        return principal_label(value)
+    if key in SECRET_FIELDS:
+        return "***"
+    if key in PSEUDONYM_FIELDS:
+        return pseudonym(value)
+    if key in KEEP_FIELDS or (key and key.endswith("_id")):
+        return value
+    text = JWT_RE.sub(lambda m: principal_label(m.group()), value)
+    return text if keep_content else mask_text(text)
+
+
+def annotate(**fields):
+    # Adds fields to the capture record of the current request; a no-op when capture is off
+    record = _current.get()
+    if record is not None:
+        record.update(fields)
+
+
+class UpstreamTiming:
+    # Chunk timing of one LLM stream inside /chatbot, stored as the "llm" field of its record so
+    # replay.py can make its fake LLM answer with the same first-token delay and pacing
+    def __init__(self, route: str):
+        self.enabled = _current.get() is not None
+        self.route = route
+        self.started = time.perf_counter()
+        self.provider: Optional[str] = None
+        self.offsets_ms: List[float] = []
+        self.chars: List[int] = []
+
+    def chunk(self, content: str, provider: Optional[str] = None):
+        if not self.enabled or len(self.offsets_ms) >= MAX_STREAM_CHUNKS:
+            return
+        self.provider = self.provider or provider
+        self.offsets_ms.append(round((time.perf_counter() - self.started) * 1000, 1))
+        self.chars.append(len(content))
+
+    def finish(self, finish_reason: Optional[str] = None, error: Optional[str] = None):
+        if not self.enabled:
+            return
+        self.enabled = False
+        annotate(llm={
+            "route": self.route,
+            "provider": self.provider,
+            "first_token_ms": self.offsets_ms[0] if self.offsets_ms else None,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "chunk_offsets_ms": self.offsets_ms,
+            "chunk_chars": self.chars,
+            "finish_reason": finish_reason,
+            "error": error,
+        })
+
+
+class CaptureWriter:
+    # Appends records as JSON lines from a background thread so the event loop never waits on the disk
+    def __init__(self, path_template: str):
+        self.path_template = path_template
+        self.queue: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        current_path, f = None, None
+        while True:
+            record = self.queue.get()
+            path = datetime.fromtimestamp(record["ts"]).strftime(self.path_template)
+            try:
+                if path != current_path:
+                    if f is not None:
+                        f.close()
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    f = open(path, "a", encoding="utf-8")
+                    current_path = path
+                f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+                self.written += 1
+                if self.queue.empty():
+                    f.flush()
+            except Exception as e:
+                self.dropped += 1
+                print(f"Traffic capture write error for {path}: {str(e)}")
+
+
+class TrafficCapture:
+    # Pure ASGI middleware (it must not buffer streaming responses): records every HTTP request and
+    # websocket connection with its timing. Records are written when the request or connection ends.
+    def __init__(self, app, path: str = TRAFFIC_CAPTURE_PATH, sample: float = TRAFFIC_CAPTURE_SAMPLE,
+                 keep_content: bool = TRAFFIC_CAPTURE_CONTENT == "keep"):
+        self.app = app
+        self.sample = sample
+        self.keep_content = keep_content
+        self.writer = CaptureWriter(path)
+        print(f"Capturing traffic to {path} (sample={sample}, content={'keep' if keep_content else 'mask'})")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or (self.sample < 1 and random.random() >= self.sample):
+            await self.app(scope, receive, send)
+            return
+        record = {"kind": scope["type"], "ts": time.time(), "method": scope.get("method", "WS"),
+                  "path": JWT_RE.sub(lambda m: principal_label(m.group()), scope["path"])}
+        query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        if query:
+            record["query"] = sanitize(query, keep_content=self.keep_content)
+        # Only the headers that change how a response is built: compression and conditional requests
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                record["accept_encoding"] = value.decode("latin-1")
+            elif name in (b"if-none-match", b"if-modified-since"):
+                record["conditional"] = True
+        context_token = _current.set(record)
+        try:
+            if scope["type"] == "http":
+                await self._http(scope, receive, send, record)
+            else:
+                await self._websocket(scope, receive, send, record)
+        except Exception as e:
+            record["exception"] = type(e).__name__
+            raise
+        finally:
+            _current.reset(context_token)
+            self._finish(scope, record)
+
+    async def _http(self, scope, receive, send, record: dict):
+        started = time.perf_counter()
+        body = bytearray()
+        response_body = bytearray()
+        response = {"content_type": "", "bytes": 0, "offsets": []}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request" and len(body) <= MAX_BODY_BYTES:
+                body.extend(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-type":
+                        response["content_type"] = value.decode("latin-1")
+            elif message["type"] == "http.response.body" and message.get("body"):
+                chunk = message["body"]
+                offset = round((time.perf_counter() - started) * 1000, 1)
+                record.setdefault("ttfb_ms", offset)
+                response["bytes"] += len(chunk)
+                if response["content_type"].startswith("text/event-stream"):
+                    if len(response["offsets"]) < MAX_STREAM_CHUNKS:
+                        response["offsets"].append(offset)
+                elif len(response_body) <= MAX_RESPONSE_BYTES:
+                    response_body.extend(chunk)
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            record["response_bytes"] = response["bytes"]
+            record["body"] = self._json(body, MAX_BODY_BYTES)
+            if response["offsets"]:
+                record["stream_offsets_ms"] = response["offsets"]
+            elif response["content_type"].startswith("application/json"):
+                # Small JSON responses carry the ids replay needs to map (new sessions, logins)
+                record["response"] = self._json(response_body, MAX_RESPONSE_BYTES)
+
+    async def _websocket(self, scope, receive, send, record: dict):
+        started = time.perf_counter()
+        frames = []
+        record["frames"] = frames
+
+        def offset():
+            return round((time.perf_counter() - started) * 1000, 1)
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "websocket.receive":
+                data = message.get("text") or message.get("bytes") or ""
+                if len(frames) < MAX_WS_FRAMES:
+                    frames.append({"dir": "in", "t_ms": offset(), "bytes": len(data),
+                                   "data": self._json(data.encode("utf-8") if isinstance(data, str) else data)})
+                else:
+                    record["frames_dropped"] = record.get("frames_dropped", 0) + 1
+            elif message["type"] == "websocket.disconnect":
+                record["close_code"] = message.get("code")
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "websocket.accept":
+                record["accept_ms"] = offset()
+            elif message["type"] == "websocket.send":
+                data = message.get("text") or message.get("bytes") or ""
+                if len(frames) < MAX_WS_FRAMES:
+                    # Outgoing frames keep only their type; replay compares counts and timing
+                    parsed = self._json(data.encode("utf-8") if isinstance(data, str) else data)
+                    frame_type = parsed.get("type", "message") if isinstance(parsed, dict) else None
+                    frames.append({"dir": "out", "t_ms": offset(), "bytes": len(data), "type": frame_type})
+                else:
+                    record["frames_dropped"] = record.get("frames_dropped", 0) + 1
+            elif message["type"] == "websocket.close":
+                record["close_code"] = message.get("code", 1000)
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            record["duration_ms"] = offset()
+
+    def _json(self, data: bytes, limit: Optional[int] = None):
+        if not data or (limit is not None and len(data) > limit):
+            return None
+        try:
+            return sanitize(json.loads(data), keep_content=self.keep_content)
+        except ValueError:
+            return None
+
+    def _finish(self, scope, record: dict):
+        # The router stores the matched route and its parameters in the scope
+        route = scope.get("route")
+        if route is not None:
+            record["route"] = route.path
+            record["path_params"] = sanitize(scope.get("path_params", {}), keep_content=self.keep_content)
+        principal = next((record[k]["token"] for k in ("path_params", "query", "body")
+                          if isinstance(record.get(k), dict) and isinstance(record[k].get("token"), str)), None)
+        if principal is None and isinstance(record.get("response"), dict):
+            # Logins: the caller is whoever the returned token belongs to
+            principal = record["response"].get("token")
+        if isinstance(principal, str):
+            record["principal"] = principal
+        self.writer.write(record)
@@ -0,0 +1,334 @@
+import json
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+USAGE_BUDGETS_PATH = os.environ.get("USAGE_BUDGETS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "usage_budgets.json"))
+USAGE_FLUSH_SECONDS = float(os.environ.get("USAGE_FLUSH_SECONDS", "15"))
+USAGE_FLUSH_MAX_PENDING = int(os.environ.get("USAGE_FLUSH_MAX_PENDING", "500"))
+# Longest prompt sent upstream (usage_budgets.json "max_prompt_tokens" overrides it); older turns are
+# dropped to fit. 0 sends every prompt as it is.
+USAGE_MAX_PROMPT_TOKENS = int(os.environ.get("USAGE_MAX_PROMPT_TOKENS", "6000"))
+# Under a blocking hard budget, a request needs room for at least this much answer to be sent
+MIN_COMPLETION_TOKENS = 64
+# Budget days follow the school's clock, like the analytics rollups. Read here rather than imported
+# from analytics, so chat.py (SQLite or api mode) does not load analytics and psycopg2.
+USAGE_TIMEZONE = ZoneInfo(os.environ.get("ANALYTICS_TIMEZONE", "Asia/Ho_Chi_Minh"))
+
+# Used when usage_budgets.json is missing: usage is recorded, nothing is limited
+DEFAULT_CONFIG = {}
+
+USAGE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS token_usage (
+        day DATE NOT NULL,
+        class TEXT NOT NULL,
+        student_id INTEGER NOT NULL,
+        session_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        estimated_calls INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens BIGINT NOT NULL DEFAULT 0,
+        completion_tokens BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, class, student_id, session_id, model)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_token_usage_class_day ON token_usage (class, day)",
+]
+USAGE_COLUMNS = ["calls", "estimated_calls", "prompt_tokens", "completion_tokens"]
+
+# Words and punctuation; a long word costs about one token per four characters
+TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+MESSAGE_OVERHEAD_TOKENS = 4
+
+LEVELS = ["ok", "soft", "hard", "blocked"]
+# Shown to the student when hard.block is on and the budget is used up
+BUDGET_BLOCKED_MESSAGE = "Hôm nay em đã dùng hết lượt hỏi AI, cô sẽ trả lời em sau nhé"
+# Shown when the newest message alone is longer than the prompt limit
+PROMPT_TOO_LONG_MESSAGE = "Câu hỏi của em dài quá, em viết ngắn lại giúp cô nhé"
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    # Used when the provider sends no usage data; close enough for budgets, not for billing
+    return sum((len(piece) + 3) // 4 for piece in TOKEN_PIECE_RE.findall(text or ""))
+
+
+def estimate_prompt_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(m.get("content")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def trim_messages(messages: List[dict], limit: int) -> List[dict]:
+    # Drops the oldest turns until the prompt fits in limit; the system prompt and the newest
+    # message always stay, so the result can still be over the limit
+    system = messages[:1] if messages and messages[0].get("role") == "system" else []
+    total = estimate_prompt_tokens(system)
+    kept = []
+    for message in reversed(messages[len(system):]):
+        tokens = estimate_prompt_tokens([message])
+        if kept and total + tokens > limit:
+            break
+        kept.append(message)
+        total += tokens
+    return system + kept[::-1]
+
+
+def load_config(path: str = USAGE_BUDGETS_PATH) -> dict:
+    if not os.path.exists(path):
+        return DEFAULT_CONFIG
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    for scope in ("class_daily_tokens", "student_daily_tokens"):
+        limits = config.get(scope) or {}
+        if limits.get("soft") and limits.get("hard") and limits["soft"] > limits["hard"]:
+            raise ValueError(f"{path}: {scope}.soft must not be above {scope}.hard")
+    return config
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class PromptTooLong(BudgetExceeded):
+    pass
+
+
+class Budget:
+    # Result of UsageTracker.check(): the strictest level reached by the class or the student today
+    def __init__(self, level: str = "ok", scope: Optional[str] = None, used: int = 0, limit: Optional[int] = None):
+        self.level = level
+        self.scope = scope
+        self.used = used
+        self.limit = limit
+
+    def as_dict(self) -> dict:
+        return {"level": self.level, "scope": self.scope, "used": self.used, "limit": self.limit}
+
+
+class Reservation:
+    # Tokens a request may still use, counted against today's budgets from UsageTracker.admit()
+    # until release(), so requests running at the same time cannot all pass on the same headroom
+    def __init__(self, tracker: "UsageTracker", keys: List[tuple], tokens: int):
+        self.tracker = tracker
+        self.keys = keys
+        self.tokens = tokens
+        self.released = False
+
+    def release(self):
+        # Safe to call more than once; call after record()
+        self.tracker._release(self)
+
+
+class UsageTracker:
+    # Token counts per call, summed per (day, class, student, session, model) in memory and written
+    # to token_usage in batches. Today's totals per class and student drive the budgets.
+    def __init__(self, config: dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._pending: Dict[tuple, List[int]] = {}
+        # (day, "class", class name) / (day, "student", student id) -> tokens used that day
+        self._totals: Dict[tuple, int] = {}
+        # Same keys -> tokens held by requests still waiting for their usage
+        self._reserved: Dict[tuple, int] = {}
+        self._last_flush = time.monotonic()
+        self.calls = 0
+        self.estimated_calls = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.levels = dict.fromkeys(LEVELS, 0)
+
+    def limits(self, scope: str, key) -> Tuple[Optional[int], Optional[int]]:
+        if scope == "class":
+            limits = (self.config.get("classes") or {}).get(key) or self.config.get("class_daily_tokens") or {}
+        else:
+            limits = self.config.get("student_daily_tokens") or {}
+        return limits.get("soft"), limits.get("hard")
+
+    def used(self, scope: str, key, day: Optional[date] = None) -> int:
+        return self._totals.get((day or usage_day(), scope, key), 0)
+
+    def reserved(self, scope: str, key, day: Optional[date] = None) -> int:
+        return self._reserved.get((day or usage_day(), scope, key), 0)
+
+    def level(self, scope: str, key, day: Optional[date] = None) -> Budget:
+        soft, hard = self.limits(scope, key)
+        used = self.used(scope, key, day) + self.reserved(scope, key, day)
+        if hard and used >= hard:
+            return Budget("blocked" if (self.config.get("hard") or {}).get("block") else "hard", scope, used, hard)
+        if soft and used >= soft:
+            return Budget("soft", scope, used, soft)
+        return Budget("ok", scope, used, soft or hard)
+
+    def check(self, class_name: Optional[str], student_id: Optional[int]) -> Budget:
+        day = usage_day()
+        budget = Budget()
+        for scope, key in (("class", class_name or ""), ("student", student_id)):
+            if key is None:
+                continue
+            reached = self.level(scope, key, day)
+            if LEVELS.index(reached.level) > LEVELS.index(budget.level):
+                budget = reached
+        with self._lock:
+            self.levels[budget.level] += 1
+        return budget
+
+    def apply(self, budget: Budget, route: str, router) -> Tuple[str, dict]:
+        # Over the soft budget: shorter answers. Over the hard budget: also the cheaper route.
+        policy = self.config.get(budget.level) if budget.level in ("soft", "hard") else None
+        if policy and policy.get("route") in router.routes:
+            route = policy["route"]
+        args = router.completion_args(route)
+        if policy and policy.get("max_tokens"):
+            args["max_tokens"] = min(args["max_tokens"], policy["max_tokens"])
+        return route, args
+
+    def admit(self, class_name: Optional[str], student_id: Optional[int], messages: List[dict],
+              args: dict) -> Tuple[List[dict], dict, Reservation]:
+        # Before the provider call: fits the prompt into max_prompt_tokens and, when hard.block is on,
+        # into what is left of today's hard budgets, lowering max_tokens to match. Reserves the prompt
+        # plus max_tokens until record(). Raises PromptTooLong or BudgetExceeded instead of calling.
+        limit = self.config.get("max_prompt_tokens", USAGE_MAX_PROMPT_TOKENS)
+        fitted = trim_messages(messages, limit) if limit else messages
+        prompt_tokens = estimate_prompt_tokens(fitted)
+        if limit and prompt_tokens > limit:
+            raise PromptTooLong(PROMPT_TOO_LONG_MESSAGE)
+        day = usage_day()
+        keys = [(day, "class", class_name or "")] + ([(day, "student", student_id)] if student_id is not None else [])
+        max_tokens = args["max_tokens"]
+        with self._lock:
+            if (self.config.get("hard") or {}).get("block"):
+                rooms = []
+                for key in keys:
+                    _, hard = self.limits(key[1], key[2])
+                    if hard:
+                        rooms.append(hard - self._totals.get(key, 0) - self._reserved.get(key, 0))
+                if rooms:
+                    room = min(rooms)
+                    if prompt_tokens + MIN_COMPLETION_TOKENS > room:
+                        fitted = trim_messages(fitted, room - MIN_COMPLETION_TOKENS)
+                        prompt_tokens = estimate_prompt_tokens(fitted)
+                        if prompt_tokens + MIN_COMPLETION_TOKENS > room:
+                            raise BudgetExceeded(BUDGET_BLOCKED_MESSAGE)
+                    max_tokens = min(max_tokens, room - prompt_tokens)
+            tokens = prompt_tokens + max_tokens
+            for key in keys:
+                self._reserved[key] = self._reserved.get(key, 0) + tokens
+        return fitted, dict(args, max_tokens=max_tokens), Reservation(self, keys, tokens)
+
+    def _release(self, reservation: Reservation):
+        with self._lock:
+            if reservation.released:
+                return
+            reservation.released = True
+            for key in reservation.keys:
+                left = self._reserved.get(key, 0) - reservation.tokens
+                if left > 0:
+                    self._reserved[key] = left
+                else:
+                    self._reserved.pop(key, None)
+
+    def record(self, class_name: Optional[str], student_id: Optional[int], session_id: Optional[int], model: str,
+               messages: List[dict], reply: str, usage: Optional[dict] = None) -> dict:
+        # usage: the provider's {"prompt_tokens", "completion_tokens"}, estimated locally when missing
+        estimated = not usage or usage.get("prompt_tokens") is None
+        prompt_tokens = estimate_prompt_tokens(messages) if estimated else int(usage["prompt_tokens"])
+        completion_tokens = estimate_tokens(reply) if estimated else int(usage.get("completion_tokens") or 0)
+        day = usage_day()
+        class_name = class_name or ""
+        total = prompt_tokens + completion_tokens
+        with self._lock:
+            if self._totals and next(iter(self._totals))[0] != day:
+                # New school day: yesterday's totals no longer count towards any budget
+                self._totals = {key: value for key, value in self._totals.items() if key[0] == day}
+            row = self._pending.setdefault((day, class_name, student_id or 0, session_id or 0, model), [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += 1 if estimated else 0
+            row[2] += prompt_tokens
+            row[3] += completion_tokens
+            self._totals[(day, "class", class_name)] = self._totals.get((day, "class", class_name), 0) + total
+            if student_id is not None:
+                self._totals[(day, "student", student_id)] = self._totals.get((day, "student", student_id), 0) + total
+            self.calls += 1
+            self.estimated_calls += 1 if estimated else 0
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "estimated": estimated}
+
+    def seed(self, rows):
+        # rows: (day, class, student_id, tokens) already stored, so budgets survive a restart
+        with self._lock:
+            for day, class_name, student_id, tokens in rows:
+                tokens = int(tokens)
+                day = date.fromisoformat(day) if isinstance(day, str) else day
+                self._totals[(day, "class", class_name)] = self._totals.get((day, "class", class_name), 0) + tokens
+                if student_id:
+                    self._totals[(day, "student", student_id)] = self._totals.get((day, "student", student_id), 0) + tokens
+
+    def due(self) -> bool:
+        with self._lock:
+            return bool(self._pending) and (len(self._pending) >= USAGE_FLUSH_MAX_PENDING
+                                            or time.monotonic() - self._last_flush >= USAGE_FLUSH_SECONDS)
+
+    def drain(self) -> List[tuple]:
+        # Rows for write_rows(); hand them back with restore() if the write fails
+        with self._lock:
+            rows = [key + tuple(values) for key, values in self._pending.items()]
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        return rows
+
+    def restore(self, rows: List[tuple]):
+        with self._lock:
+            for row in rows:
+                values = self._pending.setdefault(row[:5], [0, 0, 0, 0])
+                for i, value in enumerate(row[5:]):
+                    values[i] += value
+
+    def flushed(self, rows: int):
+        with self._lock:
+            self.flushes += 1
+            self.flushed_rows += rows
+
+    def load_totals(self, cursor):
+        cursor.execute("""
+        SELECT day, class, student_id, SUM(prompt_tokens + completion_tokens)
+        FROM token_usage WHERE day = %s GROUP BY day, class, student_id
+        """, (usage_day(),))
+        self.seed(cursor.fetchall())
+
+    def budget_status(self, class_names) -> Dict[str, dict]:
+        # Today's usage against the budget of each class
+        day = usage_day()
+        status = {}
+        for class_name in class_names:
+            soft, hard = self.limits("class", class_name)
+            status[class_name] = {"used_today": self.used("class", class_name, day),
+                                  "reserved": self.reserved("class", class_name, day), "soft": soft, "hard": hard,
+                                  "level": self.level("class", class_name, day).level}
+        return status
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "estimated_calls": self.estimated_calls, "pending_rows": len(self._pending),
+                    "reserved_tokens": sum(tokens for (_, scope, _), tokens in self._reserved.items() if scope == "class"),
+                    "flushes": self.flushes, "flushed_rows": self.flushed_rows, "budget_checks": dict(self.levels)}
+
+
+def usage_day() -> date:
+    return datetime.now(USAGE_TIMEZONE).date()
+
+
+def write_rows(cursor, rows: List[tuple]):
+    # PostgreSQL upsert of drained rows; the caller commits (chat.py writes to SQLite through
+    # storage.record_token_usage instead, and never needs psycopg2)
+    from psycopg2.extras import execute_values
+    execute_values(cursor, f"""
+    INSERT INTO token_usage (day, class, student_id, session_id, model, {', '.join(USAGE_COLUMNS)}) VALUES %s
+    ON CONFLICT (day, class, student_id, session_id, model) DO UPDATE SET
+    {', '.join(f'{column} = token_usage.{column} + EXCLUDED.{column}' for column in USAGE_COLUMNS)}
+    """, rows, page_size=1000)
+
+
+def load_tracker(path: str = USAGE_BUDGETS_PATH) -> UsageTracker:
+    return UsageTracker(load_config(path))